@@ -0,0 +1,32 @@
+"""create suggestion table
+
+Revision ID: 0a6c4e8b2d1f
+Revises: f8b2d6a4c1e9
+Create Date: 2026-10-17 22:03:55.472190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0a6c4e8b2d1f'
+down_revision = 'f8b2d6a4c1e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'suggestion',
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('media_type', sa.String(50), primary_key=True),
+        sa.Column('rank', sa.Integer, primary_key=True),
+        sa.Column('media_id', sa.Integer, nullable=False),
+        sa.Column('score', sa.Float, nullable=False),
+        sa.Column('computed', sa.DateTime, nullable=False)
+    )
+
+
+def downgrade():
+    op.drop_table('suggestion')
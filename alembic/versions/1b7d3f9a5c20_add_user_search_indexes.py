@@ -0,0 +1,38 @@
+"""add user search indexes
+
+Trigram indexes for substring search on email and full name, and lower() text_pattern_ops indexes for the prefix
+search used for queries too short to have a trigram. Built concurrently so the user table stays writable.
+
+Revision ID: 1b7d3f9a5c20
+Revises: 0a6c4e8b2d1f
+Create Date: 2026-10-17 22:48:21.730562
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '1b7d3f9a5c20'
+down_revision = '0a6c4e8b2d1f'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_user_email_trgm', 'USING gin (email gin_trgm_ops)'),
+    ('ix_user_full_name_trgm', 'USING gin (full_name gin_trgm_ops)'),
+    ('ix_user_email_prefix', '(lower(email) text_pattern_ops)'),
+    ('ix_user_full_name_prefix', '(lower(full_name) text_pattern_ops)'),
+]
+
+
+def upgrade():
+    # pg_trgm was created by 7e3b1f6a8c52
+    with op.get_context().autocommit_block():
+        for name, definition in INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON "user" {definition}')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _ in reversed(INDEXES):
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
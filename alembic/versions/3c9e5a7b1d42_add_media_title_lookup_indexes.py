@@ -0,0 +1,34 @@
+"""add media title lookup indexes
+
+Btree indexes on lower(title) for matching imported lists against the catalog by exact title, many titles per
+query. Built concurrently so the media tables stay writable.
+
+Revision ID: 3c9e5a7b1d42
+Revises: 1b7d3f9a5c20
+Create Date: 2026-10-17 23:41:05.118342
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e5a7b1d42'
+down_revision = '1b7d3f9a5c20'
+branch_labels = None
+depends_on = None
+
+TABLES = ['book', 'movie', 'tv']
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_title_lower ON {table} (lower(title))")
+            # Statistics for the new expression, without which the planner guesses lookups match most of the table
+            op.execute(f"ANALYZE {table}")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in reversed(TABLES):
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_title_lower")
@@ -0,0 +1,85 @@
+"""add media source unique constraints
+
+Merges media rows that share (source, source_id) into the oldest one, repointing everything that refers to the
+duplicates, then adds a unique constraint on (source, source_id) to each media table so media can be upserted.
+The media tables and every table referring to media are locked against writes (reads carry on) until the whole
+revision commits, so nothing can be pointed at a duplicate between the repointing and the delete: media can't be
+added and lists, recommendations and suggestions can't be written while it runs.
+
+Revision ID: 4e1a7c9b3f65
+Revises: 3c9e5a7b1d42
+Create Date: 2026-10-18 01:12:37.520914
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4e1a7c9b3f65'
+down_revision = '3c9e5a7b1d42'
+branch_labels = None
+depends_on = None
+
+TABLES = ['book', 'movie', 'tv']
+# Tables with (media_type, media_id) references
+REFERENCING_TABLES = ['consumption', 'recommendation', 'consumption_latest', 'suggestion']
+
+# Per-user tables holding at most one row per item, and which row is kept when a user has rows for several
+# duplicates of an item
+CURRENT_STATE_TABLES = {
+    'consumption_latest': 'r.created DESC, r.consumption_id DESC',
+    'suggestion': 'r.rank',
+}
+
+
+def upgrade():
+    # All at once, in one order, so the locks are held together
+    op.execute(f"LOCK TABLE {', '.join(TABLES + REFERENCING_TABLES)} IN SHARE ROW EXCLUSIVE MODE")
+    for table in TABLES:
+        op.execute(f"""
+            CREATE TEMPORARY TABLE media_merge AS
+            SELECT id AS old_id, min(id) OVER (PARTITION BY source, source_id) AS new_id
+            FROM {table}
+            WHERE source IS NOT NULL AND source_id IS NOT NULL
+        """)
+        op.execute("DELETE FROM media_merge WHERE old_id = new_id")
+        # Usually a handful of rows; without statistics the planner would scan the referencing tables for them
+        op.execute("ANALYZE media_merge")
+
+        # History keeps every record, pointed at the surviving item
+        for history in ['consumption', 'recommendation']:
+            op.execute(f"""
+                UPDATE {history} SET media_id = media_merge.new_id
+                FROM media_merge
+                WHERE {history}.media_type = '{table}' AND {history}.media_id = media_merge.old_id
+            """)
+
+        for reference, winner_order in CURRENT_STATE_TABLES.items():
+            op.execute(f"""
+                DELETE FROM {reference} WHERE ctid IN (
+                    SELECT ctid FROM (
+                        SELECT r.ctid, row_number() OVER (
+                            PARTITION BY r.user_id, coalesce(m.new_id, r.media_id)
+                            ORDER BY {winner_order}) AS position
+                        FROM {reference} r
+                        LEFT JOIN media_merge m ON m.old_id = r.media_id
+                        WHERE r.media_type = '{table}'
+                          AND (r.media_id IN (SELECT old_id FROM media_merge)
+                               OR r.media_id IN (SELECT new_id FROM media_merge))
+                    ) ranked
+                    WHERE position > 1)
+            """)
+            op.execute(f"""
+                UPDATE {reference} SET media_id = media_merge.new_id
+                FROM media_merge
+                WHERE {reference}.media_type = '{table}' AND {reference}.media_id = media_merge.old_id
+            """)
+
+        op.execute(f"DELETE FROM {table} USING media_merge WHERE {table}.id = media_merge.old_id")
+        op.execute("DROP TABLE media_merge")
+        op.create_unique_constraint(f'uq_{table}_source_source_id', table, ['source', 'source_id'])
+
+
+def downgrade():
+    for table in reversed(TABLES):
+        op.drop_constraint(f'uq_{table}_source_source_id', table, type_='unique')
@@ -0,0 +1,33 @@
+"""create media metadata table
+
+Revision ID: 5c1e7a9d2f34
+Revises: 649ae8415d9c
+Create Date: 2026-10-17 09:12:40.218734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e7a9d2f34'
+down_revision = '649ae8415d9c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'media_metadata',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('source', sa.String(50), nullable=False),
+        sa.Column('media_type', sa.String(50), nullable=False),
+        sa.Column('source_id', sa.String(50), nullable=False),
+        sa.Column('payload', sa.JSON, nullable=False),
+        sa.Column('fetched', sa.DateTime, nullable=False),
+        sa.UniqueConstraint('source', 'media_type', 'source_id', name='uq_media_metadata_source_media_type_source_id')
+    )
+
+
+def downgrade():
+    op.drop_table('media_metadata')
@@ -0,0 +1,47 @@
+"""add media title trigram indexes
+
+Trigram indexes for substring search on titles (and book authors). Built concurrently so the media tables stay
+writable.
+
+Revision ID: 7e3b1f6a8c52
+Revises: 5c1e7a9d2f34
+Create Date: 2026-10-17 11:02:19.504113
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7e3b1f6a8c52'
+down_revision = '5c1e7a9d2f34'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_book_title_trgm', 'book', 'USING gin (title gin_trgm_ops)'),
+    ('ix_book_author_names_trgm', 'book',
+     "USING gin (immutable_array_to_string(author_names::text[], ' ') gin_trgm_ops)"),
+    ('ix_movie_title_trgm', 'movie', 'USING gin (title gin_trgm_ops)'),
+    ('ix_tv_title_trgm', 'tv', 'USING gin (title gin_trgm_ops)'),
+]
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # array_to_string is only STABLE, so it can't be used in an index expression directly
+    op.execute("""
+        CREATE OR REPLACE FUNCTION immutable_array_to_string(text[], text) RETURNS text
+        AS $$ SELECT array_to_string($1, $2) $$
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    """)
+    with op.get_context().autocommit_block():
+        for name, table, definition in INDEXES:
+            op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    op.execute("DROP FUNCTION immutable_array_to_string(text[], text)")
@@ -0,0 +1,29 @@
+"""add consumption latest updated
+
+When each current list entry was last written, so incremental suggestion runs can find the users whose lists changed.
+created can't be used for that: it is the date the user gives, which for imported lists is often years ago. The
+default is stable (now()), so existing rows get the time of the migration without the table being rewritten.
+
+Revision ID: 9ccb0d313154
+Revises: 4e1a7c9b3f65
+Create Date: 2026-10-18 09:12:44.305187
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9ccb0d313154'
+down_revision = '4e1a7c9b3f65'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('consumption_latest',
+                  sa.Column('updated', sa.DateTime, server_default=sa.func.now(), nullable=False))
+
+
+def downgrade():
+    op.drop_column('consumption_latest', 'updated')
@@ -0,0 +1,34 @@
+"""create consumption latest table
+
+Revision ID: a4d8c2e6f019
+Revises: 7e3b1f6a8c52
+Create Date: 2026-10-17 13:27:51.662390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d8c2e6f019'
+down_revision = '7e3b1f6a8c52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'consumption_latest',
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('media_type', sa.String(50), primary_key=True),
+        sa.Column('media_id', sa.Integer, primary_key=True),
+        sa.Column('consumption_id', sa.Integer, sa.ForeignKey('consumption.id'), nullable=False),
+        sa.Column('source_id', sa.String(50)),
+        sa.Column('status', sa.String(50)),
+        sa.Column('created', sa.DateTime)
+    )
+    op.create_index('ix_consumption_latest_media_type_media_id', 'consumption_latest', ['media_type', 'media_id'])
+
+
+def downgrade():
+    op.drop_table('consumption_latest')
@@ -0,0 +1,44 @@
+"""add access path indexes
+
+Composite indexes matching the filters and joins in db/helpers.py. They are built with CREATE INDEX CONCURRENTLY
+so the migration doesn't lock writes on production tables; that can't run inside a transaction, hence the
+autocommit block.
+
+Revision ID: b7f2d9e4a1c3
+Revises: a4d8c2e6f019
+Create Date: 2026-10-17 14:05:33.107246
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7f2d9e4a1c3'
+down_revision = 'a4d8c2e6f019'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    # popularity counts per media item in local search
+    ('ix_consumption_media_type_media_id_user_id', 'consumption', ['media_type', 'media_id', 'user_id']),
+    # recommendations to / by a user, newest first
+    ('ix_recommendation_recommended_user_id_media_type_created', 'recommendation',
+     ['recommended_user_id', 'media_type', 'created']),
+    ('ix_recommendation_recommender_user_id_media_type_created', 'recommendation',
+     ['recommender_user_id', 'media_type', 'created']),
+    # latest friend link per pair, looked up from either side
+    ('ix_friend_requester_id_requested_id_created', 'friend', ['requester_id', 'requested_id', 'created']),
+    ('ix_friend_requested_id_requester_id_created', 'friend', ['requested_id', 'requester_id', 'created']),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
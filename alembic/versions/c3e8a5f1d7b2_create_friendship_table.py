@@ -0,0 +1,33 @@
+"""create friendship table
+
+Revision ID: c3e8a5f1d7b2
+Revises: b7f2d9e4a1c3
+Create Date: 2026-10-17 19:41:08.215734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e8a5f1d7b2'
+down_revision = 'b7f2d9e4a1c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'friendship',
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('friend_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('requester_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('friend_link_id', sa.Integer, sa.ForeignKey('friend.id'), nullable=False),
+        sa.Column('status', sa.String(50)),
+        sa.Column('created', sa.DateTime)
+    )
+    op.create_index('ix_friendship_user_id_status', 'friendship', ['user_id', 'status'])
+
+
+def downgrade():
+    op.drop_table('friendship')
@@ -0,0 +1,29 @@
+"""add consumption feed index
+
+A user's events across all media types in (created, id) order, which the friend event feed reads newest first a page
+at a time. Built concurrently, like the other access path indexes.
+
+Revision ID: d1f4b8c2e9a7
+Revises: c3e8a5f1d7b2
+Create Date: 2026-10-17 20:02:47.581903
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1f4b8c2e9a7'
+down_revision = 'c3e8a5f1d7b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_consumption_user_id_created_id', 'consumption', ['user_id', 'created', 'id'],
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_consumption_user_id_created_id', table_name='consumption', postgresql_concurrently=True)
@@ -0,0 +1,32 @@
+"""create timeline table
+
+Revision ID: e5a9c3d7f2b6
+Revises: d1f4b8c2e9a7
+Create Date: 2026-10-17 20:31:12.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a9c3d7f2b6'
+down_revision = 'd1f4b8c2e9a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'timeline',
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('consumption_id', sa.Integer, sa.ForeignKey('consumption.id'), primary_key=True),
+        sa.Column('author_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('created', sa.DateTime, nullable=False)
+    )
+    op.create_index('ix_timeline_user_id_created_consumption_id', 'timeline', ['user_id', 'created', 'consumption_id'])
+    op.create_index('ix_timeline_user_id_author_id', 'timeline', ['user_id', 'author_id'])
+
+
+def downgrade():
+    op.drop_table('timeline')
@@ -0,0 +1,32 @@
+"""create taste similarity table
+
+Revision ID: f8b2d6a4c1e9
+Revises: e5a9c3d7f2b6
+Create Date: 2026-10-17 21:16:40.318265
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8b2d6a4c1e9'
+down_revision = 'e5a9c3d7f2b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'taste_similarity',
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('other_user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('overlap', sa.Integer, nullable=False),
+        sa.Column('jaccard', sa.Float, nullable=False),
+        sa.Column('cosine', sa.Float, nullable=False),
+        sa.Column('computed', sa.DateTime, nullable=False)
+    )
+
+
+def downgrade():
+    op.drop_table('taste_similarity')
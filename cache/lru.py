@@ -0,0 +1,129 @@
+from collections import OrderedDict
+import threading
+import time
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+EVICTION_POLICIES = ("lru", "fifo")
+
+
+class TTLCache:
+    """
+    Thread-safe, size-bounded cache whose entries each carry their own expiry time. When the cache is full the
+    least recently used entry is evicted ("lru"), or the oldest inserted entry ("fifo").
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None, policy: str = "lru"):
+        """
+        :param max_size: maximum number of entries; 0 disables the cache
+        :param ttl: default time to live in seconds for entries set without an explicit expiry, None to never expire
+        :param policy: "lru" or "fifo"
+        """
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Eviction policy must be one of {EVICTION_POLICIES}, not '{policy}'")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.policy = policy
+
+        # key -> (value, expires_at, stored_at); expires_at and stored_at are wall clock timestamps
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else default
+
+    def get_entry(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        """
+        Like get, but also returns when the entry was stored.
+        :param key:
+        :return: (value, stored_at) or None if the key is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at, stored_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            if self.policy == "lru":
+                self._entries.move_to_end(key)
+            self.hits += 1
+            return value, stored_at
+
+    def set(self, key: Hashable, value: Any, expires_at: Optional[float] = None):
+        """
+        Add or replace an entry.
+        :param key:
+        :param value:
+        :param expires_at: unix timestamp after which the entry is dropped; defaults to now + ttl
+        """
+        if self.max_size <= 0:
+            return
+
+        now = time.time()
+        if expires_at is None and self.ttl is not None:
+            expires_at = now + self.ttl
+
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+            self._entries[key] = (value, expires_at, now)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def discard_where(self, predicate: Callable[[Any], bool]) -> int:
+        """
+        Remove every entry whose value matches the predicate.
+        :param predicate: called with each cached value
+        :return: number of entries removed
+        """
+        with self._lock:
+            keys = [key for key, (value, _, _) in self._entries.items() if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def oldest_age(self) -> Optional[float]:
+        """
+        :return: seconds since the oldest entry still in the cache was stored
+        """
+        with self._lock:
+            if not self._entries:
+                return None
+            return time.time() - min(stored_at for _, _, stored_at in self._entries.values())
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self._entries),
+                "max_size": self.max_size,
+                "policy": self.policy,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations}
@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+from functools import wraps
+import logging
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+from cache.lru import TTLCache
+from cache.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Background revalidation of stale entries; kept small since it only ever replaces data we can already serve
+_revalidation_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="search-cache-revalidate")
+
+
+def normalize_query(query: str) -> str:
+    """
+    Case-fold and collapse whitespace so "The  Office" and "the office" share a cache entry.
+    :param query:
+    :return:
+    """
+    return ' '.join(query.casefold().split())
+
+
+class SearchCache:
+    """
+    Size-bounded LRU cache of search results with stale-while-revalidate. Entries younger than ttl are served as
+    is; entries up to ttl + stale_ttl old are served immediately while a background thread refreshes them; older
+    entries are dropped and loaded inline. Concurrent loads of the same key, inline or in the background, share one
+    upstream call.
+    """
+
+    def __init__(self, max_size: int, ttl: float, stale_ttl: float):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = TTLCache(max_size=max_size, ttl=ttl + stale_ttl)
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        self.single_flight = SingleFlight()
+
+        self.fresh_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.revalidation_failures = 0
+        self._served_age_total = 0.0
+        self._served_age_max = 0.0
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        entry = self._entries.get_entry(key)
+        if entry is None:
+            self.misses += 1
+            return self.single_flight.do(key, lambda: self._load(key, loader))
+
+        value, stored_at = entry
+        age = time.time() - stored_at
+        self._served_age_total += age
+        self._served_age_max = max(self._served_age_max, age)
+        if age <= self.ttl:
+            self.fresh_hits += 1
+        else:
+            self.stale_hits += 1
+            self._revalidate_in_background(key, loader)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        hits = self.fresh_hits + self.stale_hits
+        lookups = hits + self.misses
+        oldest_age = self._entries.oldest_age()
+        return {"size": len(self._entries),
+                "max_size": self._entries.max_size,
+                "fresh_hits": self.fresh_hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / lookups, 4) if lookups else None,
+                "evictions": self._entries.evictions,
+                "revalidations": self.revalidations,
+                "revalidation_failures": self.revalidation_failures,
+                "mean_served_age_seconds": round(self._served_age_total / hits, 1) if hits else None,
+                "max_served_age_seconds": round(self._served_age_max, 1),
+                "oldest_entry_age_seconds": round(oldest_age, 1) if oldest_age is not None else None,
+                "upstream_calls": self.single_flight.executed,
+                "coalesced_calls": self.single_flight.coalesced}
+
+    def _load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        value = loader()
+        self._entries.set(key, value)
+        return value
+
+    def _revalidate_in_background(self, key: Hashable, loader: Callable[[], Any]):
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def revalidate():
+            try:
+                self.single_flight.do(key, lambda: self._load(key, loader))
+                self.revalidations += 1
+            except Exception:
+                self.revalidation_failures += 1
+                logger.exception(f"Unable to refresh cached search {key}")
+            finally:
+                with self._lock:
+                    self._revalidating.discard(key)
+
+        _revalidation_executor.submit(revalidate)
+
+
+def cached_search(cache: SearchCache):
+    """
+    Decorator for wrapper methods whose first argument is a search string. Results are cached under the method
+    name, the normalized search string and any remaining positional arguments. Each call gets its own deep copy of
+    the cached results: the Book, Movie and TV instances are mutable and end up in sessions and in the federated
+    dedup, so sharing them would let one request change what every other request is served.
+    :param cache:
+    :return:
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, query, *args):
+            if query is None:
+                return method(self, query, *args)
+            key = (method.__name__, normalize_query(query)) + args
+            return copy.deepcopy(cache.get_or_load(key, lambda: method(self, query, *args)))
+        return wrapper
+    return decorator
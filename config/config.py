@@ -25,3 +25,131 @@ DEV_AUTH_CONFIG = {
     "clientId": "68MpVR1fV03q6to9Al7JbNAYLTi2lRGT"
 }
 
+# Auth0 signing keys are cached in-process; refresh them in the background after this many seconds
+JWKS_TTL_SECONDS=int(os.getenv("JWKS_TTL_SECONDS", 3600))
+# Minimum gap between refreshes triggered by a token signed with an unknown key id
+JWKS_MIN_REFRESH_INTERVAL_SECONDS=int(os.getenv("JWKS_MIN_REFRESH_INTERVAL_SECONDS", 30))
+JWKS_FETCH_TIMEOUT_SECONDS=int(os.getenv("JWKS_FETCH_TIMEOUT_SECONDS", 5))
+
+# Already-verified bearer tokens are cached until they expire so repeat calls skip signature verification.
+# Set TOKEN_CACHE_MAX_SIZE to 0 to verify every request.
+TOKEN_CACHE_MAX_SIZE=int(os.getenv("TOKEN_CACHE_MAX_SIZE", 10000))
+# "lru" or "fifo"
+TOKEN_CACHE_POLICY=os.getenv("TOKEN_CACHE_POLICY", "lru")
+
+# Outbound HTTP clients (TMDB, Google Books, Open Library) are shared by every request in a worker.
+# pool_maxsize should be at least the number of threads serving requests so none of them waits on a connection.
+HTTP_POOL_CONNECTIONS=int(os.getenv("HTTP_POOL_CONNECTIONS", 4))
+HTTP_POOL_MAXSIZE=int(os.getenv("HTTP_POOL_MAXSIZE", 16))
+HTTP_CONNECT_TIMEOUT_SECONDS=float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", 3.05))
+HTTP_READ_TIMEOUT_SECONDS=float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", 10))
+
+# External media search results are cached per normalized query. Results older than SEARCH_CACHE_TTL_SECONDS are
+# still served for up to SEARCH_CACHE_STALE_SECONDS more while they refresh in the background.
+SEARCH_CACHE_MAX_SIZE=int(os.getenv("SEARCH_CACHE_MAX_SIZE", 2048))
+SEARCH_CACHE_TTL_SECONDS=int(os.getenv("SEARCH_CACHE_TTL_SECONDS", 600))
+SEARCH_CACHE_STALE_SECONDS=int(os.getenv("SEARCH_CACHE_STALE_SECONDS", 3600))
+
+# TV search fetches each show's details (for its networks) concurrently, at most this many at a time per worker.
+# Keep it at or below HTTP_POOL_MAXSIZE.
+TMDB_DETAIL_CONCURRENCY=int(os.getenv("TMDB_DETAIL_CONCURRENCY", 8))
+# A show's networks almost never change, so they are cached for a long time
+TV_NETWORKS_CACHE_MAX_SIZE=int(os.getenv("TV_NETWORKS_CACHE_MAX_SIZE", 20000))
+TV_NETWORKS_CACHE_TTL_SECONDS=int(os.getenv("TV_NETWORKS_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60))
+
+# Show details fetched from TMDB are also stored in the media_metadata table and reused for this long
+METADATA_CACHE_MAX_AGE_SECONDS=int(os.getenv("METADATA_CACHE_MAX_AGE_SECONDS", 30 * 24 * 60 * 60))
+
+# "google" searches Google Books only; "federated" queries Google Books and Open Library in parallel and returns
+# whatever arrived within BOOK_SEARCH_DEADLINE_SECONDS. Can be overridden per request with ?mode=
+BOOK_SEARCH_MODE=os.getenv("BOOK_SEARCH_MODE", "google")
+BOOK_SEARCH_DEADLINE_SECONDS=float(os.getenv("BOOK_SEARCH_DEADLINE_SECONDS", 2))
+
+# Media search answers from our own catalog first and only calls the external API when fewer than
+# LOCAL_SEARCH_MIN_RESULTS titles match locally
+LOCAL_SEARCH_ENABLED=os.getenv("LOCAL_SEARCH_ENABLED", "true").lower() == "true"
+LOCAL_SEARCH_MIN_RESULTS=int(os.getenv("LOCAL_SEARCH_MIN_RESULTS", 5))
+LOCAL_SEARCH_LIMIT=int(os.getenv("LOCAL_SEARCH_LIMIT", 20))
+# How much a title's popularity (number of users who added it) counts against its text similarity when ranking
+LOCAL_SEARCH_POPULARITY_WEIGHT=float(os.getenv("LOCAL_SEARCH_POPULARITY_WEIGHT", 0.1))
+
+# Outbound requests per provider are throttled per worker with a token bucket (requests/sec and burst size).
+# A request that can't get a token within RATE_LIMIT_MAX_WAIT_SECONDS fails with a 503 instead of being sent.
+TMDB_RATE_LIMIT_PER_SECOND=float(os.getenv("TMDB_RATE_LIMIT_PER_SECOND", 20))
+TMDB_RATE_LIMIT_BURST=int(os.getenv("TMDB_RATE_LIMIT_BURST", 40))
+GOOGLE_BOOKS_RATE_LIMIT_PER_SECOND=float(os.getenv("GOOGLE_BOOKS_RATE_LIMIT_PER_SECOND", 10))
+GOOGLE_BOOKS_RATE_LIMIT_BURST=int(os.getenv("GOOGLE_BOOKS_RATE_LIMIT_BURST", 20))
+OPEN_LIBRARY_RATE_LIMIT_PER_SECOND=float(os.getenv("OPEN_LIBRARY_RATE_LIMIT_PER_SECOND", 5))
+OPEN_LIBRARY_RATE_LIMIT_BURST=int(os.getenv("OPEN_LIBRARY_RATE_LIMIT_BURST", 10))
+RATE_LIMIT_MAX_WAIT_SECONDS=float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", 2))
+
+# The friend event feed is served a page at a time; clients can ask for up to FEED_MAX_PAGE_SIZE events with ?limit=
+FEED_PAGE_SIZE=int(os.getenv("FEED_PAGE_SIZE", 50))
+FEED_MAX_PAGE_SIZE=int(os.getenv("FEED_MAX_PAGE_SIZE", 200))
+
+# Fan-out on write: when enabled, each new event is copied into the timelines of the author and their friends in the
+# background, and the feed reads the user's own timeline instead of querying every friend's history. Timelines keep
+# the newest FEED_TIMELINE_MAX_LENGTH events. Run scripts/backfill_timelines.py before turning this on.
+FEED_FANOUT_ENABLED=os.getenv("FEED_FANOUT_ENABLED", "false").lower() == "true"
+FEED_TIMELINE_MAX_LENGTH=int(os.getenv("FEED_TIMELINE_MAX_LENGTH", 1000))
+FEED_FANOUT_WORKERS=int(os.getenv("FEED_FANOUT_WORKERS", 2))
+
+# Taste similarity scores are recomputed in the background for a user whenever their list or friendships change
+TASTE_SIMILARITY_INCREMENTAL=os.getenv("TASTE_SIMILARITY_INCREMENTAL", "true").lower() == "true"
+# Pairs of users who aren't friends get a score from the bulk job only with at least this many items in common
+TASTE_SIMILARITY_MIN_OVERLAP=int(os.getenv("TASTE_SIMILARITY_MIN_OVERLAP", 5))
+
+# "Suggested for you": jobs/suggestions.py keeps the SUGGESTIONS_TOP_N best items per user and media type, scored
+# against each item's SUGGESTIONS_NEIGHBORS most similar items. The item similarities from the last full run are
+# saved under SUGGESTIONS_MODEL_DIR so incremental runs only rescore users whose lists changed.
+SUGGESTIONS_TOP_N=int(os.getenv("SUGGESTIONS_TOP_N", 20))
+SUGGESTIONS_NEIGHBORS=int(os.getenv("SUGGESTIONS_NEIGHBORS", 50))
+SUGGESTIONS_MODEL_DIR=os.getenv("SUGGESTIONS_MODEL_DIR", "/var/tmp/goodtimes-suggestions")
+# Incremental runs also rescore users whose list entries were written up to this long before the previous run read
+# the lists; must be longer than the time between writing an entry and committing it
+SUGGESTIONS_CHANGE_OVERLAP_SECONDS=int(os.getenv("SUGGESTIONS_CHANGE_OVERLAP_SECONDS", 300))
+
+# User search returns a page of at most USER_SEARCH_MAX_PAGE_SIZE users (USER_SEARCH_PAGE_SIZE by default)
+USER_SEARCH_PAGE_SIZE=int(os.getenv("USER_SEARCH_PAGE_SIZE", 20))
+USER_SEARCH_MAX_PAGE_SIZE=int(os.getenv("USER_SEARCH_MAX_PAGE_SIZE", 100))
+
+# One connection pool per worker process, shared by request handlers and background jobs
+DB_POOL_SIZE=int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW=int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT_SECONDS=float(os.getenv("DB_POOL_TIMEOUT_SECONDS", 10))
+# Connections are replaced after this long, and tested before each use when DB_POOL_PRE_PING is set
+DB_POOL_RECYCLE_SECONDS=int(os.getenv("DB_POOL_RECYCLE_SECONDS", 30 * 60))
+DB_POOL_PRE_PING=os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Server-side limit on any one statement; batch jobs turn it off for their own connections
+DB_STATEMENT_TIMEOUT_MS=int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 30000))
+# Log every SQL statement
+DB_ECHO=os.getenv("DB_ECHO", "false").lower() == "true"
+
+# Per-request SQL statement counts and timings, in a Server-Timing header and at /api/metrics/queries. Off by default
+SQL_INSTRUMENTATION_ENABLED=os.getenv("SQL_INSTRUMENTATION_ENABLED", "false").lower() == "true"
+# Log requests that run the same statement at least this many times
+SQL_N_PLUS_ONE_THRESHOLD=int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", 5))
+# Capture EXPLAIN (ANALYZE, BUFFERS) of SELECTs slower than this (which runs them again); 0 to never
+SQL_EXPLAIN_SLOW_MS=float(os.getenv("SQL_EXPLAIN_SLOW_MS", 0))
+# Number of request summaries kept for /api/metrics/queries
+SQL_RECENT_REQUESTS=int(os.getenv("SQL_RECENT_REQUESTS", 100))
+
+# Optional comma-separated read replica URLs. GET requests read from them round-robin, except for a user who wrote
+# within the last REPLICA_STICKY_SECONDS, whose reads stay on the primary
+DATABASE_REPLICA_URLS=[url.strip().replace("postgres://", "postgresql://", 1)
+                       for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_STICKY_SECONDS=float(os.getenv("REPLICA_STICKY_SECONDS", 5))
+# Replicas further behind the primary than this are taken out of rotation until they catch up
+REPLICA_MAX_LAG_SECONDS=float(os.getenv("REPLICA_MAX_LAG_SECONDS", 10))
+REPLICA_LAG_CHECK_INTERVAL_SECONDS=float(os.getenv("REPLICA_LAG_CHECK_INTERVAL_SECONDS", 2))
+
+# List imports (Goodreads, Letterboxd, IMDb exports) are written this many rows at a time
+IMPORT_BATCH_SIZE=int(os.getenv("IMPORT_BATCH_SIZE", 500))
+# Imported rows missing from our catalog are looked up with the external providers, this many at a time
+IMPORT_PROVIDER_LOOKUP_ENABLED=os.getenv("IMPORT_PROVIDER_LOOKUP_ENABLED", "true").lower() == "true"
+IMPORT_LOOKUP_CONCURRENCY=int(os.getenv("IMPORT_LOOKUP_CONCURRENCY", 4))
+
+# History exports are read from a server-side cursor and written out this many rows at a time
+EXPORT_BATCH_SIZE=int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+# zlib level (1-9) for exports sent gzipped to clients that accept it
+EXPORT_GZIP_LEVEL=int(os.getenv("EXPORT_GZIP_LEVEL", 6))
@@ -1,15 +1,21 @@
-from typing import List, Tuple
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-from sqlalchemy import and_, or_, desc, func
-from sqlalchemy.orm import session
+from sqlalchemy import and_, or_, delete, desc, func, cast, literal, select, true, tuple_, union_all, Integer, Text
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.orm import aliased, session
 
 from models.books import Book
+from models.media_metadata import MediaMetadata
 from models.movies import Movie
 from models.recommendation import Recommendation
+from models.similarity import TasteSimilarity
+from models.suggestion import Suggestion
+from models.timeline import TimelineEntry
 from models.tv import TV
-from models.consumption import Consumption
+from models.consumption import Consumption, ConsumptionLatest
 from models.user import User
-from models.friend import Friend, FriendStatus
+from models.friend import Friend, FriendStatus, Friendship
 
 MEDIAS = {
     "book": Book,
@@ -24,28 +30,70 @@ def get_consumption_records(user_id: int, media_type: str, session: session) ->
     :param user_id:
     :param media_type:
     :param session:
-    :return: Returns a tuple of the Consumption object and Media object
+    :return: Returns a tuple of the ConsumptionLatest object and Media object
     """
     media_class = MEDIAS.get(media_type)
-    # Get most recent record for each item in consumption table
-    subq = session.query(Consumption.user_id, Consumption.media_id, Consumption.media_type,
-                         func.max(Consumption.created).label("max_created")) \
-        .group_by(Consumption.user_id, Consumption.media_id, Consumption.media_type) \
-        .subquery()
 
-    # Get most recent consumption data for selected media for user
-    results = session.query(Consumption, media_class) \
-        .filter_by(user_id=user_id, media_type=media_type) \
-        .join(subq, and_(Consumption.media_id == subq.c.media_id,
-                         Consumption.media_type == subq.c.media_type,
-                         Consumption.created == subq.c.max_created)) \
-        .join(media_class, media_class.id == Consumption.media_id) \
-        .order_by(desc(Consumption.created)) \
+    results = session.query(ConsumptionLatest, media_class) \
+        .filter(ConsumptionLatest.user_id == user_id, ConsumptionLatest.media_type == media_type) \
+        .join(media_class, media_class.id == ConsumptionLatest.media_id) \
+        .order_by(desc(ConsumptionLatest.created)) \
         .all()
 
     return results
 
 
+def record_latest_consumption(consumption: Consumption, session: session):
+    """
+    Make a new consumption record the user's current state for that media item, unless a newer record is already
+    there. The consumption record must have been flushed so it has an id. Caller commits.
+    :param consumption:
+    :param session:
+    :return:
+    """
+    record_latest_consumptions([consumption], session)
+
+
+def record_latest_consumptions(consumptions: List[Consumption], session: session):
+    """
+    Batch version of record_latest_consumption.
+    :param consumptions: flushed consumption records, or rows with the same attributes
+    :param session:
+    :return:
+    """
+    if not consumptions:
+        return
+
+    # Only the newest record for each item can win, and Postgres won't upsert the same row twice in one statement
+    latest = {}
+    for consumption in consumptions:
+        key = (consumption.user_id, consumption.media_type, consumption.media_id)
+        if key not in latest or latest[key].created <= consumption.created:
+            latest[key] = consumption
+
+    table = ConsumptionLatest.__table__
+    # The time of the write itself rather than now(), the start of a transaction that may have run a while already,
+    # so incremental suggestion runs only need a short overlap to see it
+    stmt = insert(table).values(updated=func.clock_timestamp())
+    stmt = stmt.on_conflict_do_update(index_elements=[table.c.user_id, table.c.media_type, table.c.media_id],
+                                      set_={'consumption_id': stmt.excluded.consumption_id,
+                                            'source_id': stmt.excluded.source_id,
+                                            'status': stmt.excluded.status,
+                                            'created': stmt.excluded.created,
+                                            'updated': stmt.excluded.updated},
+                                      # as in the backfill, so a row without a created date isn't frozen
+                                      where=or_(table.c.created.is_(None), table.c.created <= stmt.excluded.created))
+    # executemany, which psycopg2 runs as multi-row VALUES pages; unlike one .values() per batch, the statement is
+    # compiled once and cached whatever the number of records
+    session.execute(stmt, [{'user_id': consumption.user_id,
+                            'media_type': consumption.media_type,
+                            'media_id': consumption.media_id,
+                            'consumption_id': consumption.id,
+                            'source_id': consumption.source_id,
+                            'status': consumption.status,
+                            'created': consumption.created} for consumption in latest.values()])
+
+
 def get_records_recommended_to_user(user_id: int, media_type: str, session: session) -> List[Tuple]:
     """
     Get recommendations to a user for a specific media type.
@@ -55,35 +103,22 @@ def get_records_recommended_to_user(user_id: int, media_type: str, session: sess
     :return: Returns a tuple of the Recommendation object, Media object and User object
     """
     media_class = MEDIAS.get(media_type)
-    # Get most recent record for each item in recommendation table
-    rec_subq = session.query(Recommendation.recommended_user_id, Recommendation.recommender_user_id,
-                             Recommendation.media_id, Recommendation.media_type,
-                         func.max(Recommendation.created).label("max_created")) \
-        .group_by(Recommendation.recommended_user_id, Recommendation.recommender_user_id,
-                  Recommendation.media_id, Recommendation.media_type) \
-        .subquery()
-
-    cons_subq = session.query(Consumption.user_id, Consumption.media_id, Consumption.media_type,
-                         func.max(Consumption.created).label("max_created")) \
-        .group_by(Consumption.user_id, Consumption.media_id, Consumption.media_type) \
+    # Most recent recommendation of each item by each recommender, among this user's recommendations only
+    latest = session.query(Recommendation.id) \
+        .filter_by(recommended_user_id=user_id, media_type=media_type) \
+        .distinct(Recommendation.recommender_user_id, Recommendation.media_id) \
+        .order_by(Recommendation.recommender_user_id, Recommendation.media_id,
+                  desc(Recommendation.created), desc(Recommendation.id)) \
         .subquery()
 
-    cons_combined_subq = session.query(Consumption).join(cons_subq, and_(Consumption.user_id == cons_subq.c.user_id,
-                                                                         Consumption.media_id == cons_subq.c.media_id,
-                                                                         Consumption.media_type == cons_subq.c.media_type,
-                                                                         Consumption.created == cons_subq.c.max_created)).subquery()
-
-    # Get most recent recommendation data for selected media for user
-    results = session.query(Recommendation, media_class, User, cons_combined_subq.c.status) \
-        .filter_by(recommended_user_id=user_id, media_type=media_type) \
-        .join(rec_subq, and_(Recommendation.media_id == rec_subq.c.media_id,
-                             Recommendation.media_type == rec_subq.c.media_type,
-                             Recommendation.created == rec_subq.c.max_created)) \
+    results = session.query(Recommendation, media_class, User, ConsumptionLatest.status) \
+        .join(latest, Recommendation.id == latest.c.id) \
         .join(media_class, media_class.id == Recommendation.media_id) \
         .join(User, User.id == Recommendation.recommender_user_id) \
-        .join(cons_combined_subq, and_(Recommendation.media_id == cons_combined_subq.c.media_id,
-                                Recommendation.media_type == cons_combined_subq.c.media_type,
-                                Recommendation.recommended_user_id == cons_combined_subq.c.user_id), isouter=True) \
+        .join(ConsumptionLatest, and_(Recommendation.media_id == ConsumptionLatest.media_id,
+                                      Recommendation.media_type == ConsumptionLatest.media_type,
+                                      Recommendation.recommended_user_id == ConsumptionLatest.user_id),
+              isouter=True) \
         .order_by(desc(Recommendation.created)) \
         .all()
 
@@ -99,20 +134,16 @@ def get_records_recommended_by_user(user_id: int, media_type: str, session: sess
     :return: Returns a tuple of the Recommendation object, Media object and User object
     """
     media_class = MEDIAS.get(media_type)
-    # Get most recent record for each item in recommendation table
-    rec_subq = session.query(Recommendation.recommended_user_id, Recommendation.recommender_user_id,
-                             Recommendation.media_id, Recommendation.media_type,
-                         func.max(Recommendation.created).label("max_created")) \
-        .group_by(Recommendation.recommended_user_id, Recommendation.recommender_user_id,
-                  Recommendation.media_id, Recommendation.media_type) \
+    # Most recent recommendation of each item to each recipient, among this user's recommendations only
+    latest = session.query(Recommendation.id) \
+        .filter_by(recommender_user_id=user_id, media_type=media_type) \
+        .distinct(Recommendation.recommended_user_id, Recommendation.media_id) \
+        .order_by(Recommendation.recommended_user_id, Recommendation.media_id,
+                  desc(Recommendation.created), desc(Recommendation.id)) \
         .subquery()
 
-    # Get most recent recommendation data for selected media for user
     results = session.query(Recommendation, media_class, User) \
-        .filter_by(recommender_user_id=user_id, media_type=media_type) \
-        .join(rec_subq, and_(Recommendation.media_id == rec_subq.c.media_id,
-                             Recommendation.media_type == rec_subq.c.media_type,
-                             Recommendation.created == rec_subq.c.max_created)) \
+        .join(latest, Recommendation.id == latest.c.id) \
         .join(media_class, media_class.id == Recommendation.media_id) \
         .join(User, User.id == Recommendation.recommended_user_id) \
         .order_by(desc(Recommendation.created)) \
@@ -121,32 +152,84 @@ def get_records_recommended_by_user(user_id: int, media_type: str, session: sess
     return results
 
 
-def get_users_and_friend_statuses(user_id: int, email_substring: str, session: session) -> List[Tuple]:
+def record_friend_link(friend: Friend, session: session):
     """
-    Get all users that have an email containing the email substring along with the friendship status,
-    if there is one.
-    :param user_id:
-    :param email_substring:
+    Make a new friend link the current state of the friendship, in both directions, unless a newer link is already
+    there. The friend link must have been flushed so it has an id. Caller commits.
+    :param friend:
     :param session:
     :return:
     """
-    max_friend_link_subq = session.query(Friend.requester_id, Friend.requested_id, func.max(Friend.created).label("max_created")) \
-        .group_by(Friend.requester_id, Friend.requested_id) \
-        .subquery()
+    if friend.requester_id == friend.requested_id:
+        return
+
+    table = Friendship.__table__
+    stmt = insert(table).values([{'user_id': user_id,
+                                  'friend_id': friend_id,
+                                  'requester_id': friend.requester_id,
+                                  'friend_link_id': friend.id,
+                                  'status': friend.status,
+                                  'created': friend.created}
+                                 for user_id, friend_id in [(friend.requester_id, friend.requested_id),
+                                                            (friend.requested_id, friend.requester_id)]])
+    stmt = stmt.on_conflict_do_update(index_elements=[table.c.user_id, table.c.friend_id],
+                                      set_={'requester_id': stmt.excluded.requester_id,
+                                            'friend_link_id': stmt.excluded.friend_link_id,
+                                            'status': stmt.excluded.status,
+                                            'created': stmt.excluded.created},
+                                      where=table.c.created <= stmt.excluded.created)
+    session.execute(stmt)
+
+
+def search_users(user_id: int, query: str, limit: int, after_id: Optional[int], session: session) -> List[User]:
+    """
+    Get a page of users whose email or full name matches the query, ordered by id. Queries of three or more
+    characters match anywhere in the email or name, using the trigram indexes; shorter ones only match the start,
+    using the lower() prefix indexes, since a one or two letter substring matches nearly everyone anyway.
+    :param user_id: searching user, left out of the results
+    :param query:
+    :param limit: page size
+    :param after_id: id of the last user on the previous page; None for the first page
+    :param session:
+    :return: users, by ascending id
+    """
+    query = query.strip()
+    if not query:
+        return []
 
-    friend_subq = session.query(Friend).filter(or_(Friend.requester_id == user_id, Friend.requested_id == user_id)) \
-        .join(max_friend_link_subq, and_(Friend.requester_id == max_friend_link_subq.c.requester_id,
-                                         Friend.requested_id == max_friend_link_subq.c.requested_id,
-                                         Friend.created == max_friend_link_subq.c.max_created)) \
-        .subquery()
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    if len(query) >= 3:
+        match = or_(User.email.ilike(f'%{escaped}%', escape='\\'),
+                    User.full_name.ilike(f'%{escaped}%', escape='\\'))
+    else:
+        # Must match the ix_user_email_prefix and ix_user_full_name_prefix index expressions
+        prefix = f'{escaped.lower()}%'
+        match = or_(func.lower(User.email).like(prefix, escape='\\'),
+                    func.lower(User.full_name).like(prefix, escape='\\'))
+
+    results = session.query(User).filter(match).filter(User.id != user_id)
+    if after_id is not None:
+        results = results.filter(User.id > after_id)
+
+    return results.order_by(User.id).limit(limit).all()
+
+
+def get_friend_statuses(user_id: int, other_user_ids: List[int], session: session) -> Dict[int, str]:
+    """
+    Get the user's friendship status with each of the other users, if there is one.
+    :param user_id:
+    :param other_user_ids:
+    :param session:
+    :return: status by other user id, for those with a friendship
+    """
+    if not other_user_ids:
+        return {}
 
-    results = session.query(User, friend_subq.c.status).filter(User.email.contains(email_substring))\
-        .filter(User.id != user_id) \
-        .join(friend_subq, or_(User.id == friend_subq.c.requester_id,
-                               User.id == friend_subq.c.requested_id), isouter=True)\
+    results = session.query(Friendship.friend_id, Friendship.status) \
+        .filter(Friendship.user_id == user_id, Friendship.friend_id.in_(other_user_ids)) \
         .all()
 
-    return results
+    return dict(results)
 
 
 def get_user_friends(user_id: int, session: session) -> List[Tuple]:
@@ -159,9 +242,32 @@ def get_user_friends(user_id: int, session: session) -> List[Tuple]:
 
     friend_subq = create_user_friends_subquery(user_id, session)
 
-    results = session.query(User).filter(User.id != user_id) \
-        .join(friend_subq, or_(User.id == friend_subq.c.requester_id,
-                               User.id == friend_subq.c.requested_id)) \
+    results = session.query(User) \
+        .join(friend_subq, User.id == friend_subq.c.friend_id) \
+        .all()
+
+    return results
+
+
+def get_taste_similarities(user_id: int, friends_only: bool, limit: int, session: session) -> List[Tuple]:
+    """
+    Get the users whose lists are most similar to a user's, from the precomputed taste_similarity scores.
+    :param user_id:
+    :param friends_only: leave out users who aren't friends
+    :param limit:
+    :param session:
+    :return: tuples of TasteSimilarity object and the other User object, most similar first
+    """
+    query = session.query(TasteSimilarity, User) \
+        .join(User, User.id == TasteSimilarity.other_user_id) \
+        .filter(TasteSimilarity.user_id == user_id)
+    if friends_only:
+        query = query.join(Friendship, and_(Friendship.user_id == user_id,
+                                            Friendship.friend_id == TasteSimilarity.other_user_id,
+                                            Friendship.status == FriendStatus.ACCEPTED.value))
+
+    results = query.order_by(desc(TasteSimilarity.cosine), TasteSimilarity.other_user_id) \
+        .limit(limit) \
         .all()
 
     return results
@@ -175,21 +281,36 @@ def get_user_friend_requests(user_id: int, session: session) -> List[Tuple]:
     :return:
     """
 
-    max_friend_link_subq = session.query(Friend.requester_id, Friend.requested_id,
-                                         func.max(Friend.created).label("max_created")) \
-        .group_by(Friend.requester_id, Friend.requested_id) \
-        .subquery()
+    results = session.query(User)\
+        .join(Friendship, and_(Friendship.user_id == user_id,
+                               Friendship.friend_id == User.id))\
+        .filter(Friendship.requester_id == User.id,
+                Friendship.status == FriendStatus.REQUESTED.value)\
+        .all()
 
-    friend_subq = session.query(Friend).filter(and_(Friend.requested_id == user_id,
-                                                    Friend.status == FriendStatus.REQUESTED.value)) \
-        .join(max_friend_link_subq, and_(Friend.requester_id == max_friend_link_subq.c.requester_id,
-                                         Friend.requested_id == max_friend_link_subq.c.requested_id,
-                                         Friend.created == max_friend_link_subq.c.max_created)) \
-        .subquery()
+    return results
+
+
+def get_suggested_records(user_id: int, media_type: str, session: session) -> List[Tuple]:
+    """
+    Get a user's precomputed suggestions for a media type, leaving out items added to their list since the
+    suggestions were computed.
+    :param user_id:
+    :param media_type: book, movie or tv
+    :param session:
+    :return: tuples of Suggestion object and media object, best first
+    """
+    media_class = MEDIAS.get(media_type)
 
-    results = session.query(User).filter(User.id != user_id)\
-        .join(friend_subq, or_(User.id == friend_subq.c.requester_id,
-                               User.id == friend_subq.c.requested_id))\
+    results = session.query(Suggestion, media_class) \
+        .join(media_class, media_class.id == Suggestion.media_id) \
+        .join(ConsumptionLatest, and_(ConsumptionLatest.user_id == Suggestion.user_id,
+                                      ConsumptionLatest.media_type == Suggestion.media_type,
+                                      ConsumptionLatest.media_id == Suggestion.media_id), isouter=True) \
+        .filter(Suggestion.user_id == user_id,
+                Suggestion.media_type == media_type,
+                ConsumptionLatest.user_id.is_(None)) \
+        .order_by(Suggestion.rank) \
         .all()
 
     return results
@@ -202,83 +323,439 @@ def get_overlapping_records(primary_user_id: int, other_user_id: int, media_type
     :param other_user_id: The user the logged in user is veewing.
     :param media_type: book, movie or tv
     :param session:
-    :return: media class object
+    :return: media columns plus primary_user_status and other_user_status
     """
     media_class = MEDIAS.get(media_type)
-    # Get most recent record for each item in consumption table associated with either one of the users.
-    consumption_max_created_subq = session.query(Consumption.user_id, Consumption.media_id, Consumption.media_type,
-                         func.max(Consumption.created).label("max_created")) \
-        .filter(or_(Consumption.user_id == primary_user_id, Consumption.user_id == other_user_id)) \
-        .filter(Consumption.media_type == media_type) \
-        .group_by(Consumption.user_id, Consumption.media_id, Consumption.media_type) \
-        .subquery()
+    primary_user_latest = aliased(ConsumptionLatest)
+    other_user_latest = aliased(ConsumptionLatest)
+
+    results = session.query(*media_class.__table__.c,
+                            primary_user_latest.status.label("primary_user_status"),
+                            other_user_latest.status.label("other_user_status")) \
+        .select_from(primary_user_latest) \
+        .join(other_user_latest, and_(other_user_latest.user_id == other_user_id,
+                                      other_user_latest.media_type == primary_user_latest.media_type,
+                                      other_user_latest.media_id == primary_user_latest.media_id)) \
+        .join(media_class, media_class.id == primary_user_latest.media_id) \
+        .filter(primary_user_latest.user_id == primary_user_id,
+                primary_user_latest.media_type == media_type) \
+        .all()
+
+    return results
+
+
+def get_overlaps_with_friends(user_id: int, media_type: str, session: session) -> List[Tuple]:
+    """
+    Get the items of a media type on both a user's list and each of their friends' lists, for all friends at once.
+    :param user_id:
+    :param media_type: book, movie or tv
+    :param session:
+    :return: tuples of friend id, media id, the user's status and the friend's status, by friend id
+    """
+    user_latest = aliased(ConsumptionLatest)
+    friend_latest = aliased(ConsumptionLatest)
+
+    results = session.query(Friendship.friend_id, user_latest.media_id, user_latest.status, friend_latest.status) \
+        .select_from(user_latest) \
+        .join(Friendship, and_(Friendship.user_id == user_id,
+                               Friendship.status == FriendStatus.ACCEPTED.value)) \
+        .join(friend_latest, and_(friend_latest.user_id == Friendship.friend_id,
+                                  friend_latest.media_type == user_latest.media_type,
+                                  friend_latest.media_id == user_latest.media_id)) \
+        .filter(user_latest.user_id == user_id,
+                user_latest.media_type == media_type) \
+        .order_by(Friendship.friend_id, user_latest.media_id) \
+        .all()
+
+    return results
 
-    # Select latest Consumption records
-    consumption_subq = session.query(Consumption) \
-        .join(consumption_max_created_subq, and_(Consumption.media_id == consumption_max_created_subq.c.media_id,
-                         Consumption.media_type == consumption_max_created_subq.c.media_type,
-                         Consumption.created == consumption_max_created_subq.c.max_created)) \
-        .subquery()
 
-    # Identify all media associated with consumption records above.
-    overlap_media_subq = session.query(media_class) \
-        .join(consumption_subq, and_(media_class.id == consumption_subq.c.media_id))\
-        .group_by(media_class)\
-        .having(func.count(consumption_subq.c.user_id) > 1)\
+def get_friend_event_records(user_id: int, session: session, limit: int,
+                             before: Optional[Tuple[datetime, int]] = None) -> List[Tuple]:
+    """
+    Get a page of events by a user and their friends, newest first, in one query. Each feed user's events are read
+    newest first from ix_consumption_user_id_created_id (at most limit per user, via a lateral join) and merged, so
+    the cost of a page depends on the number of friends and the page size, not on how much history they have.
+    :param user_id:
+    :param session:
+    :param limit: page size
+    :param before: (created, id) of the last event on the previous page; None for the first page
+    :return: tuples of media object (None if the media record is gone), Consumption object, user full name and hours
+             since the event, newest first
+    """
+    friend_subq = create_user_friends_subquery(user_id, session)
+    feed_users = select(friend_subq.c.friend_id.label('user_id')) \
+        .union(select(literal(user_id, Integer).label('user_id'))) \
         .subquery()
 
-    consumption_primary_user_subq = session.query(consumption_subq)\
-        .filter(consumption_subq.c.user_id == primary_user_id).subquery()
+    user_events = select(Consumption.__table__).where(Consumption.user_id == feed_users.c.user_id)
+    if before is not None:
+        user_events = user_events.where(tuple_(Consumption.created, Consumption.id) < tuple_(*before))
+    user_events = user_events.order_by(desc(Consumption.created), desc(Consumption.id)).limit(limit).lateral()
 
-    consumption_other_user_subq = session.query(consumption_subq) \
-        .filter(consumption_subq.c.user_id == other_user_id).subquery()
+    event = aliased(Consumption, user_events)
 
-    results = session.query(overlap_media_subq,
-                            consumption_primary_user_subq.c.status.label("primary_user_status"),
-                            consumption_other_user_subq.c.status.label("other_user_status")) \
-        .join(consumption_primary_user_subq, overlap_media_subq.c.id == consumption_primary_user_subq.c.media_id,
-              isouter=True) \
-        .join(consumption_other_user_subq, overlap_media_subq.c.id == consumption_other_user_subq.c.media_id,
-              isouter=True) \
+    rows = session.query(event, User.full_name, _hours_since(event.created)) \
+        .select_from(feed_users) \
+        .join(user_events, true()) \
+        .join(User, User.id == event.user_id) \
+        .order_by(desc(event.created), desc(event.id)) \
+        .limit(limit) \
         .all()
 
-    return results
+    return _with_event_media(rows, session)
+
+
+def get_timeline_records(user_id: int, session: session, limit: int,
+                         before: Optional[Tuple[datetime, int]] = None) -> List[Tuple]:
+    """
+    Same page of events as get_friend_event_records, read from the user's fan-out timeline instead.
+    :param user_id:
+    :param session:
+    :param limit: page size
+    :param before: (created, id) of the last event on the previous page; None for the first page
+    :return: tuples of media object (None if the media record is gone), Consumption object, user full name and hours
+             since the event, newest first
+    """
+    query = session.query(Consumption, User.full_name, _hours_since(TimelineEntry.created)) \
+        .select_from(TimelineEntry) \
+        .join(Consumption, Consumption.id == TimelineEntry.consumption_id) \
+        .join(User, User.id == TimelineEntry.author_id) \
+        .filter(TimelineEntry.user_id == user_id)
+    if before is not None:
+        query = query.filter(tuple_(TimelineEntry.created, TimelineEntry.consumption_id) < tuple_(*before))
+
+    rows = query.order_by(desc(TimelineEntry.created), desc(TimelineEntry.consumption_id)) \
+        .limit(limit) \
+        .all()
+
+    return _with_event_media(rows, session)
 
 
-def get_friend_event_records(user_id, session):
+def iter_consumption_history(user_id: int, session: session, batch_size: int,
+                             after: Optional[Tuple[datetime, int]] = None) -> Iterator[Tuple]:
+    """
+    Stream a user's whole consumption history, oldest first, through a server-side cursor: rows are fetched
+    batch_size at a time as the caller iterates, in index order (ix_consumption_user_id_created_id), so neither side
+    holds the full history in memory.
+    :param user_id:
+    :param session:
+    :param batch_size: rows per fetch
+    :param after: (created, id) of the last record already exported; None to start from the beginning
+    :return: rows of id, media_type, media_id, source_id, title (None if the media record is gone), status, created
+    """
+    query = session.query(Consumption.id, Consumption.media_type, Consumption.media_id, Consumption.source_id,
+                          _media_title(), Consumption.status, Consumption.created) \
+        .filter(Consumption.user_id == user_id)
+    query = _join_media_titles(query, Consumption.media_type, Consumption.media_id)
+    if after is not None:
+        query = query.filter(tuple_(Consumption.created, Consumption.id) > tuple_(*after))
+
+    return iter(query.order_by(Consumption.created, Consumption.id)
+                .execution_options(stream_results=True)
+                .yield_per(batch_size))
+
+
+def iter_recommendation_history(user_id: int, session: session, batch_size: int,
+                                after: Optional[Tuple[datetime, int]] = None) -> Iterator[Tuple]:
+    """
+    Stream every recommendation a user made or received, oldest first, through a server-side cursor.
+    :param user_id:
+    :param session:
+    :param batch_size: rows per fetch
+    :param after: (created, id) of the last record already exported; None to start from the beginning
+    :return: rows of id, recommender_user_id, recommended_user_id, media_type, media_id, source_id, title, status,
+             created
+    """
+    query = session.query(Recommendation.id, Recommendation.recommender_user_id, Recommendation.recommended_user_id,
+                          Recommendation.media_type, Recommendation.media_id, Recommendation.source_id,
+                          _media_title(), Recommendation.status, Recommendation.created) \
+        .filter(or_(Recommendation.recommender_user_id == user_id, Recommendation.recommended_user_id == user_id))
+    query = _join_media_titles(query, Recommendation.media_type, Recommendation.media_id)
+    if after is not None:
+        query = query.filter(tuple_(Recommendation.created, Recommendation.id) > tuple_(*after))
+
+    return iter(query.order_by(Recommendation.created, Recommendation.id)
+                .execution_options(stream_results=True)
+                .yield_per(batch_size))
+
+
+def _media_title():
+    return func.coalesce(*[media_class.title for media_class in MEDIAS.values()]).label('title')
+
+
+def _join_media_titles(query, media_type, media_id):
+    # At most one of the outer joins matches, the one for the row's media type
+    for name, media_class in MEDIAS.items():
+        query = query.outerjoin(media_class, and_(media_type == name, media_class.id == media_id))
+    return query
+
+
+def _hours_since(created):
+    # created is stored as naive UTC
+    hours = func.round(func.extract('epoch', func.timezone('utc', func.now()) - created) / 3600)
+    return cast(hours, Integer).label('time_since')
+
+
+def _with_event_media(rows: List[Tuple], session: session) -> List[Tuple]:
+    """
+    Load the media for a page of (Consumption, full name, time since) rows with one query per media type.
+    """
+    media_ids = {}
+    for consumption, _, _ in rows:
+        media_ids.setdefault(consumption.media_type, set()).add(consumption.media_id)
 
+    media = {}
+    for media_type, ids in media_ids.items():
+        media_class = MEDIAS.get(media_type)
+        if media_class is None:
+            continue
+        for m in session.query(media_class).filter(media_class.id.in_(ids)).all():
+            media[(media_type, m.id)] = m
+
+    return [(media.get((consumption.media_type, consumption.media_id)), consumption, full_name, time_since)
+            for consumption, full_name, time_since in rows]
+
+
+def fan_out_consumptions(consumption_ids: List[int], session: session) -> Set[int]:
+    """
+    Copy consumption records into the timelines of their authors and the authors' current friends. Already copied
+    records are skipped, so this is safe to retry. Caller commits.
+    :param consumption_ids:
+    :param session:
+    :return: ids of the users whose timelines got new entries
+    """
+    if not consumption_ids:
+        return set()
+
+    consumption = Consumption.__table__
+    friendship = Friendship.__table__
+    timeline = TimelineEntry.__table__
+
+    to_friends = select(friendship.c.user_id, consumption.c.id, consumption.c.user_id, consumption.c.created) \
+        .select_from(consumption.join(friendship, and_(friendship.c.friend_id == consumption.c.user_id,
+                                                       friendship.c.status == FriendStatus.ACCEPTED.value))) \
+        .where(consumption.c.id.in_(consumption_ids), consumption.c.created.isnot(None))
+    to_author = select(consumption.c.user_id, consumption.c.id, consumption.c.user_id, consumption.c.created) \
+        .where(consumption.c.id.in_(consumption_ids), consumption.c.created.isnot(None))
+
+    stmt = insert(timeline) \
+        .from_select(['user_id', 'consumption_id', 'author_id', 'created'], union_all(to_friends, to_author)) \
+        .on_conflict_do_nothing() \
+        .returning(timeline.c.user_id)
+
+    return {user_id for user_id, in session.execute(stmt)}
+
+
+def backfill_timeline(user_id: int, author_id: int, max_length: int, session: session):
+    """
+    Copy an author's most recent consumption records into a user's timeline, e.g. when they become friends.
+    Caller commits.
+    :param user_id: timeline owner
+    :param author_id:
+    :param max_length: number of records to copy
+    :param session:
+    :return:
+    """
+    consumption = Consumption.__table__
+    events = select(literal(user_id, Integer), consumption.c.id, consumption.c.user_id, consumption.c.created) \
+        .where(consumption.c.user_id == author_id, consumption.c.created.isnot(None)) \
+        .order_by(desc(consumption.c.created), desc(consumption.c.id)) \
+        .limit(max_length)
+
+    stmt = insert(TimelineEntry.__table__) \
+        .from_select(['user_id', 'consumption_id', 'author_id', 'created'], events) \
+        .on_conflict_do_nothing()
+    session.execute(stmt)
+
+
+def fill_timeline(user_id: int, max_length: int, session: session):
+    """
+    Add any missing events among the newest max_length by the user and by each of their current friends to the user's
+    timeline, e.g. to refill it after a friend's entries were removed. Caller commits.
+    :param user_id: timeline owner
+    :param max_length: number of records to consider per author
+    :param session:
+    :return:
+    """
     friend_subq = create_user_friends_subquery(user_id, session)
+    authors = select(friend_subq.c.friend_id.label('author_id')) \
+        .union(select(literal(user_id, Integer).label('author_id'))) \
+        .subquery()
 
-    final_results = []
-    for media_type, media_class in MEDIAS.items():
-        media_results = session.query(media_class, Consumption, User) \
-            .join(Consumption, media_class.id == Consumption.media_id) \
-            .join(User, Consumption.user_id == User.id) \
-            .join(friend_subq, or_(User.id == friend_subq.c.requester_id,
-                                   User.id == friend_subq.c.requested_id), isouter=True) \
-            .filter(and_(Consumption.media_type == media_type,
-                    or_(friend_subq.c.requested_id == user_id,
-                        friend_subq.c.requester_id == user_id,
-                        User.id == user_id))) \
-            .all()
+    consumption = Consumption.__table__
+    author_events = select(consumption.c.id, consumption.c.user_id, consumption.c.created) \
+        .where(consumption.c.user_id == authors.c.author_id, consumption.c.created.isnot(None)) \
+        .order_by(desc(consumption.c.created), desc(consumption.c.id)) \
+        .limit(max_length) \
+        .lateral()
+    events = select(literal(user_id, Integer), author_events.c.id, author_events.c.user_id, author_events.c.created) \
+        .select_from(authors.join(author_events, true()))
 
-        final_results.append(media_results)
+    stmt = insert(TimelineEntry.__table__) \
+        .from_select(['user_id', 'consumption_id', 'author_id', 'created'], events) \
+        .on_conflict_do_nothing()
+    session.execute(stmt)
 
-    return final_results
 
+def remove_from_timeline(user_id: int, author_id: int, session: session) -> int:
+    """
+    Remove all of an author's records from a user's timeline, e.g. when they stop being friends. Caller commits.
+    :param user_id: timeline owner
+    :param author_id:
+    :param session:
+    :return: number of records removed
+    """
+    return session.execute(delete(TimelineEntry.__table__).where(TimelineEntry.user_id == user_id,
+                                                                 TimelineEntry.author_id == author_id)).rowcount
 
-def create_user_friends_subquery(user_id, session):
 
-    max_friend_link_subq = session.query(Friend.requester_id, Friend.requested_id,
-                                         func.max(Friend.created).label("max_created")) \
-        .group_by(Friend.requester_id, Friend.requested_id) \
+def trim_timelines(user_ids: Iterable[int], max_length: int, session: session):
+    """
+    Drop all but the newest max_length entries from each of the given users' timelines. Caller commits.
+    :param user_ids: timeline owners
+    :param max_length:
+    :param session:
+    :return:
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+
+    timeline = TimelineEntry.__table__
+    ranked = select(timeline.c.user_id, timeline.c.consumption_id,
+                    func.row_number().over(partition_by=timeline.c.user_id,
+                                           order_by=(desc(timeline.c.created),
+                                                     desc(timeline.c.consumption_id))).label('position')) \
+        .where(timeline.c.user_id.in_(user_ids)) \
         .subquery()
+    overflow = select(ranked.c.user_id, ranked.c.consumption_id).where(ranked.c.position > max_length)
+
+    session.execute(delete(timeline).where(tuple_(timeline.c.user_id, timeline.c.consumption_id).in_(overflow)))
 
-    friend_subq = session.query(Friend).filter(and_(or_(Friend.requested_id == user_id, Friend.requester_id == user_id),
-                                                    Friend.status == FriendStatus.ACCEPTED.value)) \
-        .join(max_friend_link_subq, and_(Friend.requester_id == max_friend_link_subq.c.requester_id,
-                                         Friend.requested_id == max_friend_link_subq.c.requested_id,
-                                         Friend.created == max_friend_link_subq.c.max_created)) \
+
+def create_user_friends_subquery(user_id, session):
+
+    friend_subq = session.query(Friendship.friend_id) \
+        .filter(Friendship.user_id == user_id,
+                Friendship.status == FriendStatus.ACCEPTED.value) \
         .subquery()
 
     return friend_subq
+
+
+def get_media_metadata(source: str, media_type: str, source_ids: List[str], session: session,
+                       max_age: Optional[timedelta] = None) -> Dict[str, Dict]:
+    """
+    Get stored provider payloads for a whole page of results in one query.
+    :param source: e.g. tmdb
+    :param media_type: book, movie or tv
+    :param source_ids:
+    :param session:
+    :param max_age: ignore payloads fetched longer ago than this
+    :return: source_id -> payload, for the source ids that have a payload
+    """
+    if not source_ids:
+        return {}
+
+    query = session.query(MediaMetadata.source_id, MediaMetadata.payload) \
+        .filter(MediaMetadata.source == source,
+                MediaMetadata.media_type == media_type,
+                MediaMetadata.source_id.in_(source_ids))
+    if max_age is not None:
+        query = query.filter(MediaMetadata.fetched >= datetime.utcnow() - max_age)
+
+    return {source_id: payload for source_id, payload in query.all()}
+
+
+def upsert_media_metadata(source: str, media_type: str, payloads: Dict[str, Dict], session: session):
+    """
+    Store provider payloads, replacing any older payload for the same item. Caller commits.
+    :param source: e.g. tmdb
+    :param media_type: book, movie or tv
+    :param payloads: source_id -> payload
+    :param session:
+    :return:
+    """
+    if not payloads:
+        return
+
+    fetched = datetime.utcnow()
+    stmt = insert(MediaMetadata.__table__).values([{'source': source,
+                                                    'media_type': media_type,
+                                                    'source_id': source_id,
+                                                    'payload': payload,
+                                                    'fetched': fetched} for source_id, payload in payloads.items()])
+    stmt = stmt.on_conflict_do_update(constraint='uq_media_metadata_source_media_type_source_id',
+                                      set_={'payload': stmt.excluded.payload, 'fetched': stmt.excluded.fetched})
+    session.execute(stmt)
+
+
+def upsert_media(media_type: str, medias: List, session: session) -> Dict[Tuple[str, str], int]:
+    """
+    Add media to the catalog unless they are already there, with INSERT ... ON CONFLICT (source, source_id) DO NOTHING
+    RETURNING id, so concurrent requests adding the same item both get the one catalog row. Items already in the
+    catalog are left untouched (no row version written, no row lock taken) and their ids are read back with a second
+    query, which only runs if some were. Caller commits.
+    :param media_type: book, movie or tv
+    :param medias: Book, Movie or TV objects, not yet in the session
+    :param session:
+    :return: catalog id by (source, source_id)
+    """
+    if not medias:
+        return {}
+
+    media_class = MEDIAS[media_type]
+    table = media_class.__table__
+    unique = {(media.source, media.source_id): media for media in medias}
+    stmt = insert(table) \
+        .on_conflict_do_nothing(constraint=f'uq_{table.name}_source_source_id') \
+        .returning(table.c.id, table.c.source, table.c.source_id)
+    rows = session.execute(stmt, [{column.name: getattr(media, column.name) for column in table.columns
+                                   if column.name != 'id'} for media in unique.values()])
+    ids = {(source, source_id): id for id, source, source_id in rows}
+
+    # A conflicting insert waits for the other transaction to commit, and this statement's fresh snapshot sees its row
+    existing = [key for key in unique if key not in ids]
+    if existing:
+        ids.update(((source, source_id), id) for id, source, source_id in session.query(
+            media_class.id, media_class.source, media_class.source_id)
+            .filter(tuple_(media_class.source, media_class.source_id).in_(existing)))
+    return ids
+
+
+def search_local_media(media_type: str, query: str, limit: int, popularity_weight: float, session: session) -> List:
+    """
+    Search media already in our catalog by title (and author for books), using the pg_trgm indexes. Results are
+    ranked by word similarity to the query plus a boost for titles more users have added.
+    :param media_type: book, movie or tv
+    :param query: search string
+    :param limit: maximum number of results
+    :param popularity_weight: weight of log(1 + number of users who added the title) in the ranking
+    :param session:
+    :return: media class objects, best match first
+    """
+    media_class = MEDIAS.get(media_type)
+    search = literal(query)
+
+    # "<%" (word similarity above pg_trgm.word_similarity_threshold), with the percent escaped for psycopg2
+    match = search.op('<%%')(media_class.title)
+    score = func.word_similarity(search, media_class.title)
+    if media_class is Book:
+        # Must match the ix_book_author_names_trgm index expression
+        authors = func.immutable_array_to_string(cast(Book.author_names, ARRAY(Text)), ' ')
+        match = or_(match, search.op('<%%')(authors))
+        score = func.greatest(score, func.word_similarity(search, authors))
+
+    popularity = session.query(func.count(func.distinct(Consumption.user_id))) \
+        .filter(Consumption.media_type == media_type, Consumption.media_id == media_class.id) \
+        .correlate(media_class) \
+        .scalar_subquery()
+
+    results = session.query(media_class) \
+        .filter(match) \
+        .order_by(desc(score + popularity_weight * func.ln(1 + popularity))) \
+        .limit(limit) \
+        .all()
+
+    return results
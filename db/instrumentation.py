@@ -0,0 +1,187 @@
+from collections import Counter, defaultdict, deque
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from flask import Flask, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import SQL_INSTRUMENTATION_ENABLED, SQL_N_PLUS_ONE_THRESHOLD, SQL_EXPLAIN_SLOW_MS, SQL_RECENT_REQUESTS
+from db.session import engine, replicas
+
+logger = logging.getLogger(__name__)
+
+
+class RequestQueries:
+    """
+    Statements run while handling one request.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest_statement = None
+        self.slowest = 0.0
+        self.slowest_plan = None
+        # statement text (parameters are bound separately, so the same query with different values is one key)
+        self.repeats = Counter()
+        self.repeat_time = defaultdict(float)
+
+    def record(self, statement: str, duration: float) -> bool:
+        """
+        :return: whether this is the slowest statement of the request so far
+        """
+        self.count += 1
+        self.total += duration
+        self.repeats[statement] += 1
+        self.repeat_time[statement] += duration
+        if duration <= self.slowest:
+            return False
+        self.slowest, self.slowest_statement, self.slowest_plan = duration, statement, None
+        return True
+
+    def n_plus_one(self, threshold: int) -> List[Dict]:
+        """
+        :param threshold: number of runs of the same statement that counts as an N+1
+        :return: statements run at least threshold times, most repeated first
+        """
+        return [{"statement": statement, "count": count, "total_ms": round(self.repeat_time[statement] * 1000, 3)}
+                for statement, count in self.repeats.most_common() if count >= threshold]
+
+
+class QueryInstrumentation:
+    """
+    Counts and times the SQL each request runs, through engine events, and reports it in a Server-Timing header, in
+    the log (for N+1 patterns and slow statements) and at /api/metrics/queries. Nothing is registered when disabled,
+    so it costs nothing then. Streamed responses are recorded when they close, with the statements their body ran,
+    and get no Server-Timing header.
+    """
+
+    def __init__(self, engines: List[Engine], enabled: bool, n_plus_one_threshold: int, explain_slow_ms: float,
+                 recent_requests: int):
+        """
+        :param engines: primary and replicas
+        :param enabled:
+        :param n_plus_one_threshold: log requests that run the same statement at least this many times
+        :param explain_slow_ms: capture EXPLAIN (ANALYZE, BUFFERS) for SELECTs slower than this; 0 to never. The
+        statement is run a second time to do so
+        :param recent_requests: number of request summaries kept for the debug endpoint
+        """
+        self.engines = engines
+        self.enabled = enabled
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.explain_slow_ms = explain_slow_ms
+        self.recent = deque(maxlen=recent_requests)
+        self._lock = threading.Lock()
+        # endpoint -> totals over every request to it
+        self.endpoints = defaultdict(lambda: {"requests": 0, "statements": 0, "db_ms": 0.0, "n_plus_one": 0})
+
+    def init_app(self, app: Flask):
+        if not self.enabled:
+            return
+        for engine in self.engines:
+            event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"enabled": self.enabled,
+                    "endpoints": {endpoint: dict(totals, db_ms=round(totals["db_ms"], 3))
+                                  for endpoint, totals in self.endpoints.items()},
+                    "recent": list(self.recent)}
+
+    @staticmethod
+    def _start_request():
+        g.sql_queries = RequestQueries()
+
+    def _finish_request(self, response):
+        queries: Optional[RequestQueries] = g.get("sql_queries")
+        if queries is None:
+            return response
+
+        if response.is_streamed:
+            # The body runs its statements after this hook, as the client reads it (stream_with_context keeps the
+            # request context, and g.sql_queries, until then). Record the request once the response is closed; the
+            # headers are sent by then, so streamed responses go without a Server-Timing header
+            method, path, endpoint = request.method, request.path, request.endpoint or request.path
+            response.call_on_close(lambda: self._record(queries, method, path, endpoint, response.status_code))
+            return response
+
+        g.pop("sql_queries")
+        response.headers.add("Server-Timing", f'db;dur={queries.total * 1000:.2f};desc="{queries.count} statements"')
+        self._record(queries, request.method, request.path, request.endpoint or request.path, response.status_code)
+        return response
+
+    def _record(self, queries: RequestQueries, method: str, path: str, endpoint: str, status: int):
+        db_ms = queries.total * 1000
+        n_plus_one = queries.n_plus_one(self.n_plus_one_threshold)
+        for pattern in n_plus_one:
+            logger.warning(f"{method} {path} ran the same statement {pattern['count']} times "
+                           f"({pattern['total_ms']:.1f}ms): {pattern['statement']}")
+
+        summary = {"method": method,
+                   "path": path,
+                   "status": status,
+                   "statements": queries.count,
+                   "db_ms": round(db_ms, 3),
+                   "slowest": {"statement": queries.slowest_statement,
+                               "ms": round(queries.slowest * 1000, 3),
+                               "plan": queries.slowest_plan} if queries.slowest_statement else None,
+                   "n_plus_one": n_plus_one}
+        with self._lock:
+            self.recent.append(summary)
+            totals = self.endpoints[endpoint]
+            totals["requests"] += 1
+            totals["statements"] += queries.count
+            totals["db_ms"] += db_ms
+            totals["n_plus_one"] += bool(n_plus_one)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # On the execution context, which goes away with the statement, so a statement that raises (and never gets
+        # to after_cursor_execute) leaves nothing behind on the connection
+        if context is not None and has_request_context() and "sql_queries" in g:
+            context._query_start_time = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_start_time", None)
+        if started is None or not has_request_context() or "sql_queries" not in g:
+            return
+        duration = time.perf_counter() - started
+
+        queries: RequestQueries = g.sql_queries
+        slowest = queries.record(statement, duration)
+        if slowest and self.explain_slow_ms and duration * 1000 >= self.explain_slow_ms and not executemany \
+                and statement.lstrip()[:6].upper() == "SELECT":
+            queries.slowest_plan = self._explain(conn, statement, parameters)
+            logger.warning(f"Slow statement ({duration * 1000:.1f}ms) in {request.method} {request.path}: "
+                           f"{statement}\n{queries.slowest_plan}")
+
+    @staticmethod
+    def _explain(conn, statement: str, parameters) -> Optional[str]:
+        # A separate DBAPI cursor on the same connection: same transaction, doesn't disturb the pending result, and
+        # bypasses the engine events. In a savepoint, so a failure doesn't abort the request's transaction
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute("SAVEPOINT explain_slow_statement")
+            try:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_statement")
+                raise
+            cursor.execute("RELEASE SAVEPOINT explain_slow_statement")
+            return plan
+        except Exception:
+            logger.exception("EXPLAIN of slow statement failed")
+            return None
+        finally:
+            cursor.close()
+
+
+query_instrumentation = QueryInstrumentation([engine] + replicas.engines, SQL_INSTRUMENTATION_ENABLED,
+                                             SQL_N_PLUS_ONE_THRESHOLD, SQL_EXPLAIN_SLOW_MS, SQL_RECENT_REQUESTS)
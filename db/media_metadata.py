@@ -0,0 +1,71 @@
+from datetime import timedelta
+import logging
+from typing import Dict, List
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+
+from config import METADATA_CACHE_MAX_AGE_SECONDS
+from db.helpers import get_media_metadata, upsert_media_metadata
+from db.session import Session
+
+logger = logging.getLogger(__name__)
+
+
+class MediaMetadataStore:
+    """
+    Provider payloads for one source and media type, kept in the media_metadata table so every worker (and this one
+    after a restart) reuses them instead of calling the provider again. Each read and write runs in its own session,
+    since callers may be on background threads, and database errors are logged rather than raised: a miss only
+    costs a provider call.
+    """
+
+    def __init__(self, session_factory: sessionmaker, source: str, media_type: str, max_age: timedelta):
+        """
+        :param session_factory:
+        :param source: e.g. tmdb
+        :param media_type: book, movie or tv
+        :param max_age: payloads fetched longer ago than this are treated as missing
+        """
+        self.session_factory = session_factory
+        self.source = source
+        self.media_type = media_type
+        self.max_age = max_age
+
+    def load(self, source_ids: List[str]) -> Dict[str, Dict]:
+        """
+        :param source_ids:
+        :return: source_id -> payload, for the source ids with a payload newer than max_age
+        """
+        if not source_ids:
+            return {}
+
+        session = self.session_factory()
+        try:
+            return get_media_metadata(self.source, self.media_type, source_ids, session, max_age=self.max_age)
+        except SQLAlchemyError:
+            logger.exception(f"Unable to read stored {self.source} {self.media_type} metadata")
+            return {}
+        finally:
+            session.close()
+
+    def save(self, payloads: Dict[str, Dict]):
+        """
+        :param payloads: source_id -> payload
+        :return:
+        """
+        if not payloads:
+            return
+
+        session = self.session_factory()
+        try:
+            upsert_media_metadata(self.source, self.media_type, payloads, session)
+            session.commit()
+        except SQLAlchemyError:
+            logger.exception(f"Unable to store {self.source} {self.media_type} metadata")
+            session.rollback()
+        finally:
+            session.close()
+
+
+tmdb_tv_details = MediaMetadataStore(Session, 'tmdb', 'tv', timedelta(seconds=METADATA_CACHE_MAX_AGE_SECONDS))
@@ -0,0 +1,298 @@
+from collections import deque
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from flask import Flask, _app_ctx_stack, _request_ctx_stack, request, has_request_context
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy import orm
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT_SECONDS, DB_POOL_RECYCLE_SECONDS, \
+    DB_POOL_PRE_PING, DB_STATEMENT_TIMEOUT_MS, DB_ECHO, DATABASE_REPLICA_URLS, REPLICA_STICKY_SECONDS, \
+    REPLICA_MAX_LAG_SECONDS, REPLICA_LAG_CHECK_INTERVAL_SECONDS
+from cache.lru import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waited for a connection (including opening one, when the pool has
+    room to grow), and which connections are checked out, by which thread and since when, so connections held past
+    the end of a request can be reported.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.leaks = 0
+        # id of the pooled connection record -> (thread ident, checkout time, where it was checked out)
+        self.checked_out = {}
+
+    def recreate(self):
+        # Keep the counters when the pool is recreated (e.g. after a disconnect is detected)
+        pool = super().recreate()
+        pool.checkouts, pool.timeouts, pool.leaks = self.checkouts, self.timeouts, self.leaks
+        pool.total_wait, pool.max_wait = self.total_wait, self.max_wait
+        return pool
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection_record = super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+
+        where = request.path if has_request_context() else threading.current_thread().name
+        self.checked_out[id(connection_record)] = (threading.get_ident(), time.monotonic(), where)
+        return connection_record
+
+    def _do_return_conn(self, connection_record):
+        self.checked_out.pop(id(connection_record), None)
+        super()._do_return_conn(connection_record)
+
+    def report_leaks(self, thread_ident: int) -> int:
+        """
+        Log every connection the given thread still has checked out. Called once a request is over, when the
+        thread should hold none.
+        :param thread_ident:
+        :return: number of connections still checked out
+        """
+        leaked = [(since, where) for ident, since, where in list(self.checked_out.values()) if ident == thread_ident]
+        for since, where in leaked:
+            logger.warning(f"Database connection checked out by {where} is still held after the request ended "
+                           f"({time.monotonic() - since:.1f}s since checkout)")
+        if leaked:
+            with self._stats_lock:
+                self.leaks += len(leaked)
+        return len(leaked)
+
+    def stats(self) -> Dict:
+        return {"size": self.size(),
+                "checked_out": self.checkedout(),
+                "overflow": max(self.overflow(), 0),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "mean_wait_ms": round(self.total_wait / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+                "leaks": self.leaks}
+
+
+def create_engine(url: str) -> Engine:
+    return sa.create_engine(url,
+                            poolclass=TimedQueuePool,
+                            pool_size=DB_POOL_SIZE,
+                            max_overflow=DB_MAX_OVERFLOW,
+                            pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+                            pool_recycle=DB_POOL_RECYCLE_SECONDS,
+                            pool_pre_ping=DB_POOL_PRE_PING,
+                            connect_args={"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"},
+                            echo=DB_ECHO)
+
+
+class ReplicaSet:
+    """
+    Read replicas, handed out round-robin. A background thread measures each replica's lag behind the primary and
+    takes replicas that are unreachable or more than max_lag seconds behind out of rotation until they catch up.
+
+    Lag is measured against the primary's WAL position, not the replica's own received position: a replica whose WAL
+    receiver has lost the primary has replayed everything it received and would look caught up forever. Each check
+    records the primary's current LSN; a replica's lag is the age of the newest recorded position it has replayed
+    past, so it is accurate to within check_interval and keeps growing while the replica receives nothing. A replica
+    that hasn't replayed even the oldest recorded position (e.g. on the first check, which records the position it is
+    compared with) is taken to be as old as that position. The history spans more than max_lag once it fills, so a
+    replica that stopped receiving is still taken out of rotation within max_lag plus a couple of check intervals of
+    the monitor starting.
+    """
+
+    PRIMARY_LSN_SQL = "SELECT pg_current_wal_lsn()::text"
+    # NULL when the server isn't in recovery (e.g. the primary itself listed as a replica), which is never behind
+    REPLAY_LSN_SQL = "SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()::text END"
+
+    def __init__(self, primary: Engine, engines: List[Engine], max_lag: float, check_interval: float):
+        """
+        :param primary: engine the replicas replicate from
+        :param engines: one per replica
+        :param max_lag: seconds
+        :param check_interval: seconds between lag checks
+        """
+        self.primary = primary
+        self.engines = engines
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        # Out of rotation until the first check
+        self.healthy = [False] * len(engines)
+        self.lag = [None] * len(engines)
+        self.errors = [0] * len(engines)
+        self.reads = [0] * len(engines)
+        # (monotonic time, primary LSN) of recent checks, covering a little more than max_lag
+        self._primary_positions = deque(maxlen=int(max_lag / check_interval) + 2)
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._monitor = None
+
+    def __bool__(self):
+        return bool(self.engines)
+
+    def start(self):
+        """
+        Start the lag monitor thread, once.
+        """
+        with self._lock:
+            if self.engines and self._monitor is None:
+                self._monitor = threading.Thread(target=self._monitor_lag, name="replica-lag-monitor", daemon=True)
+                self._monitor.start()
+
+    def choose(self) -> Optional[Engine]:
+        """
+        :return: the next healthy replica, or None if there is none
+        """
+        healthy = [i for i, ok in enumerate(self.healthy) if ok]
+        if not healthy:
+            return None
+        i = healthy[next(self._next) % len(healthy)]
+        self.reads[i] += 1
+        return self.engines[i]
+
+    def check(self):
+        try:
+            with self.primary.connect() as connection:
+                primary_lsn = _lsn(connection.execute(sa.text(self.PRIMARY_LSN_SQL)).scalar())
+        except Exception:
+            # Nothing to measure against; keep the last verdicts rather than guess
+            logger.exception("Reading the primary's WAL position for the replica lag check failed")
+            return
+        self._primary_positions.append((time.monotonic(), primary_lsn))
+
+        for i, replica in enumerate(self.engines):
+            try:
+                with replica.connect() as connection:
+                    replay_lsn = connection.execute(sa.text(self.REPLAY_LSN_SQL)).scalar()
+            except Exception:
+                logger.exception(f"Lag check of replica {i} failed")
+                self.errors[i] += 1
+                self.lag[i], self.healthy[i] = None, False
+                continue
+            lag = self._lag(None if replay_lsn is None else _lsn(replay_lsn))
+            if self.healthy[i] and lag > self.max_lag:
+                logger.warning(f"Replica {i} is {lag:.1f}s behind, taking it out of rotation")
+            self.lag[i], self.healthy[i] = lag, lag <= self.max_lag
+
+    def _lag(self, replay_lsn: Optional[int]) -> float:
+        """
+        :return: seconds since the newest recorded primary position the replica has replayed, or since the oldest
+        recorded position if it hasn't replayed any
+        """
+        now = time.monotonic()
+        newest = self._primary_positions[-1][0]
+        for recorded, primary_lsn in reversed(self._primary_positions):
+            if replay_lsn is None or replay_lsn >= primary_lsn:
+                return 0.0 if recorded == newest else now - recorded
+        return now - self._primary_positions[0][0]
+
+    def stats(self) -> List[Dict]:
+        return [{"healthy": self.healthy[i],
+                 "lag_seconds": self.lag[i],
+                 "reads": self.reads[i],
+                 "lag_check_errors": self.errors[i],
+                 "pool": replica.pool.stats()} for i, replica in enumerate(self.engines)]
+
+    def _monitor_lag(self):
+        while True:
+            self.check()
+            time.sleep(self.check_interval)
+
+
+def _lsn(text: str) -> int:
+    # pg_lsn text is two hex halves, e.g. 16/B374D848
+    high, low = text.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+engine = create_engine(DATABASE_URL)
+replicas = ReplicaSet(engine, [create_engine(url) for url in DATABASE_REPLICA_URLS], REPLICA_MAX_LAG_SECONDS,
+                      REPLICA_LAG_CHECK_INTERVAL_SECONDS)
+# auth0 sub of users who wrote recently, whose reads stay on the primary so they see their own writes
+recent_writers = TTLCache(max_size=100000, ttl=REPLICA_STICKY_SECONDS)
+
+
+class RoutingSession(orm.Session):
+    """
+    Session for request handlers that reads from a replica during GET requests, unless the user wrote recently.
+    Everything else, and any flush, goes to the primary. The choice is made once per session, so all of a request's
+    reads see the same replica.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or not replicas:
+            return engine
+        bind = self.info.get("read_bind")
+        if bind is None:
+            bind = self.info["read_bind"] = (_read_from_replica() and replicas.choose()) or engine
+        return bind
+
+
+def _read_from_replica() -> bool:
+    if not has_request_context() or request.method not in ("GET", "HEAD"):
+        return False
+    current_user = getattr(_request_ctx_stack.top, "current_user", None) or {}
+    return recent_writers.get(current_user.get("sub")) is None
+
+
+# For background jobs and scripts, which manage their own sessions
+Session = sessionmaker(bind=engine)
+# For request handlers: one session per app context, removed (and its connection returned) when the context ends
+request_session = scoped_session(sessionmaker(class_=RoutingSession), scopefunc=_app_ctx_stack.__ident_func__)
+
+
+def init_app(app: Flask):
+    """
+    Release the request session after every request, and report any connection the request left checked out.
+    Start monitoring replica lag, and keep a user's reads on the primary for a while after they write.
+    :param app:
+    :return:
+    """
+    replicas.start()
+
+    @app.after_request
+    def remember_writer(response):
+        current_user = getattr(_request_ctx_stack.top, "current_user", None) or {}
+        if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400 and "sub" in current_user:
+            recent_writers.set(current_user["sub"], True)
+        return response
+
+    @app.teardown_appcontext
+    def remove_request_session(exception=None):
+        request_session.remove()
+        for pool in [engine.pool] + [replica.pool for replica in replicas.engines]:
+            pool.report_leaks(threading.get_ident())
+
+
+def disable_statement_timeout(connection):
+    """
+    Turn off DB_STATEMENT_TIMEOUT_MS until the end of the current transaction, for batch jobs whose statements are
+    expected to run long. SET LOCAL, so the connection goes back to the pool with the timeout in place.
+    :param connection: DBAPI connection
+    :return:
+    """
+    cursor = connection.cursor()
+    cursor.execute("SET LOCAL statement_timeout = 0")
+    cursor.close()
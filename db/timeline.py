@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+from typing import Callable, Dict, List
+
+from sqlalchemy.orm import sessionmaker
+
+from config import FEED_FANOUT_ENABLED, FEED_FANOUT_WORKERS, FEED_TIMELINE_MAX_LENGTH
+from db.helpers import backfill_timeline, fan_out_consumptions, fill_timeline, remove_from_timeline, trim_timelines
+from db.session import Session
+from models.friend import FriendStatus, Friendship
+
+logger = logging.getLogger(__name__)
+
+
+class TimelineFanout:
+    """
+    Writes events into per-user feed timelines off the request path. Jobs run on a small thread pool, each in its own
+    session, and are idempotent: if a job is lost (e.g. the worker restarts), scripts/backfill_timelines.py rebuilds
+    the timelines from consumption and friendship.
+    """
+
+    def __init__(self, session_factory: sessionmaker, max_length: int, workers: int, enabled: bool = True):
+        """
+        :param session_factory:
+        :param max_length: number of entries to keep per timeline
+        :param workers: number of background threads
+        :param enabled: when False, every call is a no-op
+        """
+        self.session_factory = session_factory
+        self.max_length = max_length
+        self.enabled = enabled
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="timeline-fanout")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.timelines_updated = 0
+
+    def fan_out(self, consumption_ids: List[int]):
+        """
+        Copy committed consumption records into their authors' and the authors' friends' timelines.
+        :param consumption_ids:
+        :return:
+        """
+        if consumption_ids:
+            self._submit(self._fan_out, list(consumption_ids))
+
+    def sync_friendship(self, user_id: int, friend_id: int):
+        """
+        Bring both users' timelines in line with their current friendship: backfill each with the other's recent
+        events if they are friends, otherwise remove them.
+        :param user_id:
+        :param friend_id:
+        :return:
+        """
+        if user_id != friend_id:
+            self._submit(self._sync_friendship, user_id, friend_id)
+
+    def stats(self) -> Dict:
+        return {"enabled": self.enabled,
+                "pending": self.pending,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timelines_updated": self.timelines_updated,
+                "max_length": self.max_length}
+
+    def _submit(self, job: Callable, *args):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.pending += 1
+        self._executor.submit(self._run, job, *args)
+
+    def _run(self, job: Callable, *args):
+        session = self.session_factory()
+        try:
+            written = job(session, *args)
+            session.commit()
+        except Exception:
+            session.rollback()
+            logger.exception(f"Timeline job {job.__name__}{args} failed")
+            with self._lock:
+                self.failed += 1
+        else:
+            with self._lock:
+                self.completed += 1
+                self.timelines_updated += written or 0
+        finally:
+            session.close()
+            with self._lock:
+                self.pending -= 1
+
+    def _fan_out(self, session, consumption_ids: List[int]) -> int:
+        owners = fan_out_consumptions(consumption_ids, session)
+        trim_timelines(owners, self.max_length, session)
+        return len(owners)
+
+    def _sync_friendship(self, session, user_id: int, friend_id: int) -> int:
+        friendship = session.query(Friendship).get((user_id, friend_id))
+        if friendship is not None and friendship.status == FriendStatus.ACCEPTED.value:
+            backfill_timeline(user_id, friend_id, self.max_length, session)
+            backfill_timeline(friend_id, user_id, self.max_length, session)
+            trim_timelines([user_id, friend_id], self.max_length, session)
+            return 2
+
+        # Only a pair leaving the accepted state has entries to remove. A new, re-sent or ignored request finds none
+        # (an index lookup) and skips the refill, which reads every friend's recent events
+        emptied = [owner for owner, author in [(user_id, friend_id), (friend_id, user_id)]
+                   if remove_from_timeline(owner, author, session)]
+        for owner in emptied:
+            # Older entries trimmed to make room for the removed friend's are due back
+            fill_timeline(owner, self.max_length, session)
+        trim_timelines(emptied, self.max_length, session)
+        return len(emptied)
+
+
+timeline_fanout = TimelineFanout(Session, FEED_TIMELINE_MAX_LENGTH, FEED_FANOUT_WORKERS, enabled=FEED_FANOUT_ENABLED)
@@ -0,0 +1,167 @@
+"""
+Readers for the list exports of other sites, each turning CSV rows into ImportRows:
+
+- Goodreads: "Export Library" (goodreads_library_export.csv), books on the read, currently-reading and to-read shelves
+- Letterboxd: watched.csv, diary.csv or watchlist.csv from the data export; watchlist rows need status=want to consume
+- IMDb: ratings.csv (rated titles count as finished) or a list/watchlist export (want to consume)
+"""
+from dataclasses import dataclass, field
+from datetime import datetime
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+from models.consumption import ConsumptionStatus
+
+GOODREADS = 'goodreads'
+LETTERBOXD = 'letterboxd'
+IMDB = 'imdb'
+
+GOODREADS_SHELVES = {
+    'read': ConsumptionStatus.FINISHED.value,
+    'currently-reading': ConsumptionStatus.CONSUMING.value,
+    'to-read': ConsumptionStatus.WANT_TO_CONSUME.value,
+    # Common names for a custom "gave up on it" exclusive shelf
+    'did-not-finish': ConsumptionStatus.ABANDONED.value,
+    'dnf': ConsumptionStatus.ABANDONED.value,
+    'abandoned': ConsumptionStatus.ABANDONED.value,
+}
+
+# IMDb "Title Type", in both the current and the older export spelling
+IMDB_TITLE_TYPES = {
+    'movie': 'movie', 'tvMovie': 'movie', 'video': 'movie', 'short': 'movie',
+    'Feature Film': 'movie', 'TV Movie': 'movie', 'Video': 'movie', 'Short Film': 'movie',
+    'tvSeries': 'tv', 'tvMiniSeries': 'tv', 'TV Series': 'tv', 'TV Mini-Series': 'tv', 'Mini-Series': 'tv',
+}
+
+# "The Queen of Nothing (The Folk of the Air, #3)" -> "The Queen of Nothing"
+SERIES_SUFFIX = re.compile(r'\s*\([^()]*#\s*[\d.]+\)\s*$')
+
+
+@dataclass
+class ImportRow:
+    line: int
+    media_type: str
+    title: str
+    status: str
+    created: datetime
+    year: Optional[int] = None
+    authors: List[str] = field(default_factory=list)
+    isbns: List[str] = field(default_factory=list)
+
+
+@dataclass
+class SkippedRow:
+    line: int
+    title: Optional[str]
+    reason: str
+
+
+def detect_format(fieldnames: Iterable[str]) -> str:
+    """
+    :param fieldnames: CSV header
+    :return: GOODREADS, LETTERBOXD or IMDB
+    :raises ValueError: if the header isn't one of theirs
+    """
+    fieldnames = set(fieldnames)
+    if {'Title', 'Exclusive Shelf'} <= fieldnames:
+        return GOODREADS
+    if {'Name', 'Letterboxd URI'} <= fieldnames:
+        return LETTERBOXD
+    if {'Const', 'Title', 'Title Type'} <= fieldnames:
+        return IMDB
+    raise ValueError("Unrecognized export; expected a Goodreads, Letterboxd or IMDb CSV export")
+
+
+def parse_rows(rows: Iterable[Dict[str, str]], export_format: str,
+               status: Optional[str] = None) -> Iterator[Union[ImportRow, SkippedRow]]:
+    """
+    :param rows: csv.DictReader over the export
+    :param export_format: GOODREADS, LETTERBOXD or IMDB
+    :param status: status for every row, instead of the one the export implies
+    :return: one ImportRow or SkippedRow per CSV row, lazily
+    """
+    parse = {GOODREADS: _goodreads_row, LETTERBOXD: _letterboxd_row, IMDB: _imdb_row}[export_format]
+    # Line 1 is the header
+    for line, row in enumerate(rows, start=2):
+        title = (row.get('Title') or row.get('Name') or '').strip()
+        if not title:
+            yield SkippedRow(line, None, "no title")
+            continue
+        try:
+            parsed = parse(line, title, row, status)
+        except ValueError as e:
+            yield SkippedRow(line, title, str(e))
+            continue
+        yield parsed
+
+
+def _goodreads_row(line: int, title: str, row: Dict[str, str], status: Optional[str]) -> Union[ImportRow, SkippedRow]:
+    shelf = (row.get('Exclusive Shelf') or '').strip()
+    status = status or GOODREADS_SHELVES.get(shelf)
+    if status is None:
+        return SkippedRow(line, title, f"shelf '{shelf}'")
+
+    authors = [row.get('Author', '')] + (row.get('Additional Authors') or '').split(',')
+    # ISBNs are exported as ="0316310344" so spreadsheets keep the leading zeros
+    isbns = [isbn for isbn in (_strip_spreadsheet_quoting(row.get('ISBN13')),
+                               _strip_spreadsheet_quoting(row.get('ISBN'))) if isbn]
+    year = row.get('Original Publication Year') or row.get('Year Published')
+    read = status == ConsumptionStatus.FINISHED.value and row.get('Date Read')
+    return ImportRow(line=line,
+                     media_type='book',
+                     title=SERIES_SUFFIX.sub('', title),
+                     status=status,
+                     created=_parse_date(read or row.get('Date Added')),
+                     year=int(year) if year else None,
+                     authors=[author.strip() for author in authors if author.strip()],
+                     isbns=isbns)
+
+
+def _letterboxd_row(line: int, title: str, row: Dict[str, str], status: Optional[str]) -> ImportRow:
+    year = row.get('Year')
+    return ImportRow(line=line,
+                     media_type='movie',
+                     title=title,
+                     status=status or ConsumptionStatus.FINISHED.value,
+                     created=_parse_date(row.get('Watched Date') or row.get('Date')),
+                     year=int(year) if year else None)
+
+
+def _imdb_row(line: int, title: str, row: Dict[str, str], status: Optional[str]) -> Union[ImportRow, SkippedRow]:
+    title_type = (row.get('Title Type') or '').strip()
+    media_type = IMDB_TITLE_TYPES.get(title_type)
+    if media_type is None:
+        return SkippedRow(line, title, f"title type '{title_type}'")
+
+    rated = 'Your Rating' in row
+    if status is None:
+        status = ConsumptionStatus.FINISHED.value if rated else ConsumptionStatus.WANT_TO_CONSUME.value
+    year = row.get('Year')
+    return ImportRow(line=line,
+                     media_type=media_type,
+                     title=title,
+                     status=status,
+                     created=_parse_date(row.get('Date Rated') if rated else row.get('Created')),
+                     year=int(year) if year else None)
+
+
+def _strip_spreadsheet_quoting(value: Optional[str]) -> Optional[str]:
+    return value.strip().lstrip('=').strip('"') if value else None
+
+
+def _parse_date(value: Optional[str]) -> datetime:
+    """
+    :param value: 2021/03/14 (Goodreads), 2021-03-14 (Letterboxd, IMDb) or an ISO timestamp; empty for now
+    """
+    if not value or not value.strip():
+        return datetime.utcnow()
+    value = value.strip()
+    for date_format in ('%Y/%m/%d', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        raise ValueError(f"unreadable date '{value}'")
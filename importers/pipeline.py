@@ -0,0 +1,264 @@
+"""
+Bulk import of a parsed export into a user's lists, a batch of rows at a time. Each batch is matched against our own
+catalog by title (and author for books, year for movies and shows) in one query per media type; rows that aren't in the catalog are
+looked up with the external providers, several at a time. Media found that way are added to the catalog, then the
+batch's consumption records are written with one executemany INSERT, the user's current list state is updated and
+the batch is committed and fanned out to friends' timelines.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import logging
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from sqlalchemy import any_, extract, func, insert, tuple_
+from sqlalchemy.dialects.postgresql import array
+from sqlalchemy.orm import session
+
+from config import IMPORT_LOOKUP_CONCURRENCY, IMPORT_PROVIDER_LOOKUP_ENABLED
+from db.helpers import MEDIAS, record_latest_consumptions, upsert_media
+from db.timeline import timeline_fanout
+from importers.formats import ImportRow, SkippedRow
+from models.books import Book
+from models.consumption import Consumption, ConsumptionLatest
+from models.movies import Movie
+from models.tv import TV
+from wrappers.google_books import google_books_client
+from wrappers.tmdb import tmdb_client
+
+logger = logging.getLogger(__name__)
+
+_lookup_executor = ThreadPoolExecutor(max_workers=IMPORT_LOOKUP_CONCURRENCY, thread_name_prefix="import-lookup")
+
+# Most unmatched titles reported back to the user
+MAX_UNMATCHED_REPORTED = 100
+
+
+def import_rows(user_id: int, rows: Iterable[Union[ImportRow, SkippedRow]], session: session, batch_size: int,
+                lookup_providers: bool = IMPORT_PROVIDER_LOOKUP_ENABLED) -> Iterator[Dict]:
+    """
+    Import parsed rows into the user's lists, committing after each batch. Rows whose item is already on the user's
+    list with the same status are skipped, so importing the same export twice adds nothing the second time, and so are
+    repeats of a row earlier in the batch (counted as already on the list).
+    :param user_id:
+    :param rows: parsed export, read lazily
+    :param session:
+    :param batch_size: rows per batch
+    :param lookup_providers: look up rows missing from the catalog with the external providers
+    :return: running totals after each batch, then the final totals with "done": true
+    """
+    progress = {"rows": 0, "imported": 0, "already_on_list": 0, "added_to_catalog": 0, "unmatched": 0,
+                "skipped": 0}
+    unmatched = []
+
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        progress["rows"] += len(batch)
+        parsed = [row for row in batch if isinstance(row, ImportRow)]
+        progress["skipped"] += len(batch) - len(parsed)
+
+        media_ids = match_catalog(parsed, session)
+        missing = [row for row in parsed if row.line not in media_ids]
+        if missing and lookup_providers:
+            found, added = add_provider_matches(missing, session)
+            media_ids.update(found)
+            progress["added_to_catalog"] += added
+
+        matched = [row for row in parsed if row.line in media_ids]
+        for row in parsed:
+            if row.line not in media_ids:
+                progress["unmatched"] += 1
+                if len(unmatched) < MAX_UNMATCHED_REPORTED:
+                    unmatched.append({"line": row.line, "title": row.title})
+
+        new = drop_already_on_list(user_id, drop_repeated_rows(matched, media_ids), media_ids, session)
+        progress["already_on_list"] += len(matched) - len(new)
+
+        consumption_ids = write_consumptions(user_id, new, media_ids, session)
+        session.commit()
+        timeline_fanout.fan_out(consumption_ids)
+        progress["imported"] += len(consumption_ids)
+        yield dict(progress)
+
+    yield dict(progress, done=True, unmatched_titles=unmatched)
+
+
+def match_catalog(rows: List[ImportRow], session: session) -> Dict[int, Tuple[int, str]]:
+    """
+    Find rows' media in the catalog by exact (case-insensitive) title, one query per media type. Books must also
+    share an author, and movies and shows be from the same year (give or take one); among several candidates the
+    oldest catalog entry wins.
+    :param rows:
+    :param session:
+    :return: media id and source id by row line number, for the rows found
+    """
+    matches = {}
+    for media_type, typed_rows in _by_media_type(rows).items():
+        media_class = MEDIAS[media_type]
+        columns = [media_class.id, media_class.source_id, func.lower(media_class.title), _year_column(media_class)]
+        if media_class is Book:
+            columns.append(Book.author_names)
+        # Must match the ix_<media>_title_lower index expression
+        candidates = session.query(*columns) \
+            .filter(func.lower(media_class.title) == any_(array(list({row.title.lower() for row in typed_rows})))) \
+            .order_by(media_class.id) \
+            .all()
+
+        by_title = {}
+        for candidate in candidates:
+            by_title.setdefault(candidate[2], []).append(candidate)
+        for row in typed_rows:
+            match = _best_candidate(row, by_title.get(row.title.lower(), []))
+            if match is not None:
+                matches[row.line] = match
+    return matches
+
+
+def add_provider_matches(rows: List[ImportRow], session: session) -> Tuple[Dict[int, Tuple[int, str]], int]:
+    """
+    Look rows up with the external providers, in parallel, and add the media found to the catalog unless they are
+    there already.
+    :param rows:
+    :param session:
+    :return: media id and source id by row line number for the rows found, and the number of media added to the catalog
+    """
+    found = [(row, media) for row, media in zip(rows, _lookup_executor.map(_lookup, rows)) if media is not None]
+
+    matches = {}
+    added = 0
+    for media_type, typed in itertools.groupby(sorted(found, key=lambda pair: pair[0].media_type),
+                                               key=lambda pair: pair[0].media_type):
+        typed = list(typed)
+        media_class = MEDIAS[media_type]
+        keys = {(media.source, media.source_id): media for _, media in typed}
+
+        ids = dict(((source, source_id), id) for id, source, source_id in session.query(
+            media_class.id, media_class.source, media_class.source_id)
+            .filter(tuple_(media_class.source, media_class.source_id).in_(list(keys))))
+        # Only the missing items go through the upsert, which doesn't rewrite the rest and also resolves items
+        # added concurrently since this query
+        new = [media for key, media in keys.items() if key not in ids]
+        ids.update(upsert_media(media_type, new, session))
+        added += len(new)
+
+        for row, media in typed:
+            matches[row.line] = (ids[(media.source, media.source_id)], media.source_id)
+    return matches, added
+
+
+def drop_repeated_rows(rows: List[ImportRow], media_ids: Dict[int, Tuple[int, str]]) -> List[ImportRow]:
+    """
+    :return: the rows that aren't a repeat of an earlier row, i.e. the same item with the same status and date
+    """
+    seen = set()
+    unique = []
+    for row in rows:
+        key = (row.media_type, media_ids[row.line][0], row.status, row.created)
+        if key not in seen:
+            seen.add(key)
+            unique.append(row)
+    return unique
+
+
+def drop_already_on_list(user_id: int, rows: List[ImportRow], media_ids: Dict[int, Tuple[int, str]],
+                         session: session) -> List[ImportRow]:
+    """
+    :return: the rows whose item isn't on the user's list with the same status already
+    """
+    current = set()
+    for media_type, typed_rows in _by_media_type(rows).items():
+        # An array parameter is one bind however long the batch; a tuple IN list costs more to compile than to run
+        current.update(session.query(ConsumptionLatest.media_type, ConsumptionLatest.media_id,
+                                     ConsumptionLatest.status)
+                       .filter(ConsumptionLatest.user_id == user_id,
+                               ConsumptionLatest.media_type == media_type,
+                               ConsumptionLatest.media_id == any_(array(list({media_ids[row.line][0]
+                                                                               for row in typed_rows}))))
+                       .all())
+    return [row for row in rows if (row.media_type, media_ids[row.line][0], row.status) not in current]
+
+
+def write_consumptions(user_id: int, rows: List[ImportRow], media_ids: Dict[int, Tuple[int, str]],
+                       session: session) -> List[int]:
+    """
+    Insert the rows' consumption records and update the user's current list state. Caller commits.
+    :return: ids of the new consumption records
+    """
+    if not rows:
+        return []
+    table = Consumption.__table__
+    # executemany rather than .values(): psycopg2 still sends multi-row VALUES pages, but the statement is compiled
+    # once and cached instead of once per batch with a bound parameter per value
+    written = session.execute(insert(table).returning(*table.columns),
+                              [{'user_id': user_id,
+                                'media_type': row.media_type,
+                                'media_id': media_ids[row.line][0],
+                                'source_id': media_ids[row.line][1],
+                                'status': row.status,
+                                'created': row.created} for row in rows]).all()
+    record_latest_consumptions(written, session)
+    return [consumption.id for consumption in written]
+
+
+def _by_media_type(rows: List[ImportRow]) -> Dict[str, List[ImportRow]]:
+    by_media_type = {}
+    for row in rows:
+        by_media_type.setdefault(row.media_type, []).append(row)
+    return by_media_type
+
+
+def _year_column(media_class):
+    if media_class is Book:
+        return Book.publish_year
+    date = Movie.release_date if media_class is Movie else TV.first_air_date
+    return extract('year', date)
+
+
+def _best_candidate(row: ImportRow, candidates: List[Tuple]) -> Optional[Tuple[int, str]]:
+    # Books are told apart by author: exports give the original publication year, the catalog the edition's
+    if row.media_type == 'book':
+        if row.authors:
+            authors = {author.lower() for author in row.authors}
+            candidates = [c for c in candidates if not c[4] or authors & {author.lower() for author in c[4]}]
+    elif row.year is not None:
+        candidates = [c for c in candidates if c[3] is None or abs(int(c[3]) - row.year) <= 1]
+    return (candidates[0][0], candidates[0][1]) if candidates else None
+
+
+def _lookup(row: ImportRow):
+    """
+    :return: the provider's best match for the row, or None
+    """
+    try:
+        if row.media_type == 'book':
+            return _first(google_books_client.get_books_by_query(_book_query(row)), row)
+        search: Callable = tmdb_client.get_movies_by_title if row.media_type == 'movie' else tmdb_client.get_tv_by_title
+        return _first(search(row.title), row)
+    except Exception:
+        logger.exception(f"Provider lookup for imported {row.media_type} '{row.title}' failed")
+        return None
+
+
+def _book_query(row: ImportRow) -> str:
+    if row.isbns:
+        return f"isbn:{row.isbns[0]}"
+    query = f"intitle:{row.title}"
+    return f"{query} inauthor:{row.authors[0]}" if row.authors else query
+
+
+def _first(results: List, row: ImportRow):
+    """
+    First result from the row's year (give or take one), if the row has a year and wasn't looked up by ISBN, else the
+    first result.
+    """
+    for media in results:
+        if row.year is None or row.isbns:
+            return media
+        year = media.publish_year if isinstance(media, Book) else \
+            (media.release_date if isinstance(media, Movie) else media.first_air_date)
+        year = year.year if year is not None and not isinstance(year, int) else year
+        if year is None or abs(year - row.year) <= 1:
+            return media
+    return None
@@ -0,0 +1,298 @@
+"""
+Taste similarity between users, from the items on their lists: every (media type, media id) in consumption_latest,
+whatever its status. For two users with item sets A and B we store
+
+    overlap = |A & B|, jaccard = |A & B| / |A | B|, cosine = |A & B| / sqrt(|A| * |B|)
+
+The bulk job loads every list into a sparse user x item matrix and scores all friend pairs (plus, with --all-pairs,
+every pair of users with at least --min-overlap items in common) in a few vectorized passes, then replaces the
+taste_similarity table:
+
+    python -m jobs.similarity [--all-pairs] [--min-overlap 5]
+
+Between bulk runs, refresh_user_similarity rescores one user against their friends in the background whenever their
+list or friendships change.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import io
+import logging
+import threading
+import time
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+import sqlalchemy as sa
+from sqlalchemy.orm import session
+
+from config import TASTE_SIMILARITY_INCREMENTAL, TASTE_SIMILARITY_MIN_OVERLAP
+from db.helpers import MEDIAS
+from db.session import Session, disable_statement_timeout, engine
+from models.friend import FriendStatus
+
+logger = logging.getLogger(__name__)
+
+# One bigint per item: media type index in the high 32 bits, media id in the low 32 bits
+ITEM_KEY_SQL = f"(array_position(ARRAY[{', '.join(repr(t) for t in MEDIAS)}], media_type)::bigint << 32) | media_id"
+
+FETCH_SIZE = 1000000
+
+
+class UserItemMatrix:
+    """
+    Binary sparse matrix of users (rows, sorted by user id) by items (columns). Users with empty lists have no row.
+    """
+
+    def __init__(self, user_ids: np.ndarray, item_keys: np.ndarray):
+        self.user_ids, rows = np.unique(user_ids, return_inverse=True)
+        item_keys, columns = np.unique(item_keys, return_inverse=True)
+        data = np.ones(len(rows), dtype=np.float32)
+        self.matrix = sparse.csr_matrix((data, (rows, columns)), shape=(len(self.user_ids), len(item_keys)))
+        self.sizes = np.diff(self.matrix.indptr)
+
+    def rows(self, user_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param user_ids:
+        :return: matrix row of each user id, and a mask of which user ids have a row
+        """
+        rows = np.searchsorted(self.user_ids, user_ids)
+        found = rows < len(self.user_ids)
+        found[found] = self.user_ids[rows[found]] == user_ids[found]
+        return rows, found
+
+    def score_pairs(self, rows_a: np.ndarray, rows_b: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Similarity of each pair of rows (rows_a[k], rows_b[k]).
+        :return: overlap, jaccard and cosine arrays
+        """
+        overlap = np.asarray(self.matrix[rows_a].multiply(self.matrix[rows_b]).sum(axis=1)).ravel()
+        return self._scores(overlap, rows_a, rows_b)
+
+    def pairs_with_overlap(self, min_overlap: int, block_size: int = 1000) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        All pairs of rows (a < b) with at least min_overlap items in common, from X @ X.T a block of rows at a time.
+        :return: rows_a, rows_b
+        """
+        transposed = self.matrix.T.tocsr()
+        rows_a, rows_b = [], []
+        for start in range(0, self.matrix.shape[0], block_size):
+            counts = (self.matrix[start:start + block_size] @ transposed).tocoo()
+            row = counts.row + start
+            keep = (counts.col > row) & (counts.data >= min_overlap)
+            rows_a.append(row[keep])
+            rows_b.append(counts.col[keep])
+        return np.concatenate(rows_a), np.concatenate(rows_b)
+
+    def _scores(self, overlap: np.ndarray, rows_a: np.ndarray, rows_b: np.ndarray):
+        size_a = self.sizes[rows_a].astype(np.float64)
+        size_b = self.sizes[rows_b].astype(np.float64)
+        jaccard = overlap / (size_a + size_b - overlap)
+        cosine = overlap / np.sqrt(size_a * size_b)
+        return overlap.astype(np.int64), jaccard, cosine
+
+
+def load_matrix(connection, user_ids: Optional[Iterable[int]] = None) -> UserItemMatrix:
+    """
+    :param connection: DBAPI connection
+    :param user_ids: only load these users' lists; None for everyone
+    :return:
+    """
+    sql = f"SELECT user_id, {ITEM_KEY_SQL} FROM consumption_latest WHERE media_id IS NOT NULL"
+    params = None
+    if user_ids is not None:
+        sql += " AND user_id = ANY(%(user_ids)s)"
+        params = {"user_ids": list(user_ids)}
+
+    # Server side cursor, so the whole table is never held as Python tuples
+    cursor = connection.cursor(name="taste_similarity_items")
+    cursor.execute(sql, params)
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int64))
+    cursor.close()
+
+    pairs = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.int64)
+    return UserItemMatrix(pairs[:, 0], pairs[:, 1])
+
+
+def friend_pairs(connection) -> np.ndarray:
+    """
+    :param connection: DBAPI connection
+    :return: (user_id, friend_id) rows, each friendship once
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT user_id, friend_id FROM friendship WHERE status = %(status)s AND user_id < friend_id",
+                   {"status": FriendStatus.ACCEPTED.value})
+    pairs = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+    cursor.close()
+    return pairs
+
+
+def run(all_pairs: bool = False, min_overlap: int = TASTE_SIMILARITY_MIN_OVERLAP, chunk_size: int = 500000):
+    """
+    Recompute every score and replace the taste_similarity table in one transaction.
+    """
+    timings = {}
+    started = time.perf_counter()
+    connection = engine.raw_connection()
+    try:
+        # The whole run is one transaction; lift the pool's statement timeout for it only
+        disable_statement_timeout(connection)
+        matrix = load_matrix(connection)
+        pairs = friend_pairs(connection)
+        timings["load"] = time.perf_counter() - started
+
+        rows_a, found_a = matrix.rows(pairs[:, 0])
+        rows_b, found_b = matrix.rows(pairs[:, 1])
+        found = found_a & found_b
+        rows_a, rows_b = rows_a[found], rows_b[found]
+        if all_pairs:
+            started = time.perf_counter()
+            extra_a, extra_b = matrix.pairs_with_overlap(min_overlap)
+            rows_a, rows_b = _unique_pairs(np.concatenate([rows_a, extra_a]), np.concatenate([rows_b, extra_b]))
+            timings["all_pairs"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        overlap, jaccard, cosine = np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+        chunks = [matrix.score_pairs(rows_a[i:i + chunk_size], rows_b[i:i + chunk_size])
+                  for i in range(0, len(rows_a), chunk_size)]
+        if chunks:
+            overlap, jaccard, cosine = (np.concatenate(parts) for parts in zip(*chunks))
+        timings["score"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        _replace_table(connection, matrix.user_ids[rows_a], matrix.user_ids[rows_b], overlap, jaccard, cosine)
+        connection.commit()
+        timings["write"] = time.perf_counter() - started
+    finally:
+        connection.close()
+
+    print(f"{matrix.matrix.shape[0]} users with items, {matrix.matrix.shape[1]} items, {matrix.matrix.nnz} list "
+          f"entries, {len(pairs)} friend pairs, {len(rows_a)} pairs scored")
+    print(", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()))
+
+
+def _unique_pairs(rows_a: np.ndarray, rows_b: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    low, high = np.minimum(rows_a, rows_b), np.maximum(rows_a, rows_b)
+    unique = np.unique(np.stack([low, high], axis=1), axis=0)
+    return unique[:, 0], unique[:, 1]
+
+
+def _replace_table(connection, user_ids, other_user_ids, overlap, jaccard, cosine):
+    computed = datetime.utcnow().isoformat()
+    # Both directions, so a user's scores are one primary key range
+    columns = np.column_stack([np.concatenate([user_ids, other_user_ids]),
+                               np.concatenate([other_user_ids, user_ids]),
+                               np.tile(overlap, 2), np.tile(jaccard, 2), np.tile(cosine, 2)])
+    buffer = io.StringIO()
+    np.savetxt(buffer, columns, fmt=f"%d\t%d\t%d\t%.6f\t%.6f\t{computed}")
+    buffer.seek(0)
+
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM taste_similarity")
+    cursor.copy_expert("COPY taste_similarity (user_id, other_user_id, overlap, jaccard, cosine, computed) "
+                       "FROM STDIN", buffer)
+    cursor.close()
+
+
+def update_user_similarity(user_id: int, session: session, min_overlap: int = TASTE_SIMILARITY_MIN_OVERLAP) -> int:
+    """
+    Rescore one user against their friends and anyone they already have a score with. Scores with users who are not
+    friends are dropped once they fall below min_overlap. Caller commits.
+    :param user_id:
+    :param session:
+    :param min_overlap:
+    :return: number of pairs scored
+    """
+    friend_ids = {friend_id for friend_id, in session.execute(
+        sa.text("SELECT friend_id FROM friendship WHERE user_id = :user_id AND status = :status"),
+        {"user_id": user_id, "status": FriendStatus.ACCEPTED.value})}
+    scored_ids = {other_user_id for other_user_id, in session.execute(
+        sa.text("SELECT other_user_id FROM taste_similarity WHERE user_id = :user_id"), {"user_id": user_id})}
+    other_ids = np.array(sorted((friend_ids | scored_ids) - {user_id}), dtype=np.int64)
+
+    connection = session.connection().connection
+    matrix = load_matrix(connection, [user_id, *other_ids.tolist()])
+    (user_row,), (user_found,) = matrix.rows(np.array([user_id]))
+    other_rows, other_found = matrix.rows(other_ids)
+
+    records = []
+    if user_found and other_found.any():
+        overlap, jaccard, cosine = matrix.score_pairs(np.full(other_found.sum(), user_row), other_rows[other_found])
+        computed = datetime.utcnow()
+        for other_id, pair_overlap, pair_jaccard, pair_cosine in zip(other_ids[other_found].tolist(), overlap.tolist(),
+                                                                     jaccard.tolist(), cosine.tolist()):
+            if other_id not in friend_ids and pair_overlap < min_overlap:
+                continue
+            for a, b in [(user_id, other_id), (other_id, user_id)]:
+                records.append({"user_id": a, "other_user_id": b, "overlap": pair_overlap,
+                                "jaccard": pair_jaccard, "cosine": pair_cosine, "computed": computed})
+
+    kept_ids = {record["other_user_id"] for record in records if record["user_id"] == user_id}
+    stale_ids = [int(other_id) for other_id in other_ids if other_id not in kept_ids]
+    if stale_ids:
+        session.execute(sa.text("DELETE FROM taste_similarity "
+                                "WHERE (user_id = :user_id AND other_user_id = ANY(:stale_ids)) "
+                                "OR (other_user_id = :user_id AND user_id = ANY(:stale_ids))"),
+                        {"user_id": user_id, "stale_ids": stale_ids})
+    if records:
+        session.execute(sa.text("""
+            INSERT INTO taste_similarity (user_id, other_user_id, overlap, jaccard, cosine, computed)
+            VALUES (:user_id, :other_user_id, :overlap, :jaccard, :cosine, :computed)
+            ON CONFLICT (user_id, other_user_id) DO UPDATE
+            SET overlap = excluded.overlap, jaccard = excluded.jaccard, cosine = excluded.cosine,
+                computed = excluded.computed
+        """), records)
+
+    return len(kept_ids)
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="taste-similarity")
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def refresh_user_similarity(user_id: int):
+    """
+    Queue update_user_similarity for a user in the background. A user already waiting in the queue isn't queued
+    twice, so a burst of list changes costs one rescore.
+    :param user_id:
+    :return:
+    """
+    if not TASTE_SIMILARITY_INCREMENTAL:
+        return
+    with _pending_lock:
+        if user_id in _pending:
+            return
+        _pending.add(user_id)
+    _executor.submit(_refresh, user_id)
+
+
+def _refresh(user_id: int):
+    with _pending_lock:
+        _pending.discard(user_id)
+    session = Session()
+    try:
+        update_user_similarity(user_id, session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        logger.exception(f"Taste similarity update for user {user_id} failed")
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--all-pairs", action="store_true",
+                        help="also score users who aren't friends, if they have --min-overlap items in common")
+    parser.add_argument("--min-overlap", type=int, default=TASTE_SIMILARITY_MIN_OVERLAP)
+    parser.add_argument("--chunk-size", type=int, default=500000, help="pairs scored per vectorized pass")
+    args = parser.parse_args()
+
+    run(args.all_pairs, args.min_overlap, args.chunk_size)
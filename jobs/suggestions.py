@@ -0,0 +1,289 @@
+"""
+"Suggested for you" from item-item collaborative filtering over everyone's lists. Per media type:
+
+1. Each user's current list (consumption_latest) becomes a row of a sparse user x item matrix, weighted by status, so
+   a finished or in-progress item counts for more than an abandoned one.
+2. Items are compared by the cosine of their columns, a block of items at a time, keeping each item's most similar
+   neighbors only.
+3. A user's score for an item is the sum, over the items on their list, of status weight times similarity. The best
+   items that aren't on their list already are stored in the suggestion table.
+
+Full runs refit the item neighbors and rescore everyone; the neighbors are saved under SUGGESTIONS_MODEL_DIR, and
+incremental runs reuse them to rescore only users whose lists changed since the previous run:
+
+    python -m jobs.suggestions [--incremental] [--media-type book]
+"""
+import argparse
+from datetime import datetime, timedelta
+import io
+import json
+import pathlib
+import time
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from config import SUGGESTIONS_CHANGE_OVERLAP_SECONDS, SUGGESTIONS_MODEL_DIR, SUGGESTIONS_NEIGHBORS, SUGGESTIONS_TOP_N
+from db.helpers import MEDIAS
+from db.session import disable_statement_timeout, engine
+from models.consumption import ConsumptionStatus
+
+# How much an item on a user's list says about their taste, by its current status
+STATUS_WEIGHTS = {
+    ConsumptionStatus.FINISHED.value: 1.0,
+    ConsumptionStatus.CONSUMING.value: 0.8,
+    ConsumptionStatus.WANT_TO_CONSUME.value: 0.4,
+    ConsumptionStatus.ABANDONED.value: 0.1,
+}
+
+FETCH_SIZE = 1000000
+
+
+class ItemNeighbors:
+    """
+    Sparse item x item matrix holding, in row i, the cosine similarity of item i to each of its nearest neighbors.
+    """
+
+    def __init__(self, media_ids: np.ndarray, similarity: sparse.csr_matrix):
+        """
+        :param media_ids: media id of each row and column, sorted
+        :param similarity:
+        """
+        self.media_ids = media_ids
+        self.similarity = similarity
+
+    @classmethod
+    def fit(cls, user_ids: np.ndarray, media_ids: np.ndarray, weights: np.ndarray, neighbors: int,
+            block_size: int = 2000) -> 'ItemNeighbors':
+        users, rows = np.unique(user_ids, return_inverse=True)
+        items, columns = np.unique(media_ids, return_inverse=True)
+        ratings = sparse.csr_matrix((weights, (rows, columns)), shape=(len(users), len(items)), dtype=np.float32)
+
+        norms = np.sqrt(np.asarray(ratings.multiply(ratings).sum(axis=0)).ravel())
+        norms[norms == 0] = 1
+        normalized = (ratings @ sparse.diags(1 / norms)).tocsc()
+        by_item = normalized.T.tocsr()
+
+        blocks = []
+        for start in range(0, len(items), block_size):
+            similarity = (by_item[start:start + block_size] @ normalized).tocsr()
+            blocks.append(_top_k_per_row(similarity, neighbors, exclude_diagonal_offset=start))
+        similarity = sparse.vstack(blocks).tocsr() if blocks else sparse.csr_matrix((0, 0), dtype=np.float32)
+        return cls(items, similarity)
+
+    def recommend(self, user_ids: np.ndarray, media_ids: np.ndarray, weights: np.ndarray, top_n: int,
+                  block_size: int = 5000) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """
+        Score items for each user from the items on their list. Items the model hasn't seen are ignored.
+        :return: per user: user id, suggested media ids and their scores, best first
+        """
+        columns = np.searchsorted(self.media_ids, media_ids)
+        known = columns < len(self.media_ids)
+        known[known] = self.media_ids[columns[known]] == media_ids[known]
+        users, rows = np.unique(user_ids[known], return_inverse=True)
+        ratings = sparse.csr_matrix((weights[known], (rows, columns[known])),
+                                    shape=(len(users), len(self.media_ids)), dtype=np.float32)
+
+        for start in range(0, len(users), block_size):
+            block = ratings[start:start + block_size]
+            scores = (block @ self.similarity).tocsr()
+            for row in range(block.shape[0]):
+                items = scores.indices[scores.indptr[row]:scores.indptr[row + 1]]
+                values = scores.data[scores.indptr[row]:scores.indptr[row + 1]]
+                new = ~np.isin(items, block.indices[block.indptr[row]:block.indptr[row + 1]])
+                items, values = items[new], values[new]
+                if len(values) > top_n:
+                    best = np.argpartition(-values, top_n)[:top_n]
+                    items, values = items[best], values[best]
+                order = np.argsort(-values, kind='stable')
+                yield int(users[start + row]), self.media_ids[items[order]], values[order]
+
+    def save(self, path: pathlib.Path):
+        np.savez(path, media_ids=self.media_ids, data=self.similarity.data, indices=self.similarity.indices,
+                 indptr=self.similarity.indptr, shape=self.similarity.shape)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> 'ItemNeighbors':
+        with np.load(path) as saved:
+            similarity = sparse.csr_matrix((saved['data'], saved['indices'], saved['indptr']),
+                                           shape=tuple(saved['shape']))
+            return cls(saved['media_ids'], similarity)
+
+
+def _top_k_per_row(matrix: sparse.csr_matrix, k: int, exclude_diagonal_offset: int) -> sparse.csr_matrix:
+    """
+    Keep the k largest entries of each row, leaving out each row's own item (column row + exclude_diagonal_offset).
+    """
+    indptr = [0]
+    indices, data = [], []
+    for row in range(matrix.shape[0]):
+        columns = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+        values = matrix.data[matrix.indptr[row]:matrix.indptr[row + 1]]
+        other = columns != row + exclude_diagonal_offset
+        columns, values = columns[other], values[other]
+        if len(values) > k:
+            best = np.argpartition(-values, k)[:k]
+            columns, values = columns[best], values[best]
+        indices.append(columns)
+        data.append(values)
+        indptr.append(indptr[-1] + len(columns))
+    return sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), np.array(indptr)), shape=matrix.shape)
+
+
+def load_ratings(connection, media_type: str,
+                 user_ids: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param connection: DBAPI connection
+    :param media_type: book, movie or tv
+    :param user_ids: only load these users' lists; None for everyone
+    :return: user ids, media ids and status weights of list entries
+    """
+    weights = " ".join(f"WHEN %(status_{i})s THEN {weight}" for i, weight in enumerate(STATUS_WEIGHTS.values()))
+    sql = f"""
+        SELECT user_id, media_id, (CASE status {weights} END)::float8
+        FROM consumption_latest
+        WHERE media_type = %(media_type)s AND status = ANY(%(statuses)s)
+    """
+    params = {f"status_{i}": status for i, status in enumerate(STATUS_WEIGHTS)}
+    params.update({"media_type": media_type, "statuses": list(STATUS_WEIGHTS)})
+    if user_ids is not None:
+        sql += " AND user_id = ANY(%(user_ids)s)"
+        params["user_ids"] = list(user_ids)
+
+    # Server side cursor, so the whole table is never held as Python tuples
+    cursor = connection.cursor(name="suggestion_ratings")
+    cursor.execute(sql, params)
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.float64))
+    cursor.close()
+
+    entries = np.concatenate(chunks) if chunks else np.empty((0, 3))
+    return entries[:, 0].astype(np.int64), entries[:, 1].astype(np.int64), entries[:, 2].astype(np.float32)
+
+
+def database_time(connection) -> datetime:
+    """
+    :return: the database's clock, which list entries are stamped with
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT clock_timestamp()::timestamp")
+    now, = cursor.fetchone()
+    cursor.close()
+    return now
+
+
+def changed_users(connection, media_type: str, since: datetime) -> List[int]:
+    """
+    Users are found by when their list entries were written (consumption_latest.updated) rather than by created, which
+    is the date the user gives (e.g. the "Date Read" of an imported export) and can be long before the entry was
+    written.
+    :return: ids of users with a list entry of the media type written at or after the given time
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT DISTINCT user_id FROM consumption_latest WHERE media_type = %(media_type)s "
+                   "AND updated >= %(since)s",
+                   {"media_type": media_type, "since": since})
+    user_ids = [user_id for user_id, in cursor.fetchall()]
+    cursor.close()
+    return user_ids
+
+
+def write_suggestions(connection, media_type: str, suggestions: Iterator[Tuple[int, np.ndarray, np.ndarray]],
+                      user_ids: Optional[Sequence[int]] = None) -> int:
+    """
+    Replace the stored suggestions of a media type for the given users (everyone if None). Caller commits.
+    :return: number of suggestions written
+    """
+    computed = datetime.utcnow().isoformat()
+    buffer = io.StringIO()
+    count = 0
+    for user_id, media_ids, scores in suggestions:
+        for rank, (media_id, score) in enumerate(zip(media_ids.tolist(), scores.tolist()), start=1):
+            buffer.write(f"{user_id}\t{media_type}\t{rank}\t{media_id}\t{score:.6f}\t{computed}\n")
+        count += len(media_ids)
+    buffer.seek(0)
+
+    cursor = connection.cursor()
+    if user_ids is None:
+        cursor.execute("DELETE FROM suggestion WHERE media_type = %(media_type)s", {"media_type": media_type})
+    else:
+        cursor.execute("DELETE FROM suggestion WHERE media_type = %(media_type)s AND user_id = ANY(%(user_ids)s)",
+                       {"media_type": media_type, "user_ids": list(user_ids)})
+    cursor.copy_expert("COPY suggestion (user_id, media_type, rank, media_id, score, computed) FROM STDIN", buffer)
+    cursor.close()
+    return count
+
+
+def run(media_type: str, incremental: bool = False, top_n: int = SUGGESTIONS_TOP_N,
+        neighbors: int = SUGGESTIONS_NEIGHBORS, model_dir: str = SUGGESTIONS_MODEL_DIR):
+    """
+    Recompute suggestions for one media type. An incremental run without a saved model (or with the state of an
+    older version of this job) does a full run instead.
+    """
+    model_dir = pathlib.Path(model_dir)
+    model_path = model_dir / f"{media_type}.npz"
+    state_path = model_dir / f"{media_type}.json"
+    state = json.loads(state_path.read_text()) if state_path.exists() else {}
+    incremental = incremental and model_path.exists() and "lists_read_at" in state
+
+    run_started = datetime.utcnow()
+    timings = {}
+    connection = engine.raw_connection()
+    try:
+        # The whole run is one transaction; lift the pool's statement timeout for it only
+        disable_statement_timeout(connection)
+        # Read before the lists, so entries written while the run loads them are picked up by the next one. An entry
+        # is stamped when it is written but only seen once committed; the overlap covers entries stamped before this
+        # but committed after the lists were read
+        lists_read_at = database_time(connection)
+        started = time.perf_counter()
+        if incremental:
+            model = ItemNeighbors.load(model_path)
+            overlap = timedelta(seconds=SUGGESTIONS_CHANGE_OVERLAP_SECONDS)
+            user_ids = changed_users(connection, media_type, datetime.fromisoformat(state["lists_read_at"]) - overlap)
+            ratings = load_ratings(connection, media_type, user_ids)
+            timings["load"] = time.perf_counter() - started
+        else:
+            user_ids = None
+            ratings = load_ratings(connection, media_type)
+            timings["load"] = time.perf_counter() - started
+            started = time.perf_counter()
+            model = ItemNeighbors.fit(*ratings, neighbors=neighbors)
+            timings["fit"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        count = write_suggestions(connection, media_type, model.recommend(*ratings, top_n=top_n), user_ids)
+        connection.commit()
+        timings["score_and_write"] = time.perf_counter() - started
+    finally:
+        connection.close()
+
+    model_dir.mkdir(parents=True, exist_ok=True)
+    if not incremental:
+        model.save(model_path)
+    state_path.write_text(json.dumps({"last_run_started": run_started.isoformat(),
+                                      "lists_read_at": lists_read_at.isoformat()}))
+
+    users = len(np.unique(ratings[0])) if user_ids is None else len(user_ids)
+    print(f"{media_type}: {'incremental' if incremental else 'full'} run, {len(ratings[0])} list entries, "
+          f"{len(model.media_ids)} items, {users} users rescored, {count} suggestions")
+    print(", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="only rescore users whose lists changed since the last run, with the saved item neighbors")
+    parser.add_argument("--media-type", choices=list(MEDIAS), action="append",
+                        help="repeat for several; all media types by default")
+    parser.add_argument("--top-n", type=int, default=SUGGESTIONS_TOP_N)
+    parser.add_argument("--neighbors", type=int, default=SUGGESTIONS_NEIGHBORS)
+    args = parser.parse_args()
+
+    for media_type in args.media_type or MEDIAS:
+        run(media_type, args.incremental, args.top_n, args.neighbors)
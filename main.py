@@ -1,4 +1,5 @@
 import json
+import math
 import os
 
 from config import DEV_AUTH_CONFIG, PROD_AUTH_CONFIG
@@ -13,17 +14,28 @@ from flask import Flask, request, jsonify, _request_ctx_stack
 from flask_cors import cross_origin
 from jose import jwt
 
+from db.instrumentation import query_instrumentation
+from db.media_metadata import tmdb_tv_details
+from db.session import init_app as init_db_session
 from routes.books import books
 from routes.movies import movies
 from routes.tv import tv
 from routes.user import user
 from routes.friend import friend
+from routes.imports import imports
+from routes.exports import exports
+from routes.metrics import metrics
 from server import auth
+from wrappers.rate_limit import RateLimited
+from wrappers.tmdb import tmdb_client
 
 app = Flask(__name__, static_url_path='/static', static_folder='public')
 app.secret_key = 'very secret key'  # Fix this later!
 
 CORS(app, resources={r"*": {"origins": "*"}})
+init_db_session(app)
+query_instrumentation.init_app(app)
+tmdb_client.use_tv_details_store(tmdb_tv_details.load, tmdb_tv_details.save)
 
 
 app.register_blueprint(auth, url_prefix='/api')
@@ -32,6 +44,9 @@ app.register_blueprint(movies, url_prefix='/api')
 app.register_blueprint(tv, url_prefix='/api')
 app.register_blueprint(user, url_prefix='/api')
 app.register_blueprint(friend, url_prefix='/api')
+app.register_blueprint(imports, url_prefix='/api')
+app.register_blueprint(exports, url_prefix='/api')
+app.register_blueprint(metrics, url_prefix='/api')
 
 @app.route('/auth_config.json')
 def send_json():
@@ -66,6 +81,18 @@ def handle_exception(e):
     response.content_type = "application/json"
     return response
 
+@app.errorhandler(RateLimited)
+def handle_rate_limited(e):
+    """Tell the client to back off when an external provider's quota is used up."""
+    response = jsonify({
+        "code": 503,
+        "name": "Service Unavailable",
+        "description": str(e),
+    })
+    response.status_code = 503
+    response.headers["Retry-After"] = str(math.ceil(e.retry_after))
+    return response
+
 #  main thread of execution to start the server
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=os.getenv("PORT"))
@@ -23,7 +23,8 @@ class Book:
         sa.Column('title', sa.String(200)),
         sa.Column('author_names', sa.ARRAY(sa.String(100))),
         sa.Column('cover_url', sa.String(250)),
-        sa.Column('publish_year', sa.Integer)
+        sa.Column('publish_year', sa.Integer),
+        sa.UniqueConstraint('source', 'source_id', name='uq_book_source_source_id')
     )
 
     # TODO: make author_name a list
@@ -26,7 +26,9 @@ class Consumption:
         sa.Column('media_id', sa.Integer),
         sa.Column('source_id', sa.String(50), index=True),
         sa.Column('status', sa.String(50)),
-        sa.Column('created', sa.DateTime)
+        sa.Column('created', sa.DateTime),
+        sa.Index('ix_consumption_media_type_media_id_user_id', 'media_type', 'media_id', 'user_id'),
+        sa.Index('ix_consumption_user_id_created_id', 'user_id', 'created', 'id')
     )
 
     id: int = field(init=False)
@@ -38,6 +40,38 @@ class Consumption:
     created: datetime
 
 
+@mapper_registry.mapped
+@dataclass_json
+@dataclass
+class ConsumptionLatest:
+    """
+    Current state of each item on a user's lists: the most recent consumption record per user, media type and media
+    item. Kept up to date on every write so reads don't have to find the latest record in the consumption history.
+    """
+    __table__ = sa.Table(
+        'consumption_latest',
+        mapper_registry.metadata,
+        sa.Column('user_id', sa.Integer, sa.ForeignKey(User.id), primary_key=True),
+        sa.Column('media_type', sa.String(50), primary_key=True),
+        sa.Column('media_id', sa.Integer, primary_key=True),
+        sa.Column('consumption_id', sa.Integer, sa.ForeignKey('consumption.id'), nullable=False),
+        sa.Column('source_id', sa.String(50)),
+        sa.Column('status', sa.String(50)),
+        sa.Column('created', sa.DateTime),
+        # when the row was last written (created is the date the user gives); not serialized
+        sa.Column('updated', sa.DateTime, server_default=sa.func.now(), nullable=False),
+        sa.Index('ix_consumption_latest_media_type_media_id', 'media_type', 'media_id')
+    )
+
+    user_id: int
+    media_type: str
+    media_id: int
+    consumption_id: int
+    source_id: str
+    status: str
+    created: datetime
+
+
 class ConsumptionStatus(Enum):
     WANT_TO_CONSUME = "want to consume"
     CONSUMING = "consuming"
@@ -25,7 +25,9 @@ class Friend:
         sa.Column('requester_id', sa.Integer, sa.ForeignKey(User.id)),
         sa.Column('requested_id', sa.Integer, sa.ForeignKey(User.id)),
         sa.Column('status', sa.String(50)),
-        sa.Column('created', sa.DateTime)
+        sa.Column('created', sa.DateTime),
+        sa.Index('ix_friend_requester_id_requested_id_created', 'requester_id', 'requested_id', 'created'),
+        sa.Index('ix_friend_requested_id_requester_id_created', 'requested_id', 'requester_id', 'created')
     )
 
     id: int = field(init=False)
@@ -35,8 +37,37 @@ class Friend:
     created: datetime
 
 
+@mapper_registry.mapped
+@dataclass_json
+@dataclass
+class Friendship:
+    """
+    Current state of each friendship: one row per user and other user, stored in both directions, holding the status
+    of the most recent friend link between the two. Kept up to date on every friend link so reads are a single index
+    lookup instead of a scan of the friend history.
+    """
+    __table__ = sa.Table(
+        'friendship',
+        mapper_registry.metadata,
+        sa.Column('user_id', sa.Integer, sa.ForeignKey(User.id), primary_key=True),
+        sa.Column('friend_id', sa.Integer, sa.ForeignKey(User.id), primary_key=True),
+        sa.Column('requester_id', sa.Integer, sa.ForeignKey(User.id), nullable=False),
+        sa.Column('friend_link_id', sa.Integer, sa.ForeignKey('friend.id'), nullable=False),
+        sa.Column('status', sa.String(50)),
+        sa.Column('created', sa.DateTime),
+        sa.Index('ix_friendship_user_id_status', 'user_id', 'status')
+    )
+
+    user_id: int
+    friend_id: int
+    requester_id: int
+    friend_link_id: int
+    status: str
+    created: datetime
+
+
 class FriendStatus(Enum):
     REQUESTED = "requested"
     ACCEPTED = "accepted"
     REJECTED = "rejected"
-    UNFRIEND = "unfriend"
\ No newline at end of file
+    UNFRIEND = "unfriend"
@@ -0,0 +1,37 @@
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import datetime
+from typing import Dict
+
+from dataclasses_json import dataclass_json
+import sqlalchemy as sa
+from sqlalchemy.orm import registry
+
+mapper_registry = registry()
+
+
+@mapper_registry.mapped
+@dataclass_json
+@dataclass
+class MediaMetadata:
+    """
+    Raw detail payload fetched from an external provider, kept so workers don't have to re-fetch it.
+    """
+    __table__ = sa.Table(
+        'media_metadata',
+        mapper_registry.metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('source', sa.String(50), nullable=False),
+        sa.Column('media_type', sa.String(50), nullable=False),
+        sa.Column('source_id', sa.String(50), nullable=False),
+        sa.Column('payload', sa.JSON, nullable=False),
+        sa.Column('fetched', sa.DateTime, nullable=False),
+        sa.UniqueConstraint('source', 'media_type', 'source_id', name='uq_media_metadata_source_media_type_source_id')
+    )
+
+    id: int = field(init=False)
+    source: str
+    media_type: str
+    source_id: str
+    payload: Dict
+    fetched: datetime
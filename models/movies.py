@@ -23,7 +23,8 @@ class Movie:
         sa.Column('source_id', sa.String(50)),
         sa.Column('title', sa.String(200)),
         sa.Column('poster_url', sa.String(100)),
-        sa.Column('release_date', sa.Date)
+        sa.Column('release_date', sa.Date),
+        sa.UniqueConstraint('source', 'source_id', name='uq_movie_source_source_id')
     )
 
     id: int = field(init=False)
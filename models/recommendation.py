@@ -26,7 +26,11 @@ class Recommendation:
         sa.Column('media_id', sa.Integer),
         sa.Column('source_id', sa.String(50), index=True),
         sa.Column('status', sa.String(50)),
-        sa.Column('created', sa.DateTime)
+        sa.Column('created', sa.DateTime),
+        sa.Index('ix_recommendation_recommended_user_id_media_type_created',
+                 'recommended_user_id', 'media_type', 'created'),
+        sa.Index('ix_recommendation_recommender_user_id_media_type_created',
+                 'recommender_user_id', 'media_type', 'created')
     )
 
     id: int = field(init=False)
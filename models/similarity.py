@@ -0,0 +1,38 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+from dataclasses_json import dataclass_json
+import sqlalchemy as sa
+from sqlalchemy.orm import registry
+
+from models.user import User
+
+mapper_registry = registry()
+
+
+@mapper_registry.mapped
+@dataclass_json
+@dataclass
+class TasteSimilarity:
+    """
+    How similar two users' lists are, over all media types, stored in both directions. Computed in bulk by
+    jobs/similarity.py and refreshed for one user at a time when their list or friends change.
+    """
+    __table__ = sa.Table(
+        'taste_similarity',
+        mapper_registry.metadata,
+        sa.Column('user_id', sa.Integer, sa.ForeignKey(User.id), primary_key=True),
+        sa.Column('other_user_id', sa.Integer, sa.ForeignKey(User.id), primary_key=True),
+        # Number of items on both lists
+        sa.Column('overlap', sa.Integer, nullable=False),
+        sa.Column('jaccard', sa.Float, nullable=False),
+        sa.Column('cosine', sa.Float, nullable=False),
+        sa.Column('computed', sa.DateTime, nullable=False)
+    )
+
+    user_id: int
+    other_user_id: int
+    overlap: int
+    jaccard: float
+    cosine: float
+    computed: datetime
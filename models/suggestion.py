@@ -0,0 +1,37 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+from dataclasses_json import dataclass_json
+import sqlalchemy as sa
+from sqlalchemy.orm import registry
+
+from models.user import User
+
+mapper_registry = registry()
+
+
+@mapper_registry.mapped
+@dataclass_json
+@dataclass
+class Suggestion:
+    """
+    A "suggested for you" item: one of the top items for a user and media type, scored by jobs/suggestions.py from
+    what similar lists contain. Rank 1 is the best suggestion.
+    """
+    __table__ = sa.Table(
+        'suggestion',
+        mapper_registry.metadata,
+        sa.Column('user_id', sa.Integer, sa.ForeignKey(User.id), primary_key=True),
+        sa.Column('media_type', sa.String(50), primary_key=True),
+        sa.Column('rank', sa.Integer, primary_key=True),
+        sa.Column('media_id', sa.Integer, nullable=False),
+        sa.Column('score', sa.Float, nullable=False),
+        sa.Column('computed', sa.DateTime, nullable=False)
+    )
+
+    user_id: int
+    media_type: str
+    rank: int
+    media_id: int
+    score: float
+    computed: datetime
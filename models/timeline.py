@@ -0,0 +1,36 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+from dataclasses_json import dataclass_json
+import sqlalchemy as sa
+from sqlalchemy.orm import registry
+
+from models.consumption import Consumption
+from models.user import User
+
+mapper_registry = registry()
+
+
+@mapper_registry.mapped
+@dataclass_json
+@dataclass
+class TimelineEntry:
+    """
+    One event in a user's precomputed friend feed: a consumption record by the user or one of their friends. Written
+    when the event happens (fan-out on write) so the feed is read from the owner's timeline alone, newest first.
+    """
+    __table__ = sa.Table(
+        'timeline',
+        mapper_registry.metadata,
+        sa.Column('user_id', sa.Integer, sa.ForeignKey(User.id), primary_key=True),
+        sa.Column('consumption_id', sa.Integer, sa.ForeignKey(Consumption.id), primary_key=True),
+        sa.Column('author_id', sa.Integer, sa.ForeignKey(User.id), nullable=False),
+        sa.Column('created', sa.DateTime, nullable=False),
+        sa.Index('ix_timeline_user_id_created_consumption_id', 'user_id', 'created', 'consumption_id'),
+        sa.Index('ix_timeline_user_id_author_id', 'user_id', 'author_id')
+    )
+
+    user_id: int
+    consumption_id: int
+    author_id: int
+    created: datetime
@@ -24,7 +24,8 @@ class TV:
         sa.Column('title', sa.String(200)),
         sa.Column('networks', sa.ARRAY(sa.String(50))),
         sa.Column('poster_url', sa.String(100)),
-        sa.Column('first_air_date', sa.Date)
+        sa.Column('first_air_date', sa.Date),
+        sa.UniqueConstraint('source', 'source_id', name='uq_tv_source_source_id')
     )
 
     id: int = field(init=False)
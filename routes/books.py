@@ -1,8 +1,11 @@
 from flask import jsonify, request, Blueprint
 from flask_cors import cross_origin
 
+from config import BOOK_SEARCH_MODE
+from routes.helpers import search_local_then_external
 from server import requires_auth
-from wrappers.google_books import GoogleBooks
+from wrappers.federated_books import federated_book_search
+from wrappers.google_books import google_books_client
 
 books = Blueprint("books", __name__)
 
@@ -13,8 +16,9 @@ books = Blueprint("books", __name__)
 def search_books():
     args = request.args
     title = args.get('title', None)
+    mode = args.get('mode', BOOK_SEARCH_MODE)
 
-    google_books = GoogleBooks()
-    result = google_books.get_books_by_query(title)
+    external_search = federated_book_search.search if mode == 'federated' else google_books_client.get_books_by_query
+    result = search_local_then_external('book', title, external_search)
     return jsonify(result)
 
@@ -0,0 +1,137 @@
+import csv
+import io
+import json
+from typing import Dict, Iterator, Optional, Tuple
+import zlib
+
+from flask import Response, jsonify, request, stream_with_context, Blueprint
+from flask_cors import cross_origin
+
+from config import EXPORT_BATCH_SIZE, EXPORT_GZIP_LEVEL
+from db.helpers import iter_consumption_history, iter_recommendation_history
+from db.session import request_session
+from routes.helpers import decode_cursor, encode_cursor
+from server import requires_auth
+
+exports = Blueprint("exports", __name__)
+
+# Exported in this order, each oldest first
+SECTIONS = ["consumption", "recommendation"]
+
+CSV_COLUMNS = ["type", "id", "media_type", "media_id", "source_id", "title", "status", "created",
+               "recommender_user_id", "recommended_user_id", "cursor"]
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+@exports.route("/user/<int:user_id>/export", methods=["GET"])
+@cross_origin(headers=["Content-Type", "Authorization"])
+@requires_auth
+def export_history(user_id):
+    """
+    Endpoint for downloading a user's whole history: every consumption record, then every recommendation they made
+    or received, each oldest first. The response is streamed as the rows are read, so it starts right away and the
+    history is never held in memory. It is gzipped on the fly when the client accepts gzip. Query parameters:
+    format: ndjson (default) or csv
+    cursor: the "cursor" of the last record received, to resume an interrupted download after it
+    :param user_id:
+    :return: one record per line, e.g.,
+    {"type": "consumption", "id": 12, "media_type": "book", "media_id": 2, "source_id": "0123",
+     "title": "The Queen Of Nothing", "status": "finished", "created": "2021-03-14T10:00:00", "cursor": "..."}
+    {"type": "recommendation", "id": 3, "media_type": "movie", ..., "recommender_user_id": 1,
+     "recommended_user_id": 2, "cursor": "..."}
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in FORMATS:
+        return jsonify("format must be 'ndjson' or 'csv'"), 400
+
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            after = _decode_export_cursor(cursor)
+        except ValueError:
+            return jsonify("Invalid cursor."), 400
+
+    session = request_session()
+    records = _iter_history(user_id, session, after)
+    chunks = _ndjson_chunks(records) if export_format == 'ndjson' else _csv_chunks(records)
+
+    gzipped = 'gzip' in request.accept_encodings
+    response = Response(stream_with_context(_gzip_chunks(chunks) if gzipped else chunks),
+                        mimetype=FORMATS[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename="history-{user_id}.{export_format}"'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _iter_history(user_id: int, session, after: Optional[Tuple[str, Tuple]]) -> Iterator[Dict]:
+    start = SECTIONS.index(after[0]) if after else 0
+    for section in SECTIONS[start:]:
+        section_after = after[1] if after and after[0] == section else None
+        if section == "consumption":
+            for id, media_type, media_id, source_id, title, status, created in \
+                    iter_consumption_history(user_id, session, EXPORT_BATCH_SIZE, section_after):
+                yield {"type": section, "id": id, "media_type": media_type, "media_id": media_id,
+                       "source_id": source_id, "title": title, "status": status, "created": created.isoformat(),
+                       "cursor": _encode_export_cursor(section, created, id)}
+        else:
+            for id, recommender_user_id, recommended_user_id, media_type, media_id, source_id, title, status, \
+                    created in iter_recommendation_history(user_id, session, EXPORT_BATCH_SIZE, section_after):
+                yield {"type": section, "id": id, "media_type": media_type, "media_id": media_id,
+                       "source_id": source_id, "title": title, "status": status, "created": created.isoformat(),
+                       "recommender_user_id": recommender_user_id, "recommended_user_id": recommended_user_id,
+                       "cursor": _encode_export_cursor(section, created, id)}
+
+
+def _ndjson_chunks(records: Iterator[Dict]) -> Iterator[str]:
+    # One chunk per fetched batch: fewer, larger writes than a chunk per line
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record) + "\n")
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def _csv_chunks(records: Iterator[Dict]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    rows = 0
+    for record in records:
+        writer.writerow(record)
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _gzip_chunks(chunks: Iterator[str]) -> Iterator[bytes]:
+    # gzip container (wbits 16+), flushed after every chunk so the client can decompress as it goes
+    compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def _encode_export_cursor(section: str, created, id: int) -> str:
+    return f"{section}.{encode_cursor(created, id)}"
+
+
+def _decode_export_cursor(cursor: str) -> Tuple[str, Tuple]:
+    """
+    :return: (section, (created, id))
+    :raises ValueError: if the cursor wasn't made by _encode_export_cursor
+    """
+    section, _, position = cursor.partition(".")
+    if section not in SECTIONS:
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    return section, decode_cursor(position)
@@ -4,20 +4,17 @@ from flask_cors import cross_origin
 from pyhocon import ConfigFactory
 
 from flask import jsonify, request, Blueprint
-import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker
 
-from db.helpers import get_user_friends, get_user_friend_requests
+from db.helpers import get_taste_similarities, get_user_friends, get_user_friend_requests, record_friend_link
+from db.session import request_session
+from db.timeline import timeline_fanout
+from jobs.similarity import refresh_user_similarity
 from models.friend import Friend, FriendStatus
 from models.user import User
 from server import requires_auth
-from config import DATABASE_URL
 
 friend = Blueprint("friend", __name__)
 
-engine = sa.create_engine(DATABASE_URL, echo=True)
-Session = sessionmaker(bind=engine)
-
 
 @friend.route("/friend", methods=["POST"])
 @cross_origin(headers=["Content-Type", "Authorization"])
@@ -32,7 +29,7 @@ def add_friend_link():
     }
     :return:
     """
-    session = Session()
+    session = request_session()
 
     request_body = request.get_json()
 
@@ -52,9 +49,13 @@ def add_friend_link():
 
     # Add friend to DB
     session.add(friend)
+    session.flush()
+    record_friend_link(friend, session)
     friend_json = friend.to_json()
+    requester_id, requested_id = friend.requester_id, friend.requested_id
     session.commit()
-    session.close()
+    timeline_fanout.sync_friendship(requester_id, requested_id)
+    refresh_user_similarity(requester_id)
 
     return friend_json, 200
 
@@ -68,9 +69,8 @@ def get_friends(user_id):
     :param user_id:
     :return:
     """
-    session = Session()
+    session = request_session()
     user_results = get_user_friends(user_id, session)
-    session.close()
     return User.schema().dumps(user_results, many=True)
 
 
@@ -83,8 +83,40 @@ def get_friend_requests(user_id):
     :param user_id:
     :return:
     """
-    session = Session()
+    session = request_session()
     user_results = get_user_friend_requests(user_id, session)
-    session.close()
     return User.schema().dumps(user_results, many=True)
 
+
+@friend.route("/user/<int:user_id>/similarity", methods=["GET"])
+@cross_origin(headers=["Content-Type", "Authorization"])
+@requires_auth
+def get_taste_matches(user_id):
+    """
+    Get the users with the most similar taste to a user's, by the share of list items they have in common. Query
+    params: all=true to include users who aren't friends yet, limit (default 100).
+    :param user_id:
+    :return: Most similar first, e.g.,
+    [{
+        "user": {"id": 7, "full_name": "zoe fakename", ...},
+        "taste_match": 72,
+        "overlap": 100,
+        "jaccard": 0.52,
+        "cosine": 0.72
+    }]
+    """
+    friends_only = request.args.get('all', 'false').lower() != 'true'
+    limit = request.args.get('limit', 100, type=int)
+
+    session = request_session()
+    results = get_taste_similarities(user_id, friends_only, limit, session)
+
+    final = []
+    for similarity, other_user in results:
+        final.append({"user": other_user.to_dict(),
+                      "taste_match": round(similarity.cosine * 100),
+                      "overlap": similarity.overlap,
+                      "jaccard": similarity.jaccard,
+                      "cosine": similarity.cosine})
+
+    return jsonify(final), 200
@@ -1,4 +1,16 @@
+import base64
 from datetime import datetime
+import json
+import logging
+from typing import Callable, List, Tuple
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from config import LOCAL_SEARCH_ENABLED, LOCAL_SEARCH_MIN_RESULTS, LOCAL_SEARCH_LIMIT, LOCAL_SEARCH_POPULARITY_WEIGHT
+from db.helpers import search_local_media
+from db.session import request_session
+
+logger = logging.getLogger(__name__)
 
 
 def get_time_diff_hrs(created: datetime) -> int:
@@ -9,3 +21,57 @@ def get_time_diff_hrs(created: datetime) -> int:
     """
     diff = datetime.utcnow() - created
     return round(diff.total_seconds() / 60 / 60)
+
+
+def encode_cursor(created: datetime, id: int) -> str:
+    """
+    Opaque cursor for keyset pagination, pointing just past the given row.
+    :param created:
+    :param id:
+    :return: url-safe string
+    """
+    return base64.urlsafe_b64encode(json.dumps([created.isoformat(), id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Inverse of encode_cursor.
+    :param cursor:
+    :return: (created, id)
+    :raises ValueError: if the cursor wasn't made by encode_cursor
+    """
+    try:
+        created, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created), int(id)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor {cursor!r}") from e
+
+
+def search_local_then_external(media_type: str, query: str, external_search: Callable[[str], List]) -> List:
+    """
+    Search our own catalog first, and only go to the external API when the catalog has fewer than
+    LOCAL_SEARCH_MIN_RESULTS matches. External results that are already in the catalog are dropped.
+    :param media_type: book, movie or tv
+    :param query: search string
+    :param external_search: wrapper search method
+    :return: list of media objects, local matches first
+    """
+    if not LOCAL_SEARCH_ENABLED or not query:
+        return external_search(query)
+
+    session = request_session()
+    try:
+        local_results = search_local_media(media_type, query, LOCAL_SEARCH_LIMIT, LOCAL_SEARCH_POPULARITY_WEIGHT,
+                                           session)
+    except SQLAlchemyError:
+        logger.exception(f"Local {media_type} search failed, falling back to the external API")
+        # leave the request session usable for the rest of the request
+        session.rollback()
+        return external_search(query)
+
+    if len(local_results) >= LOCAL_SEARCH_MIN_RESULTS:
+        return local_results
+
+    local_keys = {(media.source, media.source_id) for media in local_results}
+    return local_results + [media for media in external_search(query)
+                            if (media.source, media.source_id) not in local_keys]
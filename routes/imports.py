@@ -0,0 +1,54 @@
+import csv
+import io
+import json
+
+from flask import Response, jsonify, request, stream_with_context, Blueprint
+from flask_cors import cross_origin
+
+from config import IMPORT_BATCH_SIZE
+from db.session import request_session
+from importers.formats import detect_format, parse_rows
+from importers.pipeline import import_rows
+from jobs.similarity import refresh_user_similarity
+from models.consumption import ConsumptionStatus
+from server import requires_auth
+
+imports = Blueprint("imports", __name__)
+
+
+@imports.route("/user/<int:user_id>/import", methods=["POST"])
+@cross_origin(headers=["Content-Type", "Authorization"])
+@requires_auth
+def import_list(user_id):
+    """
+    Endpoint for importing a Goodreads, Letterboxd or IMDb CSV export into a user's lists. The file is either the
+    "file" field of a multipart upload or the raw request body, and is read a batch of rows at a time. Query
+    parameters:
+    status: status for every row, e.g. 'want to consume' for a Letterboxd watchlist; by default the export's shelf,
+    rating or list decides
+    :param user_id:
+    :return: Newline-delimited JSON, one line of running totals per batch and a last one with "done", e.g.,
+    {"rows": 500, "imported": 480, "already_on_list": 0, "added_to_catalog": 35, "unmatched": 12, "skipped": 8}
+    ...
+    {"rows": 5000, "imported": 4790, ..., "done": true, "unmatched_titles": [{"line": 17, "title": "..."}, ...]}
+    """
+    status = request.args.get('status')
+    if status is not None and status not in [v.value for v in ConsumptionStatus]:
+        return jsonify("status must be 'want to consume', 'consuming', 'finished', or 'abandoned'"), 400
+
+    upload = request.files.get('file')
+    reader = csv.DictReader(io.TextIOWrapper(upload.stream if upload else request.stream, encoding='utf-8-sig',
+                                             newline=''))
+    try:
+        export_format = detect_format(reader.fieldnames or [])
+    except ValueError as e:
+        return jsonify(str(e)), 400
+
+    session = request_session()
+
+    def generate():
+        for progress in import_rows(user_id, parse_rows(reader, export_format, status), session, IMPORT_BATCH_SIZE):
+            yield json.dumps(progress) + "\n"
+        refresh_user_similarity(user_id)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
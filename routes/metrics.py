@@ -0,0 +1,73 @@
+from flask import jsonify, Blueprint
+from flask_cors import cross_origin
+
+from db.instrumentation import query_instrumentation
+from db.session import engine, replicas
+from db.timeline import timeline_fanout
+from server import requires_auth, jwks_store, verified_tokens
+from wrappers import google_books, open_lib, tmdb
+from wrappers.federated_books import federated_book_search
+from wrappers.google_books import google_books_client
+from wrappers.open_lib import open_library_client
+from wrappers.tmdb import tmdb_client
+
+metrics = Blueprint("metrics", __name__)
+
+
+@metrics.route("/metrics", methods=["GET"])
+@cross_origin(headers=["Content-Type", "Authorization"])
+@requires_auth
+def get_metrics():
+    """
+    Endpoint for checking the in-process caches and connection pools of this worker.
+    :return: Counters keyed by component, e.g.,
+    {
+        "jwks": {"hits": 120, "misses": 0, "refreshes": 1, ...},
+        "verified_tokens": {"size": 12, "hits": 108, "misses": 12, "hit_ratio": 0.9, ...},
+        "http_pools": {"tmdb": {"https://api.themoviedb.org/3": {"connections_opened": 2, "requests": 40,
+                                                                 "reuse_rate": 0.95, ...}}, ...},
+        "search_cache": {"tmdb": {"fresh_hits": 30, "stale_hits": 2, "misses": 8, "hit_ratio": 0.8,
+                                  "mean_served_age_seconds": 95.2, ...}, ...},
+        "tv_networks_cache": {"size": 480, "hits": 1900, "misses": 480, ...},
+        "book_providers": {"open_library": {"calls": 50, "timeouts": 3, "p95_latency_ms": 2400.5, ...}, ...},
+        "rate_limits": {"tmdb": {"tokens": 31.5, "delayed": 4, "rejected": 0, "pauses": 1, ...}, ...},
+        "timeline_fanout": {"enabled": true, "pending": 0, "completed": 310, "failed": 0, ...},
+        "db_pool": {"size": 10, "checked_out": 2, "checkouts": 5400, "mean_wait_ms": 0.02, "timeouts": 0,
+                    "leaks": 0, ...},
+        "db_replicas": [{"healthy": true, "lag_seconds": 0.4, "reads": 900, "pool": {...}, ...}]
+    }
+    """
+    return jsonify({"jwks": jwks_store.stats(),
+                    "verified_tokens": verified_tokens.stats(),
+                    "http_pools": {"tmdb": tmdb_client.pool_stats(),
+                                   "google_books": google_books_client.pool_stats(),
+                                   "open_library": open_library_client.pool_stats()},
+                    "search_cache": {"tmdb": tmdb.search_cache.stats(),
+                                     "google_books": google_books.search_cache.stats()},
+                    "tv_networks_cache": tmdb.tv_networks_cache.stats(),
+                    "book_providers": federated_book_search.stats(),
+                    "rate_limits": {"tmdb": tmdb.rate_limiter.stats(),
+                                    "google_books": google_books.rate_limiter.stats(),
+                                    "open_library": open_lib.rate_limiter.stats()},
+                    "timeline_fanout": timeline_fanout.stats(),
+                    "db_pool": engine.pool.stats(),
+                    "db_replicas": replicas.stats()}), 200
+
+
+@metrics.route("/metrics/queries", methods=["GET"])
+@cross_origin(headers=["Content-Type", "Authorization"])
+@requires_auth
+def get_query_metrics():
+    """
+    Endpoint for the SQL each endpoint of this worker runs, when SQL_INSTRUMENTATION_ENABLED is set.
+    :return: Totals per endpoint and the most recent requests, e.g.,
+    {
+        "enabled": true,
+        "endpoints": {"user.get_friend_events": {"requests": 12, "statements": 48, "db_ms": 60.2, "n_plus_one": 0}},
+        "recent": [{"method": "GET", "path": "/api/user/1/feed", "status": 200, "statements": 4, "db_ms": 5.1,
+                    "slowest": {"statement": "SELECT ...", "ms": 2.3, "plan": null}, "n_plus_one": []}, ...]
+    }
+    """
+    if not query_instrumentation.enabled:
+        return jsonify("SQL instrumentation is disabled; set SQL_INSTRUMENTATION_ENABLED=true."), 404
+    return jsonify(query_instrumentation.stats()), 200
@@ -3,8 +3,9 @@ from flask import request, Blueprint
 from flask_cors import cross_origin
 
 from models.movies import Movie
+from routes.helpers import search_local_then_external
 from server import requires_auth
-from wrappers.tmdb import TMDB
+from wrappers.tmdb import tmdb_client
 
 movies = Blueprint("movies", __name__)
 
@@ -16,7 +17,6 @@ def search_movies():
     args = request.args
     title = args.get('title', None)
 
-    tmdb = TMDB()
-    result = tmdb.get_movies_by_title(title)
+    result = search_local_then_external('movie', title, tmdb_client.get_movies_by_title)
     result = sorted(result, key=lambda m: date(1900, 1, 1) if not m.release_date else m.release_date, reverse=True)
     return Movie.schema().dumps(result, many=True)
@@ -4,8 +4,9 @@ from flask import request, Blueprint
 from flask_cors import cross_origin
 
 from models.tv import TV
+from routes.helpers import search_local_then_external
 from server import requires_auth
-from wrappers.tmdb import TMDB
+from wrappers.tmdb import tmdb_client
 
 tv = Blueprint("tv", __name__)
 
@@ -17,7 +18,6 @@ def search_tv():
     args = request.args
     title = args.get('title', None)
 
-    tmdb = TMDB()
-    result = tmdb.get_tv_by_title(title)
+    result = search_local_then_external('tv', title, tmdb_client.get_tv_by_title)
     result = sorted(result, key=lambda m: date(1900, 1, 1) if not m.first_air_date else m.first_air_date, reverse=True)
     return TV.schema().dumps(result, many=True)
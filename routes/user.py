@@ -3,25 +3,26 @@ from pyhocon import ConfigFactory
 from datetime import datetime, date
 
 from flask import current_app, jsonify, request, Blueprint
-import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker
 from werkzeug.exceptions import abort
 
-from config import DATABASE_URL
+from config import FEED_PAGE_SIZE, FEED_MAX_PAGE_SIZE, USER_SEARCH_PAGE_SIZE, USER_SEARCH_MAX_PAGE_SIZE
 
 from models.consumption import Consumption, ConsumptionStatus
 from models.recommendation import RecommendationStatus, Recommendation
 from models.user import User
-from db.helpers import MEDIAS, get_consumption_records, get_users_and_friend_statuses, \
-    get_records_recommended_by_user, get_records_recommended_to_user, get_overlapping_records, get_friend_event_records
-from routes.helpers import get_time_diff_hrs
+from db.helpers import MEDIAS, get_consumption_records, get_friend_statuses, search_users, \
+    get_records_recommended_by_user, get_records_recommended_to_user, get_overlapping_records, \
+    get_friend_event_records, get_media_metadata, get_overlaps_with_friends, get_suggested_records, \
+    get_timeline_records, record_latest_consumption, upsert_media
+from db.session import request_session
+from db.timeline import timeline_fanout
+from jobs.similarity import refresh_user_similarity
+from routes.helpers import decode_cursor, encode_cursor
 from server import requires_auth
+from wrappers.tmdb import TMDB
 
 user = Blueprint("user", __name__)
 
-engine = sa.create_engine(DATABASE_URL, echo=True)
-Session = sessionmaker(bind=engine)
-
 
 @user.route("/user", methods=["POST"])
 @cross_origin(headers=["Content-Type", "Authorization"])
@@ -40,7 +41,7 @@ def verify_user():
     """
     request_body = request.get_json()
 
-    session = Session()
+    session = request_session()
     try:
         user = User.from_dict(request_body)
     except KeyError:
@@ -57,8 +58,6 @@ def verify_user():
         session.commit()
         db_resp = session.query(User).filter_by(auth0_sub=user.auth0_sub).first()
 
-    session.close()
-
     return db_resp.to_json()
 
 
@@ -71,53 +70,75 @@ def get_user(user_id):
     :param user_id:
     :return: User object
     """
-    session = Session()
+    session = request_session()
     user_result = session.query(User).filter_by(id=user_id).first()
-    session.close()
     if not user_result:
         abort(404, description=f"user (id {user_id}) does not exist")
     return user_result.to_json()
 
 
 @user.route("/users", methods=["GET"])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@cross_origin(headers=["Content-Type", "Authorization"], expose_headers=["X-Next-Cursor"])
 @requires_auth
 def get_user_and_status_by_email():
     """
-    Search for a user by email and with user ID of user conducting the search. User record and status of friendship
-    between user conducting the search and user associated with email.
+    Search for users by email or name, with user ID of user conducting the search. User records and status of
+    friendship between user conducting the search and each user found, a page at a time. Query parameters:
+    q: search string (email is accepted too); three or more characters match anywhere, fewer match the start
+    user_id: user conducting the search
+    limit: page size (default USER_SEARCH_PAGE_SIZE, at most USER_SEARCH_MAX_PAGE_SIZE)
+    cursor: the X-Next-Cursor header of the previous page; omit for the first page
+    The X-Next-Cursor response header is only set when there may be more users.
     :return: Example
-    {
-        "id": 1,
-        "auth0_sub": "123",
-        "first_name": "zoe"
-        "last_name": "fakename",
-        "full_name": "zoe fakename",
-        "email": "zoefakename@yahoo.com",
-        "created": 1611190613.837367,
-        "picture": "zoefakename.jpg",
+    [{
+        "user": {
+            "id": 1,
+            "auth0_sub": "123",
+            "first_name": "zoe"
+            "last_name": "fakename",
+            "full_name": "zoe fakename",
+            "email": "zoefakename@yahoo.com",
+            "created": 1611190613.837367,
+            "picture": "zoefakename.jpg"
+        },
         "status": "pending"
-    }
+    }]
     """
     args = request.args
-    # Email search
-    email_substring = args.get('email', '')
+    query = args.get('q', args.get('email', ''))
     # User ID of user conducting the search
-    user_id = args.get('user_id')
-
-    session = Session()
-    user_results = get_users_and_friend_statuses(user_id, email_substring, session)
+    user_id = args.get('user_id', type=int)
+
+    limit = args.get('limit', USER_SEARCH_PAGE_SIZE, type=int)
+    if limit < 1:
+        return jsonify("limit must be a positive integer."), 400
+    limit = min(limit, USER_SEARCH_MAX_PAGE_SIZE)
+
+    after_id = None
+    cursor = args.get('cursor')
+    if cursor:
+        try:
+            after_id = int(cursor)
+        except ValueError:
+            return jsonify("Invalid cursor."), 400
+
+    session = request_session()
+    users = search_users(user_id, query, limit, after_id, session)
+    # Friendship statuses for this page only
+    statuses = get_friend_statuses(user_id, [user.id for user in users], session)
 
     final = []
-    for user, status in user_results:
+    for user in users:
         record = dict()
         record['user'] = user.to_dict()
-        # Status of friendship between searching user and the user associated with the email
-        record['status'] = status
+        # Status of friendship between searching user and the user found
+        record['status'] = statuses.get(user.id)
         final.append(record)
-    session.close()
 
-    return jsonify(final)
+    response = jsonify(final)
+    if len(users) == limit:
+        response.headers['X-Next-Cursor'] = str(users[-1].id)
+    return response
 
 
 @user.route("/user/<int:user_id>/media/<media_type>", methods=["POST"])
@@ -139,7 +160,7 @@ def add_media_to_profile(user_id, media_type):
     :param media_type: book, movie or tv
     :return:
     """
-    session = Session()
+    session = request_session()
 
     request_body = request.get_json()
     status = request_body.get('status')
@@ -150,24 +171,19 @@ def add_media_to_profile(user_id, media_type):
               description="Request body needs a status of 'want to consume', 'consuming', 'finished', or 'abandoned'")
     request_body.pop('status')
 
+    # Shows found through search already have their details stored, so fill in networks without calling TMDB
+    if media_type == 'tv' and not request_body.get('networks'):
+        stored = get_media_metadata('tmdb', 'tv', [request_body.get('source_id')], session)
+        details = stored.get(request_body.get('source_id'))
+        request_body['networks'] = TMDB.networks_from_tv_details(details) if details else []
+
     try:
         media_item = media_class.from_dict(request_body)
     except KeyError:
         abort(400, description="object is missing required fields")
 
-    # check if media item is in database
-    db_resp = session.query(media_class).filter_by(source_id=media_item.source_id).first()
-
-    # if not in database, add media item to appropriate table
-    if not db_resp:
-        current_app.logger.info(
-            f"Media not in database, adding media with source_id {media_item.source_id} to database")
-        session.add(media_item)
-        session.flush()
-        media_id = media_item.id
-
-    else:
-        media_id = db_resp.id
+    # add media item to appropriate table unless it's there already
+    media_id = upsert_media(media_type, [media_item], session)[(media_item.source, media_item.source_id)]
 
     current_app.logger.info(
         f"Recording media with source_id {media_item.source_id} in consumption table {user_id} with status {status} (user id {user_id})")
@@ -180,9 +196,13 @@ def add_media_to_profile(user_id, media_type):
                                   created=datetime.utcnow())
 
     session.add(consumption_rec)
+    session.flush()
+    record_latest_consumption(consumption_rec, session)
     consumption_resp = consumption_rec.to_json()
+    consumption_id = consumption_rec.id
     session.commit()
-    session.close()
+    timeline_fanout.fan_out([consumption_id])
+    refresh_user_similarity(user_id)
     return consumption_resp, 200
 
 
@@ -208,18 +228,17 @@ def get_consumed_media_by_media_type(user_id, media_type):
         "title": "The Queen Of Nothing"
     }]
     """
-    session = Session()
+    session = request_session()
     record_results = get_consumption_records(user_id, media_type, session)
 
     result = []
     for consumption, media in record_results:
         c = consumption.to_dict()
-        # Remove id, media_id, and user_id associated with consumption as not necessary
-        c.pop('id'), c.pop('media_id'), c.pop('user_id'), c.pop('media_type'), c.pop('created')
+        # Remove ids and media_type associated with consumption as not necessary
+        c.pop('consumption_id'), c.pop('media_id'), c.pop('user_id'), c.pop('media_type'), c.pop('created')
         c.update(media.to_dict())
         result.append(c)
 
-    session.close()
     return jsonify(result), 200
 
 
@@ -238,7 +257,7 @@ def add_recommended_media(media_type):
     :param media_type: book, movie or tv
     :return: Recommendation object
     """
-    session = Session()
+    session = request_session()
 
     request_body = request.get_json()
     status = request_body.get('status')
@@ -264,7 +283,6 @@ def add_recommended_media(media_type):
     session.add(rec)
     rec_json = rec.to_json()
     session.commit()
-    session.close()
     return rec_json, 200
 
 
@@ -294,7 +312,7 @@ def get_media_recommended_to_user(user_id, media_type):
         "recommender_full_name": "Aaron Strick"
     }]
     """
-    session = Session()
+    session = request_session()
 
     final = []
     record_results = get_records_recommended_to_user(user_id, media_type, session)
@@ -308,7 +326,6 @@ def get_media_recommended_to_user(user_id, media_type):
                         'created': recommendation.created}
         final.append(media_result)
 
-    session.close()
     return jsonify(sorted(final, key=lambda m: m.get('created'), reverse=True)), 200
 
 
@@ -336,7 +353,7 @@ def get_media_recommended_by_user(user_id, media_type):
         "recommended_full_name": "full_name"
     },
     """
-    session = Session()
+    session = request_session()
 
     final = []
     record_results = get_records_recommended_by_user(user_id, media_type, session)
@@ -349,10 +366,47 @@ def get_media_recommended_by_user(user_id, media_type):
                         'created': recommendation.created}
         final.append(media_result)
 
-    session.close()
     return jsonify(sorted(final, key=lambda m: m.get('created'), reverse=True)), 200
 
 
+@user.route("/user/<int:user_id>/suggestions/<media_type>", methods=["GET"])
+@cross_origin(headers=["Content-Type", "Authorization"])
+@requires_auth
+def get_media_suggested_to_user(user_id, media_type):
+    """
+    Endpoint for getting "suggested for you" media, picked from what users with similar lists have on theirs.
+    :param user_id:
+    :param media_type: book, movie or tv
+    :return: List of media object + media_type + score, best first, e.g.,
+    [{
+        "media": {"author_names": [
+                    "Holly Black"
+                    ],
+                    "cover_url": "http://covers.openlibrary.org/b/id/10381918-M.jpg",
+                    "id": 2,
+                    "publish_year": 2020,
+                    "source": "open library",
+                    "source_id": "0123",
+                    "title": "The Queen Of Nothing"},
+        "media_type": "book",
+        "score": 2.31
+    }]
+    """
+    if media_type not in MEDIAS.keys():
+        abort(400, "Media_type must be 'book', 'movie', or tv")
+
+    session = request_session()
+    record_results = get_suggested_records(user_id, media_type, session)
+
+    final = []
+    for suggestion, media_class in record_results:
+        final.append({'media': media_class.to_dict(),
+                      'media_type': media_type,
+                      'score': suggestion.score})
+
+    return jsonify(final), 200
+
+
 @user.route("/overlaps/<media_type>/<int:primary_user_id>/<int:other_user_id>", methods=["GET"])
 @cross_origin(headers=["Content-Type", "Authorization"])
 @requires_auth
@@ -385,9 +439,8 @@ def get_overlapping_media(media_type, primary_user_id, other_user_id):
     if media_type not in MEDIAS.keys():
         abort(400, "Media_type must be 'book', 'movie', or tv")
 
-    session = Session()
+    session = request_session()
     record_results = get_overlapping_records(primary_user_id, other_user_id, media_type, session)
-    session.close()
 
     final = []
     for record in record_results:
@@ -407,12 +460,63 @@ def get_overlapping_media(media_type, primary_user_id, other_user_id):
     return jsonify(sorted(final, key=lambda m: m.get('media').get('title'))), 200
 
 
-@user.route("/user/<int:user_id>/friend/events", methods=["GET"])
+@user.route("/overlaps/<media_type>/<int:user_id>", methods=["GET"])
 @cross_origin(headers=["Content-Type", "Authorization"])
 @requires_auth
+def get_overlapping_media_with_friends(media_type, user_id):
+    """
+    Endpoint for getting overlapping media between a user and every one of their friends in one call. Friends with
+    nothing in common are left out.
+    :param media_type:
+    :param user_id:
+    :return: Overlapping media ids and statuses by friend id, and each overlapping media object once, e.g.,
+    {
+        "media_type": "book",
+        "friends": {
+            "7": {"count": 1,
+                  "overlaps": [{"media_id": 2, "status": "consuming", "other_user_status": "finished"}]}
+        },
+        "media": {
+            "2": {"author_names": ["Holly Black"],
+                  "cover_url": "http://covers.openlibrary.org/b/id/10381918-M.jpg",
+                  "id": 2,
+                  "publish_year": 2020,
+                  "source": "open library",
+                  "source_id": "0123",
+                  "title": "The Queen Of Nothing"}
+        }
+    }
+    """
+    media_class = MEDIAS.get(media_type)
+    if not media_class:
+        abort(400, "Media_type must be 'book', 'movie', or tv")
+
+    session = request_session()
+    overlaps = get_overlaps_with_friends(user_id, media_type, session)
+
+    friends = {}
+    for friend_id, media_id, status, other_user_status in overlaps:
+        friend = friends.setdefault(friend_id, {"count": 0, "overlaps": []})
+        friend["count"] += 1
+        friend["overlaps"].append({"media_id": media_id, "status": status, "other_user_status": other_user_status})
+
+    media_ids = {media_id for _, media_id, _, _ in overlaps}
+    media = session.query(media_class).filter(media_class.id.in_(media_ids)).all() if media_ids else []
+    media_json = {m.id: m.to_dict() for m in media}
+
+    return jsonify({"media_type": media_type, "friends": friends, "media": media_json}), 200
+
+
+@user.route("/user/<int:user_id>/friend/events", methods=["GET"])
+@cross_origin(headers=["Content-Type", "Authorization"], expose_headers=["X-Next-Cursor"])
+@requires_auth
 def get_friend_events(user_id):
     """
-    Endpoint for getting all events associated with a user's friends.
+    Endpoint for getting events by a user and their friends, newest first, a page at a time. Query params:
+    limit: page size (default FEED_PAGE_SIZE, at most FEED_MAX_PAGE_SIZE)
+    cursor: the X-Next-Cursor header of the previous page; omit for the first page
+    The X-Next-Cursor response header is only set when there may be more events. With FEED_FANOUT_ENABLED the
+    events come from the user's timeline, so paging stops after the newest FEED_TIMELINE_MAX_LENGTH.
     :param user_id:
     :return: media object + status, e.g.,
     {
@@ -433,25 +537,45 @@ def get_friend_events(user_id):
         "created" : datetime
     },
     """
-    session = Session()
-    record_results = get_friend_event_records(user_id, session)
+    limit = request.args.get('limit', FEED_PAGE_SIZE, type=int)
+    if limit < 1:
+        return jsonify("limit must be a positive integer."), 400
+    limit = min(limit, FEED_MAX_PAGE_SIZE)
+
+    before = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            before = decode_cursor(cursor)
+        except ValueError:
+            return jsonify("Invalid cursor."), 400
+
+    session = request_session()
+    if timeline_fanout.enabled:
+        record_results = get_timeline_records(user_id, session, limit, before)
+    else:
+        record_results = get_friend_event_records(user_id, session, limit, before)
 
     final_results = []
-    for media_set in record_results:
-        for media_class, consumption_class, user_class in media_set:
-            m = media_class.to_dict()
-            media_result = {'media': m,
-                            "media_type": consumption_class.media_type,
-                            'user_id': user_class.id,
-                            'full_name': user_class.full_name,
-                            'status': consumption_class.status,
-                            'created': consumption_class.created,
-                            'time_since': get_time_diff_hrs(consumption_class.created)}
-
-            final_results.append(media_result)
-
-    session.close()
-    return jsonify(sorted(final_results, key=lambda m: m.get('time_since'))), 200
+    for media_class, consumption_class, full_name, time_since in record_results:
+        if media_class is None:
+            continue
+        m = media_class.to_dict()
+        media_result = {'media': m,
+                        "media_type": consumption_class.media_type,
+                        'user_id': consumption_class.user_id,
+                        'full_name': full_name,
+                        'status': consumption_class.status,
+                        'created': consumption_class.created,
+                        'time_since': time_since}
+
+        final_results.append(media_result)
+
+    response = jsonify(final_results)
+    if len(record_results) == limit:
+        last = record_results[-1][1]
+        response.headers['X-Next-Cursor'] = encode_cursor(last.created, last.id)
+    return response, 200
 
 
 
@@ -0,0 +1,38 @@
+"""
+This script fills the consumption_latest table from the consumption history. Run it once after migrating; it is
+safe to re-run, and only ever moves a row forward to a newer consumption record.
+"""
+import pathlib
+import sys
+
+import sqlalchemy as sa
+
+sys.path.append(pathlib.Path(__file__).parent.parent.absolute().as_posix())
+from config import DATABASE_URL
+
+BACKFILL_SQL = """
+INSERT INTO consumption_latest (user_id, media_type, media_id, consumption_id, source_id, status, created)
+SELECT DISTINCT ON (user_id, media_type, media_id)
+       user_id, media_type, media_id, id, source_id, status, created
+FROM consumption
+WHERE user_id IS NOT NULL AND media_id IS NOT NULL AND media_type IS NOT NULL
+ORDER BY user_id, media_type, media_id, created DESC, id DESC
+ON CONFLICT (user_id, media_type, media_id) DO UPDATE
+SET consumption_id = excluded.consumption_id,
+    source_id = excluded.source_id,
+    status = excluded.status,
+    created = excluded.created,
+    updated = clock_timestamp()
+WHERE consumption_latest.created IS NULL OR consumption_latest.created <= excluded.created
+"""
+
+
+def backfill():
+    engine = sa.create_engine(DATABASE_URL)
+    with engine.begin() as connection:
+        result = connection.execute(sa.text(BACKFILL_SQL))
+    print(f"Upserted {result.rowcount} consumption_latest rows")
+
+
+if __name__ == '__main__':
+    backfill()
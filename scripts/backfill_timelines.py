@@ -0,0 +1,56 @@
+"""
+This script fills every user's feed timeline with the newest events by them and their friends, then trims each to
+FEED_TIMELINE_MAX_LENGTH. Run it before setting FEED_FANOUT_ENABLED, and again to repair timelines after fan-out jobs
+were lost; it only adds missing entries, so it is safe to re-run while the app is serving.
+"""
+import pathlib
+import sys
+
+import sqlalchemy as sa
+
+sys.path.append(pathlib.Path(__file__).parent.parent.absolute().as_posix())
+from config import DATABASE_URL, FEED_TIMELINE_MAX_LENGTH
+
+BACKFILL_SQL = [
+    """
+    INSERT INTO timeline (user_id, consumption_id, author_id, created)
+    SELECT feed.user_id, events.id, events.user_id, events.created
+    FROM (
+        SELECT user_id, friend_id AS author_id FROM friendship WHERE status = 'accepted'
+        UNION ALL
+        SELECT id AS user_id, id AS author_id FROM "user"
+    ) feed
+    CROSS JOIN LATERAL (
+        SELECT id, user_id, created
+        FROM consumption
+        WHERE user_id = feed.author_id AND created IS NOT NULL
+        ORDER BY created DESC, id DESC
+        LIMIT :max_length
+    ) events
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    DELETE FROM timeline
+    WHERE (user_id, consumption_id) IN (
+        SELECT user_id, consumption_id
+        FROM (
+            SELECT user_id, consumption_id,
+                   row_number() OVER (PARTITION BY user_id ORDER BY created DESC, consumption_id DESC) AS position
+            FROM timeline
+        ) ranked
+        WHERE position > :max_length
+    )
+    """,
+]
+
+
+def backfill(max_length: int = FEED_TIMELINE_MAX_LENGTH):
+    engine = sa.create_engine(DATABASE_URL)
+    with engine.begin() as connection:
+        inserted = connection.execute(sa.text(BACKFILL_SQL[0]), {"max_length": max_length}).rowcount
+        trimmed = connection.execute(sa.text(BACKFILL_SQL[1]), {"max_length": max_length}).rowcount
+    print(f"Added {inserted} timeline entries, trimmed {trimmed}")
+
+
+if __name__ == '__main__':
+    backfill()
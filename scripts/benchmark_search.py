@@ -0,0 +1,68 @@
+"""
+This script compares media search latency against our own catalog (pg_trgm indexes) with the external APIs.
+
+    python scripts/benchmark_search.py movie "star wars" "the office" dune --repeat 20
+"""
+import argparse
+import pathlib
+import statistics
+import sys
+import time
+
+sys.path.append(pathlib.Path(__file__).parent.parent.absolute().as_posix())
+from config import LOCAL_SEARCH_LIMIT, LOCAL_SEARCH_POPULARITY_WEIGHT
+from db.helpers import search_local_media
+from db.session import Session
+from wrappers import google_books, tmdb
+from wrappers.google_books import google_books_client
+from wrappers.tmdb import tmdb_client
+
+EXTERNAL_SEARCHES = {
+    "book": google_books_client.get_books_by_query,
+    "movie": tmdb_client.get_movies_by_title,
+    "tv": tmdb_client.get_tv_by_title
+}
+
+
+def time_ms(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+
+def summarize(name: str, timings: list):
+    timings = sorted(timings)
+    print(f"{name:>10}: n={len(timings)} "
+          f"p50={statistics.median(timings):.1f}ms "
+          f"p95={timings[int(len(timings) * 0.95) - 1]:.1f}ms "
+          f"max={timings[-1]:.1f}ms")
+
+
+def benchmark(media_type: str, queries: list, repeat: int):
+    external_search = EXTERNAL_SEARCHES[media_type]
+    session = Session()
+
+    local_timings = []
+    external_timings = []
+    for query in queries:
+        for _ in range(repeat):
+            local_timings.append(time_ms(lambda: search_local_media(media_type, query, LOCAL_SEARCH_LIMIT,
+                                                                    LOCAL_SEARCH_POPULARITY_WEIGHT, session)))
+            # Measure the API itself, not our in-process search cache
+            tmdb.search_cache.clear()
+            google_books.search_cache.clear()
+            external_timings.append(time_ms(lambda: external_search(query)))
+
+    session.close()
+    summarize("local", local_timings)
+    summarize("external", external_timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("media_type", choices=EXTERNAL_SEARCHES.keys())
+    parser.add_argument("queries", nargs="+")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    benchmark(args.media_type, args.queries, args.repeat)
@@ -0,0 +1,171 @@
+"""
+This script writes an EXPLAIN (ANALYZE, BUFFERS) snapshot of every query run by the read helpers in db/helpers.py to
+db/explain/<helper>.txt, so changes to indexes or helpers can be checked against the plans we expect.
+
+With --seed it first fills an empty database with synthetic users, media, friendships, recommendations and
+consumption history at the given scale (never point --seed at a real database):
+
+    python scripts/explain_helpers.py --seed --consumption-rows 10000000 --users 100000 --media 100000
+"""
+import argparse
+import pathlib
+import sys
+
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+sys.path.append(pathlib.Path(__file__).parent.parent.absolute().as_posix())
+from config import DATABASE_URL
+from db import helpers
+from scripts.backfill_consumption_latest import BACKFILL_SQL
+from scripts.rebuild_friendship import REBUILD_SQL
+
+SNAPSHOT_DIR = pathlib.Path(__file__).parent.parent / "db" / "explain"
+
+SEED_SQL = [
+    """
+    INSERT INTO "user" (auth0_sub, first_name, last_name, full_name, email, created)
+    SELECT 'seed|' || g, 'first' || g, 'last' || g, 'first' || g || ' last' || g, 'user' || g || '@example.com',
+           now() - random() * interval '3 years'
+    FROM generate_series(1, :users) g
+    """,
+    """
+    INSERT INTO book (source, source_id, title, author_names, cover_url, publish_year)
+    SELECT 'seed', 'b' || g, 'book title ' || g, ARRAY['author ' || (g % 5000)], NULL, 1900 + g % 120
+    FROM generate_series(1, :media) g
+    """,
+    """
+    INSERT INTO movie (source, source_id, title, poster_url, release_date)
+    SELECT 'seed', 'm' || g, 'movie title ' || g, NULL, date '1950-01-01' + g % 25000
+    FROM generate_series(1, :media) g
+    """,
+    """
+    INSERT INTO tv (source, source_id, title, networks, poster_url, first_air_date)
+    SELECT 'seed', 't' || g, 'tv title ' || g, ARRAY['network ' || (g % 50)], NULL, date '1950-01-01' + g % 25000
+    FROM generate_series(1, :media) g
+    """,
+    """
+    INSERT INTO friend (requester_id, requested_id, status, created)
+    SELECT u.id, (SELECT min(id) FROM "user") + floor(random() * :users)::int, 'accepted',
+           now() - random() * interval '3 years'
+    FROM "user" u, generate_series(1, :friends_per_user) g
+    """,
+    """
+    INSERT INTO consumption (user_id, media_type, media_id, source_id, status, created)
+    SELECT (SELECT min(id) FROM "user") + floor(random() * :users)::int,
+           (ARRAY['book', 'movie', 'tv'])[1 + g % 3],
+           1 + floor(random() * :media)::int,
+           NULL,
+           (ARRAY['want to consume', 'consuming', 'finished', 'abandoned'])[1 + floor(random() * 4)::int],
+           now() - random() * interval '3 years'
+    FROM generate_series(1, :consumption_rows) g
+    """,
+    """
+    INSERT INTO recommendation (recommender_user_id, recommended_user_id, media_type, media_id, source_id, status,
+                                created)
+    SELECT (SELECT min(id) FROM "user") + floor(random() * :users)::int,
+           (SELECT min(id) FROM "user") + floor(random() * :users)::int,
+           (ARRAY['book', 'movie', 'tv'])[1 + g % 3],
+           1 + floor(random() * :media)::int,
+           NULL,
+           'pending',
+           now() - random() * interval '3 years'
+    FROM generate_series(1, :consumption_rows / 10) g
+    """,
+]
+
+
+def seed(engine, users: int, media: int, consumption_rows: int, friends_per_user: int):
+    with engine.connect() as connection:
+        if connection.execute(sa.text("SELECT count(*) FROM consumption")).scalar():
+            sys.exit("Refusing to seed a database that already has consumption records")
+
+    params = {"users": users, "media": media, "consumption_rows": consumption_rows,
+              "friends_per_user": friends_per_user}
+    with engine.begin() as connection:
+        for statement in SEED_SQL:
+            connection.execute(sa.text(statement), params)
+        connection.execute(sa.text(BACKFILL_SQL))
+        for statement in REBUILD_SQL:
+            connection.execute(sa.text(statement))
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(sa.text("VACUUM ANALYZE"))
+
+
+def pick_users(engine):
+    """
+    Pick a user with friends and a typical amount of history, and one of their friends.
+    """
+    with engine.connect() as connection:
+        user_id, other_user_id = connection.execute(sa.text("""
+            SELECT f.requester_id, f.requested_id
+            FROM friend f
+            WHERE f.status = 'accepted' AND f.requester_id <> f.requested_id
+            ORDER BY f.id
+            LIMIT 1
+        """)).first()
+    return user_id, other_user_id
+
+
+def snapshot(engine, user_id: int, other_user_id: int):
+    session = sessionmaker(bind=engine)()
+    calls = {
+        "get_consumption_records": lambda: helpers.get_consumption_records(user_id, "book", session),
+        "get_records_recommended_to_user": lambda: helpers.get_records_recommended_to_user(user_id, "book", session),
+        "get_records_recommended_by_user": lambda: helpers.get_records_recommended_by_user(user_id, "book", session),
+        "search_users": lambda: helpers.search_users(user_id, "us", 20, None, session),
+        "get_friend_statuses": lambda: helpers.get_friend_statuses(user_id, [other_user_id], session),
+        "get_user_friends": lambda: helpers.get_user_friends(user_id, session),
+        "get_user_friend_requests": lambda: helpers.get_user_friend_requests(user_id, session),
+        "get_overlapping_records": lambda: helpers.get_overlapping_records(user_id, other_user_id, "book", session),
+        "get_suggested_records": lambda: helpers.get_suggested_records(user_id, "book", session),
+        "get_overlaps_with_friends": lambda: helpers.get_overlaps_with_friends(user_id, "book", session),
+        "get_friend_event_records": lambda: helpers.get_friend_event_records(user_id, session, 50),
+    }
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    SNAPSHOT_DIR.mkdir(exist_ok=True)
+    event.listen(engine, "before_cursor_execute", capture)
+    for name, call in calls.items():
+        statements.clear()
+        call()
+        captured = list(statements)
+
+        plans = []
+        raw_connection = engine.raw_connection()
+        cursor = raw_connection.cursor()
+        for statement, parameters in captured:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+            plans.append(f"-- {statement.strip()}\n-- {parameters}\n" + "\n".join(row[0] for row in cursor.fetchall()))
+        raw_connection.close()
+
+        (SNAPSHOT_DIR / f"{name}.txt").write_text("\n\n".join(plans) + "\n")
+        print(f"Wrote {name} ({len(captured)} statements)")
+    event.remove(engine, "before_cursor_execute", capture)
+    session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", action="store_true", help="fill an empty database with synthetic data first")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--media", type=int, default=100000, help="rows per media table")
+    parser.add_argument("--consumption-rows", type=int, default=10000000)
+    parser.add_argument("--friends-per-user", type=int, default=10)
+    parser.add_argument("--user-id", type=int)
+    parser.add_argument("--other-user-id", type=int)
+    args = parser.parse_args()
+
+    engine = sa.create_engine(DATABASE_URL)
+    if args.seed:
+        seed(engine, args.users, args.media, args.consumption_rows, args.friends_per_user)
+
+    user_id, other_user_id = args.user_id, args.other_user_id
+    if user_id is None or other_user_id is None:
+        user_id, other_user_id = pick_users(engine)
+    snapshot(engine, user_id, other_user_id)
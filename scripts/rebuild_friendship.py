@@ -0,0 +1,39 @@
+"""
+This script rebuilds the friendship table from the friend link history. Run it once after migrating, or any time the
+table needs to be derived again from scratch; it replaces the table contents in a single transaction.
+"""
+import pathlib
+import sys
+
+import sqlalchemy as sa
+
+sys.path.append(pathlib.Path(__file__).parent.parent.absolute().as_posix())
+from config import DATABASE_URL
+
+REBUILD_SQL = [
+    "DELETE FROM friendship",
+    """
+    INSERT INTO friendship (user_id, friend_id, requester_id, friend_link_id, status, created)
+    SELECT DISTINCT ON (user_id, friend_id)
+           user_id, friend_id, requester_id, id, status, created
+    FROM (
+        SELECT requester_id AS user_id, requested_id AS friend_id, requester_id, id, status, created FROM friend
+        UNION ALL
+        SELECT requested_id AS user_id, requester_id AS friend_id, requester_id, id, status, created FROM friend
+    ) links
+    WHERE user_id IS NOT NULL AND friend_id IS NOT NULL AND user_id <> friend_id
+    ORDER BY user_id, friend_id, created DESC, id DESC
+    """,
+]
+
+
+def rebuild():
+    engine = sa.create_engine(DATABASE_URL)
+    with engine.begin() as connection:
+        for statement in REBUILD_SQL:
+            result = connection.execute(sa.text(statement))
+    print(f"Rebuilt friendship with {result.rowcount} rows")
+
+
+if __name__ == '__main__':
+    rebuild()
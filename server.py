@@ -1,15 +1,22 @@
 from flask import Blueprint
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
 
 from six.moves.urllib.request import urlopen
 from functools import wraps
 
-from config import PROD_AUTH0_DOMAIN, DEV_AUTH0_DOMAIN
+from config import PROD_AUTH0_DOMAIN, DEV_AUTH0_DOMAIN, JWKS_TTL_SECONDS, JWKS_MIN_REFRESH_INTERVAL_SECONDS, \
+    JWKS_FETCH_TIMEOUT_SECONDS, TOKEN_CACHE_MAX_SIZE, TOKEN_CACHE_POLICY
 
 from flask import request, jsonify, _request_ctx_stack
 from jose import jwt
 
+from cache.lru import TTLCache
+
 
 if os.getenv("FLASK_ENV") == 'production':
     AUTH0_DOMAIN = PROD_AUTH0_DOMAIN
@@ -21,6 +28,8 @@ ALGORITHMS = ["RS256"]
 
 auth = Blueprint("auth", __name__)
 
+logger = logging.getLogger(__name__)
+
 
 # Error handler
 class AuthError(Exception):
@@ -36,6 +45,146 @@ def handle_auth_error(ex):
     return response
 
 
+class JWKSStore:
+    """
+    Process-level cache of the Auth0 signing keys. The key set is fetched once, refreshed in a background
+    thread once it is older than the TTL, and only re-fetched inline when a token arrives with a key id we
+    have not seen (at most once per min_refresh_interval). Listeners registered with add_rotation_listener are
+    called with the key ids that disappeared whenever a refresh drops keys.
+    """
+
+    def __init__(self, jwks_url: str, ttl: int, min_refresh_interval: int, fetch_timeout: int):
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.fetch_timeout = fetch_timeout
+
+        self._keys = {}
+        self._fetched_at = None
+        self._last_kid_miss_refresh = 0.0
+        self._lock = threading.Lock()
+        self._background_refresh_running = False
+        self._rotation_listeners = []
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.kid_miss_refreshes = 0
+        self.kid_miss_refreshes_throttled = 0
+
+    def get_key(self, kid: str) -> dict:
+        """
+        Get the RSA key for a key id, or an empty dict if Auth0 does not know about it.
+        :param kid: key id from the token header
+        :return: RSA key
+        """
+        if self._fetched_at is None:
+            with self._lock:
+                if self._fetched_at is None:
+                    self._refresh()
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self._refresh_in_background()
+
+        rsa_key = self._keys.get(kid)
+        if rsa_key:
+            self.hits += 1
+            return rsa_key
+
+        self.misses += 1
+        with self._lock:
+            # Another thread may have already picked up the new key while we waited on the lock
+            if kid in self._keys:
+                return self._keys[kid]
+            if time.monotonic() - self._last_kid_miss_refresh < self.min_refresh_interval:
+                self.kid_miss_refreshes_throttled += 1
+                return {}
+            self._last_kid_miss_refresh = time.monotonic()
+            self.kid_miss_refreshes += 1
+            try:
+                self._refresh()
+            except AuthError:
+                return {}
+        return self._keys.get(kid, {})
+
+    def add_rotation_listener(self, listener):
+        self._rotation_listeners.append(listener)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "refresh_failures": self.refresh_failures,
+                "kid_miss_refreshes": self.kid_miss_refreshes,
+                "kid_miss_refreshes_throttled": self.kid_miss_refreshes_throttled,
+                "keys": len(self._keys),
+                "age_seconds": round(time.monotonic() - self._fetched_at) if self._fetched_at is not None else None}
+
+    def _refresh(self):
+        """
+        Fetch the key set from Auth0 and swap it in. Callers must hold the lock.
+        """
+        try:
+            jsonurl = urlopen(self.jwks_url, timeout=self.fetch_timeout)
+            jwks = json.loads(jsonurl.read())
+        except Exception:
+            self.refresh_failures += 1
+            logger.exception(f"Unable to fetch signing keys from {self.jwks_url}")
+            if self._fetched_at is None:
+                raise AuthError({"code": "jwks_unavailable",
+                                 "description": "Unable to fetch signing keys"}, 503)
+            # Keep serving the keys we already have, and wait another TTL before trying again
+            self._fetched_at = time.monotonic()
+            return
+
+        keys = {}
+        for key in jwks["keys"]:
+            keys[key["kid"]] = {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key["use"],
+                "n": key["n"],
+                "e": key["e"]
+            }
+
+        removed_kids = set(self._keys) - set(keys)
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        self.refreshes += 1
+
+        if removed_kids:
+            logger.info(f"Signing keys {sorted(removed_kids)} were rotated out")
+            for listener in self._rotation_listeners:
+                listener(removed_kids)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._background_refresh_running:
+                return
+            self._background_refresh_running = True
+
+        def refresh():
+            try:
+                with self._lock:
+                    if time.monotonic() - self._fetched_at > self.ttl:
+                        self._refresh()
+            finally:
+                self._background_refresh_running = False
+
+        threading.Thread(target=refresh, name="jwks-refresh", daemon=True).start()
+
+
+jwks_store = JWKSStore(jwks_url="https://"+AUTH0_DOMAIN+"/.well-known/jwks.json",
+                       ttl=JWKS_TTL_SECONDS,
+                       min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL_SECONDS,
+                       fetch_timeout=JWKS_FETCH_TIMEOUT_SECONDS)
+
+# sha256(token) -> (kid, claims payload) for tokens that have already passed verification
+verified_tokens = TTLCache(max_size=TOKEN_CACHE_MAX_SIZE, policy=TOKEN_CACHE_POLICY)
+jwks_store.add_rotation_listener(
+    lambda removed_kids: verified_tokens.discard_where(lambda entry: entry[0] in removed_kids))
+
+
 # Format error response and append status code
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
@@ -72,21 +221,20 @@ def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         token = get_token_auth_header()
-        jsonurl = urlopen("https://"+AUTH0_DOMAIN+"/.well-known/jwks.json")
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        cached = verified_tokens.get(token_hash)
+        if cached:
+            _request_ctx_stack.top.current_user = cached[1]
+            return f(*args, **kwargs)
 
-        jwks = json.loads(jsonurl.read())
-        print(token)
-        unverified_header = jwt.get_unverified_header(token)
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
+        try:
+            unverified_header = jwt.get_unverified_header(token)
+        except Exception:
+            raise AuthError({"code": "invalid_header",
+                            "description":
+                                "Unable to parse authentication"
+                                " token."}, 401)
+        rsa_key = jwks_store.get_key(unverified_header.get("kid"))
         if rsa_key:
             try:
                 payload = jwt.decode(
@@ -111,6 +259,8 @@ def requires_auth(f):
                                     "Unable to parse authentication"
                                     " token."}, 401)
 
+            if payload.get("exp"):
+                verified_tokens.set(token_hash, (rsa_key["kid"], payload), expires_at=payload["exp"])
             _request_ctx_stack.top.current_user = payload
             return f(*args, **kwargs)
         raise AuthError({"code": "invalid_header",
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+# config reads DATABASE_URL at import time; none of these tests open a connection
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/goodtimes")
+
+
+class FakeClock:
+    """
+    Stands in for the time module in the module under test, so expiry and waiting can be tested without sleeping.
+    sleep advances the clock instead of blocking.
+    """
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
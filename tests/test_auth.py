@@ -0,0 +1,105 @@
+import json
+import time
+
+from flask import Flask, _request_ctx_stack
+from jose import jwk, jwt
+import pytest
+import rsa
+
+import server
+from server import AuthError, requires_auth
+
+
+def make_key(kid):
+    # Small keys, since pure-Python key generation is slow; the size makes no difference to these tests
+    _, private_key = rsa.newkeys(1024)
+    pem = private_key.save_pkcs1()
+    public = jwk.construct(pem, "RS256").public_key().to_dict()
+    return pem, {"kid": kid, "kty": "RSA", "use": "sig", "n": public["n"], "e": public["e"]}
+
+
+def sign(pem, kid, sub="auth0|1"):
+    claims = {"sub": sub,
+              "aud": server.API_AUDIENCE,
+              "iss": "https://" + server.AUTH0_DOMAIN + "/",
+              "exp": int(time.time()) + 3600}
+    return jwt.encode(claims, pem, algorithm="RS256", headers={"kid": kid})
+
+
+class FakeJWKSEndpoint:
+    def __init__(self, *public_keys):
+        self.keys = list(public_keys)
+        self.fetches = 0
+
+    def __call__(self, url, timeout):
+        self.fetches += 1
+        body = json.dumps({"keys": self.keys}).encode()
+        return type("Response", (), {"read": lambda _: body})()
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return make_key("kid-1"), make_key("kid-2")
+
+
+@pytest.fixture
+def endpoint(monkeypatch, keys):
+    (_, public_1), _ = keys
+    endpoint = FakeJWKSEndpoint(public_1)
+    monkeypatch.setattr(server, "urlopen", endpoint)
+    # Start from an empty key set and token cache, and put the module's state back afterwards
+    monkeypatch.setattr(server.jwks_store, "_keys", {})
+    monkeypatch.setattr(server.jwks_store, "_fetched_at", None)
+    monkeypatch.setattr(server.jwks_store, "_last_kid_miss_refresh", 0.0)
+    server.verified_tokens.clear()
+    yield endpoint
+    server.verified_tokens.clear()
+
+
+@requires_auth
+def current_subject():
+    return _request_ctx_stack.top.current_user["sub"]
+
+
+def call_with(token):
+    with Flask(__name__).test_request_context(headers={"Authorization": f"Bearer {token}"}):
+        return current_subject()
+
+
+def test_verified_token_is_cached(monkeypatch, endpoint, keys):
+    (pem_1, _), _ = keys
+    token = sign(pem_1, "kid-1")
+    assert call_with(token) == "auth0|1"
+    assert len(server.verified_tokens) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached token was verified again")
+    monkeypatch.setattr(server.jwt, "decode", fail)
+
+    assert call_with(token) == "auth0|1"
+    assert endpoint.fetches == 1
+
+
+def test_rotated_out_key_invalidates_cached_tokens(endpoint, keys):
+    (pem_1, _), (pem_2, public_2) = keys
+    old_token = sign(pem_1, "kid-1", sub="auth0|old")
+    assert call_with(old_token) == "auth0|old"
+
+    # kid-1 is rotated out; the first token signed with kid-2 triggers a refresh that notices
+    endpoint.keys = [public_2]
+    assert call_with(sign(pem_2, "kid-2", sub="auth0|new")) == "auth0|new"
+    assert endpoint.fetches == 2
+    assert len(server.verified_tokens) == 1
+
+    with pytest.raises(AuthError) as error:
+        call_with(old_token)
+    assert error.value.status_code == 401
+
+
+def test_refresh_that_keeps_a_key_keeps_its_tokens(endpoint, keys):
+    (pem_1, public_1), (pem_2, public_2) = keys
+    assert call_with(sign(pem_1, "kid-1")) == "auth0|1"
+
+    endpoint.keys = [public_1, public_2]
+    assert call_with(sign(pem_2, "kid-2", sub="auth0|2")) == "auth0|2"
+    assert len(server.verified_tokens) == 2
@@ -0,0 +1,158 @@
+import csv
+from datetime import datetime
+import io
+
+import pytest
+
+from importers.formats import GOODREADS, IMDB, LETTERBOXD, ImportRow, SkippedRow, detect_format, parse_rows
+from importers.pipeline import drop_repeated_rows
+
+GOODREADS_EXPORT = '''\
+Book Id,Title,Author,Author l-f,Additional Authors,ISBN,ISBN13,My Rating,Average Rating,Publisher,Binding,\
+Number of Pages,Year Published,Original Publication Year,Date Read,Date Added,Bookshelves,\
+Bookshelves with positions,Exclusive Shelf,My Review,Spoiler,Private Notes,Read Count,Owned Copies
+1,"The Queen of Nothing (The Folk of the Air, #3)",Holly Black,"Black, Holly",,"=""0316310344""",\
+"=""9780316310345""",5,4.3,"Little, Brown",Hardcover,300,2019,2019,2020/01/15,2019/12/01,,,read,,,,1,0
+2,Good Omens,Terry Pratchett,"Pratchett, Terry",Neil Gaiman,"=""""","=""""",0,4.25,,Paperback,412,2006,1990,,\
+2021/03/14,to-read,to-read (#1),to-read,,,,0,0
+3,Middlemarch,George Eliot,"Eliot, George",,,,0,3.9,,Paperback,800,2003,,,2021/05/01,\
+currently-reading,,currently-reading,,,,0,0
+4,Infinite Jest,David Foster Wallace,"Wallace, David Foster",,,,0,4.0,,Paperback,1079,2006,1996,,2021/06/01,\
+owned,,owned,,,,0,0
+'''
+
+LETTERBOXD_DIARY = '''\
+Date,Name,Year,Letterboxd URI,Rating,Rewatch,Tags,Watched Date
+2021-02-03,Parasite,2019,https://boxd.it/abc,5,,,2021-02-01
+2021-02-05,"Crouching Tiger, Hidden Dragon",,https://boxd.it/def,4,Yes,,
+'''
+
+IMDB_RATINGS = '''\
+Const,Your Rating,Date Rated,Title,URL,Title Type,IMDb Rating,Runtime (mins),Year,Genres,Num Votes,Release Date,\
+Directors
+tt0903747,10,2020-08-09,Breaking Bad,https://www.imdb.com/title/tt0903747/,tvSeries,9.5,49,2008,Drama,1900000,\
+2008-01-20,
+tt0111161,9,2019-04-01,The Shawshank Redemption,https://www.imdb.com/title/tt0111161/,movie,9.3,142,1994,Drama,\
+2700000,1994-09-23,Frank Darabont
+tt0000001,7,2019-04-02,Some Podcast Episode,https://www.imdb.com/title/tt0000001/,podcastEpisode,7.0,30,2020,,10,,
+'''
+
+IMDB_WATCHLIST = '''\
+Position,Const,Created,Modified,Description,Title,URL,Title Type,IMDb Rating,Runtime (mins),Year,Genres,Num Votes,\
+Release Date,Directors
+1,tt0068646,2022-01-05,2022-01-05,,The Godfather,https://www.imdb.com/title/tt0068646/,Feature Film,9.2,175,1972,\
+Crime,1900000,1972-03-24,Francis Ford Coppola
+'''
+
+
+def read(export):
+    return csv.DictReader(io.StringIO(export))
+
+
+def parse(export, status=None):
+    reader = read(export)
+    return list(parse_rows(reader, detect_format(reader.fieldnames), status=status))
+
+
+@pytest.mark.parametrize("export,expected", [
+    (GOODREADS_EXPORT, GOODREADS),
+    (LETTERBOXD_DIARY, LETTERBOXD),
+    (IMDB_RATINGS, IMDB),
+    (IMDB_WATCHLIST, IMDB),
+])
+def test_detect_format(export, expected):
+    assert detect_format(read(export).fieldnames) == expected
+
+
+def test_detect_format_rejects_other_csvs():
+    with pytest.raises(ValueError):
+        detect_format(["title", "author", "rating"])
+
+
+def test_goodreads():
+    read_book, to_read, reading, custom_shelf = parse(GOODREADS_EXPORT)
+
+    assert read_book == ImportRow(line=2,
+                                  media_type='book',
+                                  title='The Queen of Nothing',
+                                  status='finished',
+                                  created=datetime(2020, 1, 15),
+                                  year=2019,
+                                  authors=['Holly Black'],
+                                  isbns=['9780316310345', '0316310344'])
+    assert (to_read.status, to_read.created, to_read.year) == ('want to consume', datetime(2021, 3, 14), 1990)
+    assert to_read.authors == ['Terry Pratchett', 'Neil Gaiman']
+    assert to_read.isbns == []
+    assert (reading.status, reading.year) == ('consuming', 2003)
+    assert custom_shelf == SkippedRow(line=5, title='Infinite Jest', reason="shelf 'owned'")
+
+
+def test_goodreads_status_override():
+    rows = parse(GOODREADS_EXPORT, status='abandoned')
+
+    assert [row.status for row in rows] == ['abandoned'] * 4
+    # The read date only applies to finished books
+    assert rows[0].created == datetime(2019, 12, 1)
+
+
+def test_letterboxd():
+    watched, undated = parse(LETTERBOXD_DIARY)
+
+    assert watched == ImportRow(line=2, media_type='movie', title='Parasite', status='finished',
+                                created=datetime(2021, 2, 1), year=2019)
+    assert undated.title == 'Crouching Tiger, Hidden Dragon'
+    assert undated.created == datetime(2021, 2, 5)
+    assert undated.year is None
+
+
+def test_letterboxd_watchlist():
+    watchlist = 'Date,Name,Year,Letterboxd URI\n2021-02-03,Parasite,2019,https://boxd.it/abc\n'
+
+    assert parse(watchlist, status='want to consume')[0].status == 'want to consume'
+
+
+def test_imdb_ratings():
+    series, movie, podcast = parse(IMDB_RATINGS)
+
+    assert series == ImportRow(line=2, media_type='tv', title='Breaking Bad', status='finished',
+                               created=datetime(2020, 8, 9), year=2008)
+    assert (movie.media_type, movie.created) == ('movie', datetime(2019, 4, 1))
+    assert podcast == SkippedRow(line=4, title='Some Podcast Episode', reason="title type 'podcastEpisode'")
+
+
+def test_imdb_watchlist():
+    movie, = parse(IMDB_WATCHLIST)
+
+    assert (movie.media_type, movie.status, movie.created) == ('movie', 'want to consume', datetime(2022, 1, 5))
+
+
+def test_rows_without_a_title_or_with_bad_dates_are_skipped():
+    export = 'Date,Name,Year,Letterboxd URI\n2021-02-03,,2019,https://boxd.it/abc\nlast tuesday,Heat,1995,x\n'
+
+    assert parse(export) == [SkippedRow(line=2, title=None, reason="no title"),
+                             SkippedRow(line=3, title='Heat', reason="unreadable date 'last tuesday'")]
+
+
+def test_missing_date_is_now():
+    export = 'Date,Name,Year,Letterboxd URI\n,Heat,1995,https://boxd.it/abc\n'
+    before = datetime.utcnow()
+
+    assert before <= parse(export)[0].created <= datetime.utcnow()
+
+
+def test_rows_are_parsed_lazily():
+    rows = parse_rows(iter([{'Name': 'Heat', 'Date': '2021-01-01'}, None]), LETTERBOXD)
+
+    assert next(rows).title == 'Heat'
+
+
+def test_repeated_rows_within_a_batch_are_dropped():
+    # Two diary entries for the same film and day (e.g. the same title listed under two spellings), a rewatch
+    # on another day, and the same day's entry for a different film
+    rows = [ImportRow(line=2, media_type='movie', title='Heat', status='finished', created=datetime(2021, 1, 1)),
+            ImportRow(line=3, media_type='movie', title='Heat (1995)', status='finished', created=datetime(2021, 1, 1)),
+            ImportRow(line=4, media_type='movie', title='Heat', status='finished', created=datetime(2021, 6, 1)),
+            ImportRow(line=5, media_type='movie', title='Ronin', status='finished', created=datetime(2021, 1, 1))]
+    media_ids = {2: (10, 'tmdb'), 3: (10, 'tmdb'), 4: (10, 'tmdb'), 5: (11, 'tmdb')}
+
+    assert [row.line for row in drop_repeated_rows(rows, media_ids)] == [2, 4, 5]
@@ -0,0 +1,95 @@
+import pytest
+
+from cache import lru
+from cache.lru import TTLCache
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(lru, "time", clock)
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = TTLCache(max_size=10, ttl=60)
+    cache.set("a", 1)
+
+    clock.advance(59)
+    assert cache.get("a") == 1
+
+    clock.advance(1)
+    assert cache.get("a") is None
+    assert cache.expirations == 1
+    assert len(cache) == 0
+
+
+def test_explicit_expiry_overrides_ttl(clock):
+    cache = TTLCache(max_size=10, ttl=60)
+    cache.set("a", 1, expires_at=clock.now + 5)
+
+    clock.advance(5)
+    assert cache.get("a", "missing") == "missing"
+
+
+def test_no_ttl_never_expires(clock):
+    cache = TTLCache(max_size=10)
+    cache.set("a", 1)
+
+    clock.advance(10 * 365 * 24 * 60 * 60)
+    assert cache.get("a") == 1
+
+
+def test_get_entry_returns_stored_time(clock):
+    cache = TTLCache(max_size=10, ttl=60)
+    stored_at = clock.now
+    cache.set("a", 1)
+    clock.advance(30)
+
+    assert cache.get_entry("a") == (1, stored_at)
+    assert cache.oldest_age() == 30
+
+
+def test_lru_evicts_least_recently_used():
+    cache = TTLCache(max_size=2, policy="lru")
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.evictions == 1
+
+
+def test_fifo_evicts_oldest_inserted():
+    cache = TTLCache(max_size=2, policy="fifo")
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+
+
+def test_zero_size_disables_cache():
+    cache = TTLCache(max_size=0)
+    cache.set("a", 1)
+
+    assert cache.get("a") is None
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        TTLCache(policy="random")
+
+
+def test_discard_where():
+    cache = TTLCache(max_size=10)
+    cache.set("a", ("kid-1", {}))
+    cache.set("b", ("kid-2", {}))
+    cache.set("c", ("kid-1", {}))
+
+    assert cache.discard_where(lambda entry: entry[0] == "kid-1") == 2
+    assert cache.get("a") is None
+    assert cache.get("b") == ("kid-2", {})
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+
+import pytest
+
+from wrappers import rate_limit
+from wrappers.http import build_session
+from wrappers.rate_limit import RateLimited, TokenBucket, parse_retry_after
+
+
+@pytest.fixture
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+def test_burst_is_served_without_waiting(fake_time):
+    bucket = TokenBucket("tmdb", rate=10, burst=3, max_wait=0)
+    for _ in range(3):
+        bucket.acquire()
+
+    assert fake_time.now == 0
+    assert (bucket.acquired, bucket.delayed) == (3, 0)
+
+
+def test_waits_for_a_token_to_refill(fake_time):
+    bucket = TokenBucket("tmdb", rate=10, burst=1, max_wait=1)
+    bucket.acquire()
+    bucket.acquire()
+
+    assert fake_time.now == pytest.approx(0.1)
+    assert bucket.delayed == 1
+    assert bucket.total_wait_seconds == pytest.approx(0.1)
+
+
+def test_rejects_when_wait_exceeds_max_wait(fake_time):
+    bucket = TokenBucket("tmdb", rate=2, burst=1, max_wait=0.1)
+    bucket.acquire()
+
+    with pytest.raises(RateLimited) as error:
+        bucket.acquire()
+    assert error.value.retry_after == pytest.approx(0.5)
+    assert bucket.rejected == 1
+
+
+def test_refill_is_capped_at_burst(fake_time):
+    bucket = TokenBucket("tmdb", rate=10, burst=2, max_wait=0)
+    fake_time.advance(60)
+    bucket.acquire()
+    bucket.acquire()
+
+    with pytest.raises(RateLimited):
+        bucket.acquire()
+
+
+def test_pause_holds_back_every_request(fake_time):
+    bucket = TokenBucket("tmdb", rate=10, burst=5, max_wait=1)
+    bucket.pause(30)
+
+    with pytest.raises(RateLimited) as error:
+        bucket.acquire()
+    assert error.value.retry_after == pytest.approx(30)
+
+    bucket.max_wait = 60
+    bucket.acquire()
+    assert fake_time.now == pytest.approx(30)
+    assert bucket.pauses == 1
+
+
+def test_shorter_pause_does_not_shorten_a_longer_one(fake_time):
+    bucket = TokenBucket("tmdb", rate=10, burst=5, max_wait=0)
+    bucket.pause(30)
+    bucket.pause(5)
+
+    assert bucket.stats()["paused_for_seconds"] == 30
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("120", 120),
+    ("1.5", 1.5),
+    ("-3", 0),
+    (None, None),
+    ("", None),
+    ("soon", None),
+])
+def test_parse_retry_after_seconds(value, expected):
+    assert parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_http_date():
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=60)
+
+    assert parse_retry_after(format_datetime(retry_at, usegmt=True)) == pytest.approx(60, abs=2)
+
+
+def test_parse_retry_after_date_in_the_past():
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(429)
+        self.send_header("Retry-After", "30")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def throttling_server():
+    server = HTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_throttled_response_pauses_the_provider(throttling_server):
+    bucket = TokenBucket("tmdb", rate=100, burst=10, max_wait=1)
+    session = build_session(throttling_server, rate_limiter=bucket)
+
+    assert session.get(throttling_server + "search").status_code == 429
+    assert bucket.pauses == 1
+    with pytest.raises(RateLimited):
+        session.get(throttling_server + "search")
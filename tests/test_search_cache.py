@@ -0,0 +1,146 @@
+import threading
+import time
+
+import pytest
+
+from cache import lru, search
+from cache.search import SearchCache, cached_search, normalize_query
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(lru, "time", clock)
+    monkeypatch.setattr(search, "time", clock)
+
+
+class Loader:
+    """
+    Returns "v1", "v2", ... on successive calls, or raises if fail is set.
+    """
+
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+
+    def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("provider down")
+        return f"v{self.calls}"
+
+
+def wait_until(condition):
+    """
+    Background revalidation runs on the cache's executor; give it a few seconds to finish.
+    """
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("background revalidation did not finish")
+
+
+def test_fresh_entry_is_served_from_cache(clock):
+    cache = SearchCache(max_size=10, ttl=60, stale_ttl=600)
+    loader = Loader()
+
+    assert cache.get_or_load("q", loader) == "v1"
+    clock.advance(60)
+    assert cache.get_or_load("q", loader) == "v1"
+
+    assert loader.calls == 1
+    assert (cache.misses, cache.fresh_hits, cache.stale_hits) == (1, 1, 0)
+
+
+def test_stale_entry_is_served_then_revalidated(clock):
+    cache = SearchCache(max_size=10, ttl=60, stale_ttl=600)
+    loader = Loader()
+    cache.get_or_load("q", loader)
+
+    clock.advance(61)
+    assert cache.get_or_load("q", loader) == "v1"
+    wait_until(lambda: cache.revalidations == 1)
+
+    assert cache.get_or_load("q", loader) == "v2"
+    assert cache.stale_hits == 1
+    assert cache.fresh_hits == 1
+    assert cache.revalidations == 1
+
+
+def test_expired_entry_is_loaded_inline(clock):
+    cache = SearchCache(max_size=10, ttl=60, stale_ttl=600)
+    loader = Loader()
+    cache.get_or_load("q", loader)
+
+    clock.advance(661)
+    assert cache.get_or_load("q", loader) == "v2"
+    assert cache.misses == 2
+    assert cache.stale_hits == 0
+
+
+def test_failed_revalidation_keeps_serving_stale_entry(clock):
+    cache = SearchCache(max_size=10, ttl=60, stale_ttl=600)
+    cache.get_or_load("q", Loader())
+
+    clock.advance(61)
+    failing = Loader(fail=True)
+    assert cache.get_or_load("q", failing) == "v1"
+    wait_until(lambda: cache.revalidation_failures == 1)
+
+    # Still stale, so the next read serves v1 again and retries in the background
+    assert cache.get_or_load("q", lambda: "v2") == "v1"
+    wait_until(lambda: cache.revalidations == 1)
+    assert cache.get_or_load("q", failing) == "v2"
+
+
+def test_concurrent_stale_reads_revalidate_once(clock):
+    cache = SearchCache(max_size=10, ttl=60, stale_ttl=600)
+    cache.get_or_load("q", Loader())
+    clock.advance(61)
+
+    release = threading.Event()
+    loader = Loader()
+
+    def slow_loader():
+        release.wait(5)
+        return loader()
+
+    for _ in range(5):
+        assert cache.get_or_load("q", slow_loader) == "v1"
+    release.set()
+    wait_until(lambda: cache.revalidations == 1)
+
+    assert loader.calls == 1
+    assert cache.stale_hits == 5
+
+
+def test_normalize_query():
+    assert normalize_query("  The   Office\t") == normalize_query("the office") == "the office"
+
+
+class Wrapper:
+    def __init__(self):
+        self.calls = 0
+
+    @cached_search(SearchCache(max_size=10, ttl=60, stale_ttl=600))
+    def search(self, query, page=1):
+        self.calls += 1
+        return [{"title": query, "page": page, "isbns": ["1"]}]
+
+
+def test_cached_search_shares_entries_across_spellings():
+    wrapper = Wrapper()
+
+    assert wrapper.search("Dune") == wrapper.search(" dune ")
+    assert wrapper.calls == 1
+    wrapper.search("dune", 2)
+    assert wrapper.calls == 2
+
+
+def test_cached_search_results_can_be_mutated_safely():
+    wrapper = Wrapper()
+    results = wrapper.search("Emma")
+    results[0]["isbns"].append("2")
+    results.append({"title": "extra"})
+
+    assert wrapper.search("Emma") == [{"title": "Emma", "page": 1, "isbns": ["1"]}]
@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+
+from cache.singleflight import SingleFlight
+
+
+def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("callers never arrived")
+
+
+def run_concurrently(single_flight, key, fn, callers):
+    """
+    Start callers threads on the same key while fn is blocked, then return their futures.
+    """
+    release = threading.Event()
+
+    def blocked():
+        release.wait(5)
+        return fn()
+
+    executor = ThreadPoolExecutor(max_workers=callers)
+    futures = [executor.submit(single_flight.do, key, blocked) for _ in range(callers)]
+    wait_until(lambda: single_flight.executed + single_flight.coalesced == callers)
+    release.set()
+    executor.shutdown(wait=True)
+    return futures
+
+
+def test_concurrent_calls_share_one_execution():
+    single_flight = SingleFlight()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return ["result"]
+
+    futures = run_concurrently(single_flight, "dune", fn, callers=8)
+    results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert (single_flight.executed, single_flight.coalesced) == (1, 7)
+    assert single_flight.stats()["in_flight"] == 0
+
+
+def test_error_is_raised_to_every_waiting_caller():
+    single_flight = SingleFlight()
+
+    def fn():
+        raise ValueError("provider down")
+
+    futures = run_concurrently(single_flight, "dune", fn, callers=4)
+
+    for future in futures:
+        with pytest.raises(ValueError, match="provider down"):
+            future.result()
+    assert single_flight.executed == 1
+
+
+def test_results_are_not_kept_after_the_call():
+    single_flight = SingleFlight()
+    results = iter(["first", "second"])
+
+    assert single_flight.do("dune", lambda: next(results)) == "first"
+    assert single_flight.do("dune", lambda: next(results)) == "second"
+    assert single_flight.coalesced == 0
+
+
+def test_failed_call_does_not_block_the_next_one():
+    single_flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError("provider down")
+
+    with pytest.raises(RuntimeError):
+        single_flight.do("dune", fail)
+    assert single_flight.do("dune", lambda: "ok") == "ok"
+
+
+def test_different_keys_run_separately():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    started = []
+
+    def fn(key):
+        started.append(key)
+        release.wait(5)
+        return key
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(single_flight.do, key, lambda key=key: fn(key)) for key in ("dune", "emma")]
+        wait_until(lambda: len(started) == 2)
+        release.set()
+
+    assert [future.result() for future in futures] == ["dune", "emma"]
+    assert (single_flight.executed, single_flight.coalesced) == (2, 0)
@@ -0,0 +1,116 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+
+from cache.search import normalize_query
+from config import BOOK_SEARCH_DEADLINE_SECONDS
+from models.books import Book, CoverSize
+from wrappers.google_books import google_books_client
+from wrappers.open_lib import open_library_client
+
+logger = logging.getLogger(__name__)
+
+_provider_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="federated-books")
+
+
+class ProviderStats:
+    """
+    Latency, error and timeout counts for one provider. Latencies are kept for the most recent calls only.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self._latencies_ms = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency_ms: float, error: bool):
+        with self._lock:
+            self.calls += 1
+            self.errors += int(error)
+            self._latencies_ms.append(latency_ms)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            latencies = sorted(self._latencies_ms)
+        return {"calls": self.calls,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "p50_latency_ms": round(latencies[len(latencies) // 2], 1) if latencies else None,
+                "p95_latency_ms": round(latencies[int(len(latencies) * 0.95)], 1) if latencies else None,
+                "max_latency_ms": round(latencies[-1], 1) if latencies else None}
+
+
+class FederatedBookSearch:
+    """
+    Searches several book providers in parallel and merges their results. Providers that have not answered by
+    the deadline are left out of the response (their call still finishes in the background, which warms their
+    search cache). Results are ordered by provider priority and de-duplicated by ISBN, or by normalized title and
+    first author when there are no ISBNs in common.
+    """
+
+    def __init__(self, providers: Dict[str, Callable[[str], List[Book]]], deadline: float):
+        """
+        :param providers: provider name -> search function, highest priority first
+        :param deadline: seconds to wait for providers
+        """
+        self.providers = providers
+        self.deadline = deadline
+        self.provider_stats = {name: ProviderStats() for name in providers}
+
+    def search(self, query: str) -> List[Book]:
+        futures = {name: _provider_executor.submit(self._timed_search, name, search, query)
+                   for name, search in self.providers.items()}
+        wait(futures.values(), timeout=self.deadline)
+
+        result_sets = []
+        for name, future in futures.items():
+            if not future.done():
+                self.provider_stats[name].timeouts += 1
+                logger.warning(f"Book provider {name} missed the {self.deadline}s deadline for '{query}'")
+                continue
+            try:
+                result_sets.append(future.result())
+            except Exception:
+                logger.exception(f"Book provider {name} failed for '{query}'")
+
+        return self.merge(result_sets)
+
+    def stats(self) -> Dict:
+        return {name: provider_stats.stats() for name, provider_stats in self.provider_stats.items()}
+
+    @staticmethod
+    def merge(result_sets: List[List[Book]]) -> List[Book]:
+        seen = set()
+        merged = []
+        for books in result_sets:
+            for book in books or []:
+                first_author = book.author_names[0] if book.author_names else ''
+                keys = {('isbn', isbn) for isbn in getattr(book, 'isbns', None) or []}
+                keys.add(('title_author', normalize_query(book.title or ''), normalize_query(first_author)))
+                if keys & seen:
+                    continue
+                seen |= keys
+                merged.append(book)
+        return merged
+
+    def _timed_search(self, name: str, search: Callable[[str], List[Book]], query: str) -> List[Book]:
+        start = time.perf_counter()
+        error = False
+        try:
+            return search(query)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.provider_stats[name].record((time.perf_counter() - start) * 1000, error)
+
+
+federated_book_search = FederatedBookSearch(
+    providers={'google_books': google_books_client.get_books_by_query,
+               'open_library': lambda query: open_library_client.get_books_by_title(query, CoverSize.MEDIUM)},
+    deadline=BOOK_SEARCH_DEADLINE_SECONDS)
@@ -1,27 +1,31 @@
 from typing import List, Dict
 
-from config import GOOGLE_BOOKS_API_KEY 
-import requests
-from requests.adapters import HTTPAdapter, Retry
+from cache.search import SearchCache, cached_search
+from config import GOOGLE_BOOKS_API_KEY, SEARCH_CACHE_MAX_SIZE, SEARCH_CACHE_TTL_SECONDS, SEARCH_CACHE_STALE_SECONDS, \
+    GOOGLE_BOOKS_RATE_LIMIT_PER_SECOND, GOOGLE_BOOKS_RATE_LIMIT_BURST, RATE_LIMIT_MAX_WAIT_SECONDS
 
 from models.books import Book
+from wrappers.http import build_session, session_pool_stats
+from wrappers.rate_limit import TokenBucket
+
+rate_limiter = TokenBucket('google books', rate=GOOGLE_BOOKS_RATE_LIMIT_PER_SECOND, burst=GOOGLE_BOOKS_RATE_LIMIT_BURST,
+                           max_wait=RATE_LIMIT_MAX_WAIT_SECONDS)
+
+search_cache = SearchCache(max_size=SEARCH_CACHE_MAX_SIZE,
+                           ttl=SEARCH_CACHE_TTL_SECONDS,
+                           stale_ttl=SEARCH_CACHE_STALE_SECONDS)
 
-# this are the HTTP status codes that we are going to retry
-# 429 - too many requests (rate limited)
-# 502 - bad gateway
-# 503 - service unavailable
-RETRY_CODES = [429, 502, 503]
 
 class GoogleBooks:
     def __init__(self):
         self.base_uri = 'https://www.googleapis.com/books/v1/volumes'
         self.api_key = GOOGLE_BOOKS_API_KEY
-        self.session = requests.Session()
-        self.session.mount(self.base_uri, HTTPAdapter(max_retries=Retry(total=5,
-                                                                        read=5,
-                                                                        connect=5,
-                                                                        redirect=5, backoff_factor=0.1)))
+        self.session = build_session(self.base_uri, rate_limiter=rate_limiter)
+
+    def pool_stats(self) -> Dict:
+        return session_pool_stats(self.session)
 
+    @cached_search(search_cache)
     def get_books_by_title(self, title: str) -> List[Book]:
         payload = {'q': f'intitle:{title}',
                    'key': self.api_key}
@@ -31,10 +35,11 @@ class GoogleBooks:
         response.raise_for_status()
         response_body = response.json()
 
-        items = response_body.get('items')
+        items = response_body.get('items', [])
         books = [self.book_from_google_books_result(result=item) for item in items]
         return books
 
+    @cached_search(search_cache)
     def get_books_by_query(self, query: str) -> List[Book]:
         payload = {'q': query,
                    'key': self.api_key}
@@ -44,7 +49,7 @@ class GoogleBooks:
         response.raise_for_status()
         response_body = response.json()
 
-        items = response_body.get('items')
+        items = response_body.get('items', [])
         books = [self.book_from_google_books_result(result=item) for item in items]
         return books
 
@@ -63,4 +68,12 @@ class GoogleBooks:
         clean_result['publish_year'] = int(publish_year.split('-')[0].replace('*', '')) if publish_year else None
         clean_result['cover_url'] = image_links.get('thumbnail', None) if image_links else None
 
-        return Book.from_dict(clean_result)
+        book = Book.from_dict(clean_result)
+        # Not persisted; only used to match this edition against other providers' results
+        book.isbns = [identifier.get('identifier') for identifier in info.get('industryIdentifiers', [])
+                      if identifier.get('type') in ('ISBN_10', 'ISBN_13')]
+        return book
+
+
+# Shared by every request in the worker so searches reuse kept-alive connections
+google_books_client = GoogleBooks()
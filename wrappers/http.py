@@ -0,0 +1,93 @@
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+from config import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS
+from wrappers.rate_limit import TokenBucket, parse_retry_after
+
+# Responses whose Retry-After pauses the provider's rate limiter
+RETRY_AFTER_CODES = [429, 503]
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that applies a default (connect, read) timeout to every request, takes a token from the provider's
+    rate limiter before sending, and can report how often connections in its pools are reused.
+    """
+
+    def __init__(self, timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS),
+                 rate_limiter: Optional[TokenBucket] = None, **kwargs):
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        response = super().send(request, **kwargs)
+
+        if self.rate_limiter is not None and response.status_code in RETRY_AFTER_CODES:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                self.rate_limiter.pause(retry_after)
+        return response
+
+    def pool_stats(self) -> Dict:
+        """
+        Connection reuse across every host pool of this adapter. A connection is opened for each request
+        that could not reuse a kept-alive one, so reuse_rate is the share of requests that skipped a handshake.
+        """
+        pools = self.poolmanager.pools
+        connections = 0
+        requests_made = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_made += pool.num_requests
+
+        return {'pools': len(pools),
+                'pool_maxsize': self._pool_maxsize,
+                'connections_opened': connections,
+                'requests': requests_made,
+                'reuse_rate': round(1 - connections / requests_made, 4) if requests_made else None}
+
+
+def build_session(base_uri: str, rate_limiter: Optional[TokenBucket] = None) -> requests.Session:
+    """
+    Build a long-lived session for one provider. Sessions are shared between request threads; urllib3's
+    connection pools are thread-safe and hand each thread its own kept-alive connection.
+
+    Only connection and read failures are retried. Throttled responses (429/503) are returned as is and pause
+    the rate limiter instead, since retrying them right away just spends more of the quota.
+    :param base_uri: prefix of every URL the session will call
+    :param rate_limiter: token bucket every request to this provider goes through
+    :return:
+    """
+    session = requests.Session()
+    session.mount(base_uri, PooledHTTPAdapter(rate_limiter=rate_limiter,
+                                              pool_connections=HTTP_POOL_CONNECTIONS,
+                                              pool_maxsize=HTTP_POOL_MAXSIZE,
+                                              max_retries=Retry(total=5,
+                                                                read=2,
+                                                                connect=3,
+                                                                redirect=5,
+                                                                status=0,
+                                                                respect_retry_after_header=False,
+                                                                backoff_factor=0.1)))
+    return session
+
+
+def session_pool_stats(session: requests.Session) -> Dict:
+    """
+    Pool stats for every PooledHTTPAdapter mounted on a session, keyed by mount prefix.
+    :param session:
+    :return:
+    """
+    return {prefix: adapter.pool_stats() for prefix, adapter in session.adapters.items()
+            if isinstance(adapter, PooledHTTPAdapter)}
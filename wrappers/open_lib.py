@@ -1,21 +1,29 @@
 from typing import List, Dict
 
-import requests
-
+from config import OPEN_LIBRARY_RATE_LIMIT_PER_SECOND, OPEN_LIBRARY_RATE_LIMIT_BURST, RATE_LIMIT_MAX_WAIT_SECONDS
 from models.books import Book, CoverSize, IdType
+from wrappers.http import build_session, session_pool_stats
+from wrappers.rate_limit import TokenBucket
+
+rate_limiter = TokenBucket('open library', rate=OPEN_LIBRARY_RATE_LIMIT_PER_SECOND, burst=OPEN_LIBRARY_RATE_LIMIT_BURST,
+                           max_wait=RATE_LIMIT_MAX_WAIT_SECONDS)
 
 
 class OpenLibrary:
     def __init__(self):
         self.open_library_search_base_uri = 'http://openlibrary.org/search.json'
         self.open_library_cover_uri = 'http://covers.openlibrary.org/b'
+        self.session = build_session(self.open_library_search_base_uri, rate_limiter=rate_limiter)
+
+    def pool_stats(self) -> Dict:
+        return session_pool_stats(self.session)
 
     def get_books_by_title(self, title: str, cover_image_size: CoverSize) -> List[Book]:
         reformatted_title = title.replace(' ', '+')
 
         payload = {'title': reformatted_title}
 
-        response = requests.get(self.open_library_search_base_uri, params=payload)
+        response = self.session.get(self.open_library_search_base_uri, params=payload)
 
         response.raise_for_status()
         response_body = response.json()
@@ -40,7 +48,7 @@ class OpenLibrary:
         clean_result['source_id'] = source_id
         clean_result['source'] = 'open library'
         clean_result['title'] = title.title()
-        clean_result['author_name'] = author_names.pop(0).title() if author_names else None
+        clean_result['author_names'] = [author_name.title() for author_name in author_names]
         clean_result['publish_year'] = publish_years.pop(0) if publish_years else None
 
         if cover_id:
@@ -50,4 +58,11 @@ class OpenLibrary:
         else:
             clean_result['cover_url'] = None
 
-        return Book.from_dict(clean_result)
+        book = Book.from_dict(clean_result)
+        # Not persisted; only used to match this edition against other providers' results
+        book.isbns = isbns
+        return book
+
+
+# Shared by every request in the worker so searches reuse kept-alive connections
+open_library_client = OpenLibrary()
@@ -0,0 +1,123 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
+import time
+from typing import Optional
+
+import requests
+
+
+class RateLimited(requests.exceptions.RequestException):
+    """
+    Raised instead of sending a request when the provider's quota would not free up within the limiter's max wait.
+    """
+
+    def __init__(self, provider: str, retry_after: float):
+        self.provider = provider
+        self.retry_after = retry_after
+        super().__init__(f"{provider} rate limit reached, retry in {retry_after:.1f}s")
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every thread calling one provider. Requests take a token, waiting up to max_wait for one
+    to refill. A Retry-After from the provider pauses the whole bucket, so one throttled response holds back every
+    request in the worker rather than each retrying on its own.
+    """
+
+    def __init__(self, provider: str, rate: float, burst: int, max_wait: float):
+        """
+        :param provider: name used in errors and stats
+        :param rate: tokens added per second
+        :param burst: bucket size
+        :param max_wait: longest a request will queue for a token before RateLimited is raised
+        """
+        self.provider = provider
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+        self.acquired = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.pauses = 0
+        self.total_wait_seconds = 0.0
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        waited = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.acquired += 1
+                    if waited:
+                        self.delayed += 1
+                        self.total_wait_seconds += now - start
+                    return
+
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+                if now + wait > deadline:
+                    self.rejected += 1
+                    raise RateLimited(self.provider, retry_after=wait)
+            time.sleep(wait)
+            waited = True
+
+    def pause(self, seconds: float):
+        """
+        Stop handing out tokens for the given number of seconds, e.g. because the provider sent Retry-After.
+        :param seconds:
+        :return:
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self.pauses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {"rate_per_second": self.rate,
+                    "burst": self.burst,
+                    "tokens": round(self._tokens, 2),
+                    "paused_for_seconds": round(max(0.0, self._blocked_until - now), 1),
+                    "acquired": self.acquired,
+                    "delayed": self.delayed,
+                    "rejected": self.rejected,
+                    "pauses": self.pauses,
+                    "total_wait_seconds": round(self.total_wait_seconds, 2)}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header, given either as seconds or as an HTTP date.
+    :param value:
+    :return: seconds to wait, or None if the header is missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+    return max(0.0, seconds)
@@ -1,25 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict
+import logging
+from typing import Callable, List, Dict, Iterable, Optional
+
+from cache.lru import TTLCache
+from cache.search import SearchCache, cached_search
+from config import TMDB_TOKEN, SEARCH_CACHE_MAX_SIZE, SEARCH_CACHE_TTL_SECONDS, SEARCH_CACHE_STALE_SECONDS, \
+    TMDB_DETAIL_CONCURRENCY, TV_NETWORKS_CACHE_MAX_SIZE, TV_NETWORKS_CACHE_TTL_SECONDS, \
+    TMDB_RATE_LIMIT_PER_SECOND, TMDB_RATE_LIMIT_BURST, RATE_LIMIT_MAX_WAIT_SECONDS
+from models.movies import Movie
+from models.tv import TV
+from wrappers.http import build_session, session_pool_stats
+from wrappers.rate_limit import TokenBucket
 
-import requests
-from requests.adapters import HTTPAdapter, Retry
+logger = logging.getLogger(__name__)
 
-from config import TMDB_TOKEN
+rate_limiter = TokenBucket('tmdb', rate=TMDB_RATE_LIMIT_PER_SECOND, burst=TMDB_RATE_LIMIT_BURST,
+                           max_wait=RATE_LIMIT_MAX_WAIT_SECONDS)
+
+search_cache = SearchCache(max_size=SEARCH_CACHE_MAX_SIZE,
+                           ttl=SEARCH_CACHE_TTL_SECONDS,
+                           stale_ttl=SEARCH_CACHE_STALE_SECONDS)
+
+# tmdb_id -> list of network names
+tv_networks_cache = TTLCache(max_size=TV_NETWORKS_CACHE_MAX_SIZE, ttl=TV_NETWORKS_CACHE_TTL_SECONDS)
+
+_detail_executor = ThreadPoolExecutor(max_workers=TMDB_DETAIL_CONCURRENCY, thread_name_prefix="tmdb-detail")
 
-from models.movies import Movie
-from models.tv import TV
 
 class TMDB:
-    def __init__(self):
+    def __init__(self, load_tv_details: Optional[Callable[[List[str]], Dict[str, Dict]]] = None,
+                 save_tv_details: Optional[Callable[[Dict[str, Dict]], None]] = None):
+        """
+        :param load_tv_details: gets show details saved by an earlier fetch, str(tmdb_id) -> details payload
+        :param save_tv_details: saves fetched show details, str(tmdb_id) -> details payload
+        Without them, show details are only cached in memory; see use_tv_details_store.
+        """
         self.search_base_uri = 'https://api.themoviedb.org/3'
         self.poster_cover_uri = 'http://image.tmdb.org/t/p/w185'
         self.api_key = TMDB_TOKEN
-        self.session = requests.Session()
-        self.session.mount(self.search_base_uri, HTTPAdapter(max_retries=Retry(total=5,
-                                                                               read=5,
-                                                                               connect=5,
-                                                                               redirect=5, backoff_factor=0.1)))
-
+        self.session = build_session(self.search_base_uri, rate_limiter=rate_limiter)
+        self.load_tv_details = load_tv_details
+        self.save_tv_details = save_tv_details
+
+    def use_tv_details_store(self, load_tv_details: Callable[[List[str]], Dict[str, Dict]],
+                             save_tv_details: Callable[[Dict[str, Dict]], None]):
+        """
+        Share fetched show details beyond this worker's memory, e.g. in the database.
+        :param load_tv_details: see __init__
+        :param save_tv_details: see __init__
+        :return:
+        """
+        self.load_tv_details = load_tv_details
+        self.save_tv_details = save_tv_details
+
+    def pool_stats(self) -> Dict:
+        return session_pool_stats(self.session)
+
+    @cached_search(search_cache)
     def get_movies_by_title(self, title: str) -> List[Movie]:
         payload = {'query': title,
                    'api_key': self.api_key,
@@ -46,6 +84,7 @@ class TMDB:
 
         return Movie.from_dict(clean_result)
 
+    @cached_search(search_cache)
     def get_tv_by_title(self, title: str) -> List[Movie]:
         payload = {'query': title,
                    'api_key': self.api_key,
@@ -58,10 +97,12 @@ class TMDB:
         response_body = response.json()
 
         results = response_body.get('results')
-        books = [self.tv_from_tmdb_result(result=result) for result in results]
+        networks = self.get_tv_networks_by_ids([result.get('id') for result in results])
+        books = [self.tv_from_tmdb_result(result=result, networks=networks.get(result.get('id'), []))
+                 for result in results]
         return books
 
-    def tv_from_tmdb_result(self, result: Dict) -> Movie:
+    def tv_from_tmdb_result(self, result: Dict, networks: Optional[List[str]] = None) -> Movie:
         clean_result = {}
 
         id = result.get('id', None)
@@ -71,18 +112,85 @@ class TMDB:
         clean_result['title'] = result.get('name', None)
         clean_result['first_air_date'] = datetime.strptime(result.get('first_air_date'), '%Y-%m-%d').date() if result.get('first_air_date') else None
         clean_result['poster_url'] = f"{self.poster_cover_uri}{result.get('poster_path')}" if result.get('poster_path') else None
-        clean_result['networks'] = self.get_tv_network_by_id(id)
+        clean_result['networks'] = networks if networks is not None else self.get_tv_network_by_id(id)
 
         return TV.from_dict(clean_result)
 
+    def get_tv_networks_by_ids(self, tmdb_ids: Iterable[int]) -> Dict[int, List[str]]:
+        """
+        Get the networks for several shows at once. Shows are looked up in the in-memory networks cache, then in
+        the details store (one lookup for all of them), and only the rest are fetched from TMDB,
+        concurrently and once per repeated id.
+        :param tmdb_ids:
+        :return: tmdb_id -> network names; shows whose details could not be fetched are left out
+        """
+        networks = {}
+        missing = []
+        for tmdb_id in dict.fromkeys(tmdb_ids):
+            cached = tv_networks_cache.get(tmdb_id)
+            if cached is not None:
+                networks[tmdb_id] = cached
+            else:
+                missing.append(tmdb_id)
+
+        stored = self.get_stored_tv_details(missing)
+        for tmdb_id in missing:
+            details = stored.get(str(tmdb_id))
+            if details is not None:
+                networks[tmdb_id] = self.networks_from_tv_details(details)
+                tv_networks_cache.set(tmdb_id, networks[tmdb_id])
+
+        to_fetch = [tmdb_id for tmdb_id in missing if tmdb_id not in networks]
+        futures = {tmdb_id: _detail_executor.submit(self.get_tv_details_by_id, tmdb_id) for tmdb_id in to_fetch}
+        fetched = {}
+        for tmdb_id, future in futures.items():
+            try:
+                fetched[str(tmdb_id)] = future.result()
+            except Exception:
+                logger.exception(f"Unable to fetch networks for tv show {tmdb_id}")
+                continue
+            networks[tmdb_id] = self.networks_from_tv_details(fetched[str(tmdb_id)])
+            tv_networks_cache.set(tmdb_id, networks[tmdb_id])
+
+        self.store_tv_details(fetched)
+        return networks
+
+    def get_stored_tv_details(self, tmdb_ids: List[int]) -> Dict[str, Dict]:
+        """
+        Get show details saved by an earlier fetch, from any worker.
+        :param tmdb_ids:
+        :return: str(tmdb_id) -> details payload
+        """
+        if not self.load_tv_details or not tmdb_ids:
+            return {}
+        return self.load_tv_details([str(tmdb_id) for tmdb_id in tmdb_ids])
+
+    def store_tv_details(self, details: Dict[str, Dict]):
+        """
+        Save show details so other workers, and this one after a restart, don't fetch them again.
+        :param details: str(tmdb_id) -> details payload
+        :return:
+        """
+        if not self.save_tv_details or not details:
+            return
+        self.save_tv_details(details)
+
     def get_tv_network_by_id(self, tmdb_id: int) -> List[str]:
+        return self.networks_from_tv_details(self.get_tv_details_by_id(tmdb_id))
+
+    def get_tv_details_by_id(self, tmdb_id: int) -> Dict:
         payload = {'api_key': self.api_key,
                    'language': 'en-US'}
 
         response = self.session.get(f'{self.search_base_uri}/tv/{tmdb_id}', params=payload)
         response.raise_for_status()
-        response_body = response.json()
+        return response.json()
 
-        networks = [d.get('name') for d in response_body.get('networks')]
+    @staticmethod
+    def networks_from_tv_details(details: Dict) -> List[str]:
+        return [d.get('name') for d in details.get('networks', [])]
 
-        return networks
+
+# Shared by every request in the worker so searches reuse kept-alive connections. The app points it at the
+# media_metadata table on startup (main.py)
+tmdb_client = TMDB()